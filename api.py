@@ -0,0 +1,346 @@
+"""
+Title: MCDB HTTP API
+Author: Billy Cobb
+Desc: Optional read-only JSON API served from the bot's event loop, answering from the same resident locations, indexes
+and presence histories the commands use
+"""
+
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import time
+
+from aiohttp import web
+
+from cache import missing
+from guilds import home_key
+from metrics import metrics
+from transfer import parse_dim
+
+
+""" API Vars """
+
+
+default_limit = 100  # locations per page when the request doesn't give a limit
+max_limit = 1000
+gzip_min_bytes = 1024  # smaller bodies are sent uncompressed
+gzip_executor_bytes = 256 * 1024  # larger bodies are compressed on a worker thread
+
+
+class APIError(Exception):
+	"""
+	A request the API can't answer, sent back as {"error": message} with the status
+	"""
+
+	def __init__(self, status: int, message: str):
+		super().__init__(message)
+		self.status = status
+
+
+def int_param(request: web.Request, name: str, default: int = None, lo: int = None, hi: int = None):
+	"""
+	:param request: The request
+	:param name: The query parameter
+	:param default: Value when it is left out, None makes it required
+	:param lo: Smallest value allowed
+	:param hi: Largest value allowed
+	:return: The parameter as an int
+	:raises APIError: if it is missing, not an int or out of range
+	"""
+	value = request.query.get(name)
+	if value is None:
+		if default is None:
+			raise APIError(400, f'{name} is required')
+		return default
+	try:
+		value = int(value)
+	except ValueError:
+		raise APIError(400, f'{name} must be an integer')
+	if (lo is not None and value < lo) or (hi is not None and value > hi):
+		raise APIError(400, f'{name} must be between {lo} and {hi}')
+	return value
+
+
+def page_params(request: web.Request):
+	"""
+	:return: The (offset, limit) of a paginated request
+	"""
+	return int_param(request, 'offset', 0, lo=0), int_param(request, 'limit', default_limit, lo=1, hi=max_limit)
+
+
+def location_json(name: str, loc: dict):
+	return {'name': name, 'dimension': loc["Dimension"], 'x': loc["X"], 'y': loc["Y"], 'z': loc["Z"],
+			'tags': loc.get("Tags", [])}
+
+
+""" Location API """
+
+
+class LocationAPI:
+	"""
+	Serves GET requests under /guilds/{guild}, where guild is 'home' or a guild id with a namespace folder. Index
+	queries go through the same query path as the commands, so a large guild's may be awaited on the worker pool,
+	and are run again if the locations changed meanwhile. Every body is then read from the resident data without
+	awaiting again, so a response is a consistent snapshot of one store generation. Location responses are tagged
+	with the generation they were built from and their encoded bodies are kept in the guild's query cache, so
+	repeated requests and If-None-Match revalidations skip the work until it changes.
+	"""
+
+	def __init__(self, guilds, servers, query, owns=None):
+		"""
+		:param guilds: The bot's GuildRegistry
+		:param servers: The bot's ServerRegistry, for presence
+		:param query: A coroutine function taking a GuildData, a cache key, an index method and its arguments and
+		returning the method's result from the guild's query cache, running it if it isn't cached
+		:param owns: A callable telling whether this process owns a namespace key when the bot runs as several
+		shard processes, each serving its own guilds, None when it owns every key
+		"""
+		self.guilds = guilds
+		self.servers = servers
+		self.query = query
+		self.owns = owns
+		self.boot = format(int(time.time()), 'x')  # keeps ETags from one run matching another run's generations
+		self.runner = None
+		self.requests = 0
+		self.not_modified = 0
+		self.gzipped = 0
+		self.errors = 0
+		self.app = web.Application()
+		self.app.add_routes([
+			web.get('/guilds/{guild}/locations', self.locations),
+			web.get('/guilds/{guild}/locations/{name}', self.location),
+			web.get('/guilds/{guild}/find', self.find),
+			web.get('/guilds/{guild}/near', self.near),
+			web.get('/guilds/{guild}/presence', self.presence)
+		])
+
+	async def start(self, host: str, port: int):
+		"""
+		Starts serving if it isn't already
+		:param host: Address to bind, keep it local unless a proxy sits in front
+		:param port: Port to bind
+		:return: None
+		"""
+		if self.runner is not None:
+			return
+		self.runner = web.AppRunner(self.app, access_log=None)
+		await self.runner.setup()
+		await web.TCPSite(self.runner, host, port).start()
+		print(f'HTTP API listening on http://{host}:{port}')
+
+	async def close(self):
+		if self.runner is not None:
+			await self.runner.cleanup()
+			self.runner = None
+
+	async def _guild(self, request: web.Request):
+		"""
+		:return: The GuildData named in the path, loaded off the event loop, only namespaces that already exist are
+		opened
+		:raises APIError: if there is no such namespace, or another shard process serves it
+		"""
+		key = request.match_info['guild']
+		if self.owns is not None and (key == home_key or key.isdigit()) and not self.owns(key):
+			raise APIError(404, f'guild {key} is served by another shard process')
+		if key == home_key:
+			return await self.guilds.open(self.guilds.home_guild_id)
+		if key.isdigit() and (key in self.guilds.guilds or os.path.isdir(os.path.join(self.guilds.root, key))):
+			return await self.guilds.open(int(key))
+		raise APIError(404, f'no guild {key}')
+
+	async def _respond(self, request: web.Request, route: str, handler, tagged: bool = True):
+		"""
+		Runs a handler and sends its result as json, honouring If-None-Match and Accept-Encoding
+		:param request: The request
+		:param route: Route name for metrics
+		:param handler: A callable taking the request and the GuildData named in its path, opened before it runs, and
+		returning build, a coroutine function returning the json serializable body. build is only awaited if the
+		encoded body isn't cached.
+		:param tagged: The body is built from the locations and holds the generation it was built from, which tags it
+		and keys its cache entry. Other bodies are tagged by their hash and not cached.
+		:return: The web.Response
+		"""
+		self.requests += 1
+		with metrics.timer('mcdb_api_seconds', route=route):
+			try:
+				guild = await self._guild(request)
+				build = handler(request, guild)
+				source = guild if tagged else None
+				encoded = None
+				if source is not None:
+					etag = self._etag(source, source.store.generation)
+				else:
+					encoded = await self._encode(build, None, request.path_qs)
+					etag = encoded[1]
+				headers = {'ETag': etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'}
+				if etag in (tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')):
+					self.not_modified += 1
+					metrics.inc('mcdb_api_requests_total', route=route, status='304')
+					return web.Response(status=304, headers=headers)
+				if encoded is None:
+					encoded = await self._encode(build, source, request.path_qs)
+					headers['ETag'] = encoded[1]  # a later generation if the locations changed while it was built
+			except APIError as e:
+				self.errors += 1
+				metrics.inc('mcdb_api_requests_total', route=route, status=str(e.status))
+				return web.json_response({'error': str(e)}, status=e.status)
+			data = encoded[0]
+			if len(data) >= gzip_min_bytes and 'gzip' in request.headers.get('Accept-Encoding', ''):
+				if encoded[2] is None:  # compressed once per cached body
+					encoded[2] = (await asyncio.get_running_loop().run_in_executor(None, gzip.compress, data, 6)
+								  if len(data) >= gzip_executor_bytes else gzip.compress(data, 6))
+				data = encoded[2]
+				headers['Content-Encoding'] = 'gzip'
+				self.gzipped += 1
+			metrics.inc('mcdb_api_requests_total', route=route, status='200')
+			return web.Response(body=data, content_type='application/json', headers=headers)
+
+	async def _encode(self, build, guild, path: str):
+		"""
+		:param build: The handler's build coroutine function
+		:param guild: The GuildData a tagged body is built from, None for a body tagged by its hash
+		:param path: The request's path and query string, keying the cached body
+		:return: A [json bytes, ETag, gzipped bytes or None] list for a body, from the guild's query cache if the body
+		came from an unchanged store
+		"""
+		if guild is not None:
+			encoded = guild.query_cache.get(('api', path), guild.store.generation)
+			if encoded is not missing:
+				return encoded
+		body = await build()
+		data = json.dumps(body, separators=(',', ':')).encode('utf-8')
+		if guild is None:
+			return [data, f'W/"{hashlib.sha1(data).hexdigest()[:16]}"', None]
+		encoded = [data, self._etag(guild, body['generation']), None]
+		guild.query_cache.put(('api', path), body['generation'], encoded)  # dropped if the locations changed since
+		return encoded
+
+	def _etag(self, guild, generation: int):
+		"""
+		:return: The ETag of a response built from a guild's locations at a store generation
+		"""
+		return f'W/"{self.boot}-{guild.key}-{generation}"'
+
+	async def _query(self, guild, key: tuple, method: str, *args, **kwargs):
+		"""
+		Runs an index query through the bot's query path, again if the locations changed while it was awaited
+		:return: The result, computed at the store generation that is still current when it is returned
+		"""
+		while True:
+			generation = guild.store.generation
+			result = await self.query(guild, key, method, *args, **kwargs)
+			if guild.store.generation == generation:
+				return result
+
+	def _paged(self, request: web.Request, guild, total: int, offset: int, limit: int, key: str, items: list):
+		"""
+		:return: A page body with the store generation and a link to the next page
+		"""
+		next_page = None
+		if offset + limit < total:
+			next_page = str(request.rel_url.update_query({'offset': offset + limit, 'limit': limit}))
+		return {'generation': guild.store.generation, 'total': total, 'offset': offset, 'limit': limit,
+				'next': next_page, key: items}
+
+	async def locations(self, request: web.Request):
+		"""
+		GET /guilds/{guild}/locations?dim=&offset=&limit=, locations sorted by name
+		"""
+		def handler(request, guild):
+			dim = request.query.get('dim')
+			if dim is not None and parse_dim(dim) is None:
+				raise APIError(400, f'unknown dimension {dim}')
+			dim = parse_dim(dim)
+			offset, limit = page_params(request)
+
+			async def build():
+				locs = guild.store.locations
+				names = guild.query_cache.lookup(('api_names', dim), guild.store.generation, lambda: sorted(
+					name for name in locs if dim is None or locs[name]["Dimension"] == dim))
+				page = [location_json(name, locs[name]) for name in names[offset:offset + limit]]
+				return self._paged(request, guild, len(names), offset, limit, 'locations', page)
+			return build
+		return await self._respond(request, 'locations', handler)
+
+	async def location(self, request: web.Request):
+		"""
+		GET /guilds/{guild}/locations/{name}
+		"""
+		def handler(request, guild):
+			name = request.match_info['name'].lower()
+			locs = guild.store.locations
+			if name not in locs:
+				raise APIError(404, f'no location {name}')
+
+			async def build():
+				return {'generation': guild.store.generation, **location_json(name, locs[name])}
+			return build
+		return await self._respond(request, 'location', handler)
+
+	async def find(self, request: web.Request):
+		"""
+		GET /guilds/{guild}/find?q=&offset=&limit=, ranked like the find command
+		"""
+		def handler(request, guild):
+			query = request.query.get('q', '').lower().strip()
+			if not query:
+				raise APIError(400, 'q is required')
+			offset, limit = page_params(request)
+
+			async def build():
+				total, found = await self._query(guild, ('api_find', query, offset, limit), 'search', query,
+												 limit=limit, offset=offset)
+				locs = guild.store.locations
+				matches = [{'match': kind, **location_json(name, locs[name])} for kind, name in found if name in locs]
+				return self._paged(request, guild, total, offset, limit, 'matches', matches)
+			return build
+		return await self._respond(request, 'find', handler)
+
+	async def near(self, request: web.Request):
+		"""
+		GET /guilds/{guild}/near?dim=&x=&y=&z=&count=&cross=, nearest first like the near command
+		"""
+		def handler(request, guild):
+			dim = parse_dim(request.query.get('dim'))
+			if dim is None:
+				raise APIError(400, 'dim must be overworld, nether or end')
+			coords = [int_param(request, axis) for axis in ('x', 'y', 'z')]
+			k = int_param(request, 'count', 5, lo=1, hi=max_limit)
+			cross = request.query.get('cross', '').lower() in ('1', 'true', 'yes')
+
+			async def build():
+				# shares cached results with the near command
+				nearest = await self._query(guild, ('near', dim, *coords, k, cross), 'nearest', dim, *coords, k=k,
+											cross=cross)
+				locs = guild.store.locations
+				found = [{'distance': round(dist, 1), **location_json(name, locs[name])}
+						 for dist, name, _ in nearest if name in locs]
+				return {'generation': guild.store.generation, 'locations': found}
+			return build
+		return await self._respond(request, 'near', handler)
+
+	async def presence(self, request: web.Request):
+		"""
+		GET /guilds/{guild}/presence, who is online on each of the guild's servers, tagged by a hash of the body
+		"""
+		def handler(request, guild):
+
+			async def build():
+				servers = []
+				for entry in self.servers.for_guild(guild.key):
+					history = entry.presence
+					peak = history.peak()
+					servers.append({'ip': entry.ip, 'online': sorted(history.online), 'count': history.last_count,
+									'peak': {'count': peak[0], 'time': peak[1]} if peak is not None else None})
+				return {'servers': servers}
+			return build
+		return await self._respond(request, 'presence', handler, tagged=False)
+
+	def stats(self):
+		"""
+		:return: A dict of request, not modified, gzipped and error counts
+		"""
+		return {'requests': self.requests, 'not_modified': self.not_modified, 'gzipped': self.gzipped,
+				'errors': self.errors}
@@ -0,0 +1,424 @@
+"""
+Title: MCDB Storage Backends
+Author: Billy Cobb
+Desc: SQLite storage for locations, members and the command log, with an R*Tree over location coordinates
+"""
+
+import asyncio
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cmdlog import CommandLog
+from metrics import metrics
+from store import load_json_data
+
+
+""" SQLite Vars """
+
+
+schema = [
+	'CREATE TABLE IF NOT EXISTS locations (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, '
+	'dimension TEXT NOT NULL, x INTEGER NOT NULL, y INTEGER NOT NULL, z INTEGER NOT NULL, extra TEXT)',
+	'CREATE INDEX IF NOT EXISTS locations_dimension ON locations (dimension)',
+	'CREATE VIRTUAL TABLE IF NOT EXISTS locations_rtree USING rtree(id, min_x, max_x, min_y, max_y, min_z, max_z)',
+	'CREATE TABLE IF NOT EXISTS members (name TEXT PRIMARY KEY, data TEXT NOT NULL)',
+	'CREATE TABLE IF NOT EXISTS command_log (id INTEGER PRIMARY KEY, time REAL NOT NULL, command TEXT, '
+	'user_id INTEGER, user_name TEXT, extra TEXT)',
+	'CREATE INDEX IF NOT EXISTS command_log_time ON command_log (time)',
+	'CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)'
+]
+
+location_keys = ("Dimension", "X", "Y", "Z")  # location fields with their own columns, the rest go in extra
+log_keys = ("Time", "Command", "UserID", "UserName")  # command log fields with their own columns
+restored_tables = ('locations', 'locations_rtree', 'members')  # tables restore_tables() copies, not the command log
+
+version_check_interval = 1.0  # secs between checks for writes made to the database by other processes
+
+
+""" SQLite Backend """
+
+
+class SQLiteBackend:
+	"""
+	Owns the SQLite connection. Every statement runs on one dedicated worker thread so the event loop never
+	waits on the database, and the connection is never shared between threads.
+	"""
+
+	def __init__(self, path: str):
+		"""
+		:param path: String path to the database file
+		"""
+		self.path = path
+		self.conn = None
+		self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mcdb-sqlite',
+										   initializer=self._connect)
+		self.statements = 0
+
+	def _connect(self):
+		"""
+		Opens the connection on the worker thread, switches it to WAL mode and creates the schema
+		:return: None
+		"""
+		self.conn = sqlite3.connect(self.path)
+		self.conn.execute('PRAGMA journal_mode=WAL')
+		self.conn.execute('PRAGMA synchronous=NORMAL')
+		with self.conn:
+			for statement in schema:
+				self.conn.execute(statement)
+
+	def _call(self, fn, *args):
+		self.statements += 1
+		with metrics.timer('mcdb_io_seconds', op=f'sqlite_{fn.__name__.strip("_")}'):
+			return fn(self.conn, *args)
+
+	def submit(self, fn, *args):
+		"""
+		Queues fn(connection, *args) on the worker thread, failures are printed rather than raised
+		:return: A concurrent.futures.Future of the result
+		"""
+		future = self.executor.submit(self._call, fn, *args)
+		future.add_done_callback(_report_error)
+		return future
+
+	def run(self, fn, *args):
+		"""
+		Runs fn(connection, *args) on the worker thread and waits for it, only for startup and worker threads
+		:return: The result of fn
+		"""
+		return self.executor.submit(self._call, fn, *args).result()
+
+	async def call(self, fn, *args):
+		"""
+		Runs fn(connection, *args) on the worker thread without blocking the event loop
+		:return: The result of fn
+		"""
+		return await asyncio.wrap_future(self.executor.submit(self._call, fn, *args))
+
+	def tables(self):
+		"""
+		:return: The resident tables for a DataStore
+		"""
+		return {
+			'locations': SQLiteTable(self, 'locations'),
+			'members': SQLiteTable(self, 'members')
+		}
+
+	async def locations_in_box(self, dim: str, x1: int, y1: int, z1: int, x2: int, y2: int, z2: int):
+		"""
+		Finds every location of a dimension inside an axis aligned box using the R*Tree
+		:return: A list of location names
+		"""
+		x1, x2 = sorted((x1, x2))
+		y1, y2 = sorted((y1, y2))
+		z1, z2 = sorted((z1, z2))
+
+		def query(conn):
+			# the R*Tree stores 32 bit floats rounded outwards, so it narrows the rows and the columns decide
+			rows = conn.execute('SELECT l.name FROM locations_rtree r JOIN locations l ON l.id = r.id '
+								'WHERE r.max_x >= ? AND r.min_x <= ? AND r.max_y >= ? AND r.min_y <= ? '
+								'AND r.max_z >= ? AND r.min_z <= ? AND l.dimension = ? '
+								'AND l.x BETWEEN ? AND ? AND l.y BETWEEN ? AND ? AND l.z BETWEEN ? AND ?',
+								(x1, x2, y1, y2, z1, z2, dim, x1, x2, y1, y2, z1, z2))
+			return [row[0] for row in rows]
+		return await self.call(query)
+
+	def migrate(self, paths: dict):
+		"""
+		Copies Locations.json, Members.json and the command log into the database the first time it is opened
+		:param paths: The json_files dict with 'locations', 'members', 'log' and 'legacy_log' paths
+		:return: True if the json data was migrated, False if the database had already been migrated
+		"""
+		if self.run(lambda conn: conn.execute("SELECT value FROM meta WHERE key = 'migrated'").fetchone()):
+			return False
+		locations = (load_json_data(paths['locations']) if os.path.exists(paths['locations']) else None) or {}
+		members = (load_json_data(paths['members']) if os.path.exists(paths['members']) else None) or {}
+		log = CommandLog(paths['log'], legacy_path=paths.get('legacy_log'))
+
+		def copy(conn):
+			with conn:
+				for name, loc in locations.items():
+					_put_location(conn, name, loc)
+				conn.executemany('INSERT OR REPLACE INTO members (name, data) VALUES (?, ?)',
+								 [(name, json.dumps(data)) for name, data in members.items()])
+				batch = []
+				for entry in log.read():
+					batch.append(_log_row(entry))
+					if len(batch) >= 10000:
+						conn.executemany(log_insert, batch)
+						batch = []
+				conn.executemany(log_insert, batch)
+				conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated', ?)", (str(time.time()),))
+		self.run(copy)
+		print(f'SQLiteBackend: migrated {len(locations)} locations and {len(members)} members to {self.path}')
+		return True
+
+	async def restore_tables(self, path: str):
+		"""
+		Replaces the locations and members with those of another database, such as a restored backup, in one
+		transaction. The command log is left as it is.
+		:param path: String path to the database to copy from
+		:return: None
+		"""
+		def copy(conn):
+			conn.execute('ATTACH DATABASE ? AS restored', (path,))
+			try:
+				with conn:
+					for table in restored_tables:
+						conn.execute(f'DELETE FROM main.{table}')
+						conn.execute(f'INSERT INTO main.{table} SELECT * FROM restored.{table}')
+			finally:
+				conn.execute('DETACH DATABASE restored')
+		await self.call(copy)
+
+	def close(self):
+		"""
+		Waits for queued writes and closes the connection
+		:return: None
+		"""
+		if self.conn is not None:
+			self.run(lambda conn: conn.close())
+		self.executor.shutdown(wait=True)
+
+
+def _report_error(future):
+	"""
+	Prints the exception of a failed fire and forget database call
+	"""
+	if not future.cancelled() and future.exception() is not None:
+		print(f'SQLiteBackend ERROR: {future.exception()!r}')
+
+
+""" Row Helpers """
+
+
+log_insert = 'INSERT INTO command_log (time, command, user_id, user_name, extra) VALUES (?, ?, ?, ?, ?)'
+
+
+def _put_location(conn: sqlite3.Connection, name: str, loc: dict):
+	"""
+	Inserts or updates a location row and its R*Tree entry
+	:return: None
+	"""
+	extra = {key: value for key, value in loc.items() if key not in location_keys}
+	conn.execute('INSERT INTO locations (name, dimension, x, y, z, extra) VALUES (?, ?, ?, ?, ?, ?) '
+				 'ON CONFLICT(name) DO UPDATE SET dimension = excluded.dimension, x = excluded.x, y = excluded.y, '
+				 'z = excluded.z, extra = excluded.extra',
+				 (name, loc["Dimension"], loc["X"], loc["Y"], loc["Z"], json.dumps(extra) if extra else None))
+	row_id = conn.execute('SELECT id FROM locations WHERE name = ?', (name,)).fetchone()[0]
+	conn.execute('INSERT OR REPLACE INTO locations_rtree VALUES (?, ?, ?, ?, ?, ?, ?)',
+				 (row_id, loc["X"], loc["X"], loc["Y"], loc["Y"], loc["Z"], loc["Z"]))
+
+
+def _delete_location(conn: sqlite3.Connection, name: str):
+	"""
+	Deletes a location row and its R*Tree entry
+	:return: None
+	"""
+	row = conn.execute('SELECT id FROM locations WHERE name = ?', (name,)).fetchone()
+	if row is not None:
+		conn.execute('DELETE FROM locations_rtree WHERE id = ?', row)
+		conn.execute('DELETE FROM locations WHERE id = ?', row)
+
+
+def _load_locations(conn: sqlite3.Connection):
+	"""
+	:return: Every location as the dict stored in Locations.json
+	"""
+	locations = {}
+	for name, dim, x, y, z, extra in conn.execute('SELECT name, dimension, x, y, z, extra FROM locations'):
+		locations[name] = {"Dimension": dim, "X": x, "Y": y, "Z": z, **(json.loads(extra) if extra else {})}
+	return locations
+
+
+def _load_members(conn: sqlite3.Connection):
+	"""
+	:return: Every member as the dict stored in Members.json
+	"""
+	return {name: json.loads(data) for name, data in conn.execute('SELECT name, data FROM members')}
+
+
+def _log_row(entry: dict):
+	"""
+	:return: The command_log column values for a log entry
+	"""
+	extra = {key: value for key, value in entry.items() if key not in log_keys}
+	return (entry.get("Time", time.time()), entry.get("Command"), entry.get("UserID"), entry.get("UserName"),
+			json.dumps(extra) if extra else None)
+
+
+""" Resident Tables """
+
+
+class SQLiteTable:
+	"""
+	The SQLite counterpart of store.ResidentFile. Data is held in memory, changes are written row by row on the
+	backend's worker thread, and writes made by other processes are noticed through PRAGMA data_version and
+	reloaded off the event loop.
+	"""
+
+	loaders = {'locations': _load_locations, 'members': _load_members}
+
+	def __init__(self, backend: SQLiteBackend, kind: str):
+		"""
+		:param backend: The SQLiteBackend owning the connection
+		:param kind: 'locations' or 'members'
+		"""
+		self.backend = backend
+		self.kind = kind
+		self.data = None
+		self.version = None
+		self.checked = 0
+		self.check = None  # future of a data_version check running on the worker thread
+		self.hits = 0
+		self.reloads = 0
+		self.writes = 0
+		self.listeners = []  # callables run with the new data every time the table is reloaded
+
+	def _load(self, conn: sqlite3.Connection):
+		return conn.execute('PRAGMA data_version').fetchone()[0], self.loaders[self.kind](conn)
+
+	def _check_version(self, conn: sqlite3.Connection):
+		"""
+		Worker thread: reloads the table if another connection has committed since it was last read
+		:return: A (version, data) tuple if it changed, else None
+		"""
+		version = conn.execute('PRAGMA data_version').fetchone()[0]
+		if version == self.version:
+			return None
+		return self._load(conn)
+
+	def _swap(self, version: int, data: dict):
+		self.version = version
+		self.data = data
+		self.reloads += 1
+		for listener in self.listeners:
+			listener(data)
+
+	def get(self):
+		"""
+		Returns the in-memory data, picking up a reload finished by an earlier background check
+		:return: The table as a dict
+		"""
+		if self.data is None:
+			self.reload()
+			return self.data
+		if self.check is not None and self.check.done():
+			result = None if self.check.exception() else self.check.result()
+			self.check = None
+			if result is not None:
+				self._swap(*result)
+				return self.data
+		if self.check is None and time.monotonic() - self.checked >= version_check_interval:
+			self.checked = time.monotonic()
+			self.check = self.backend.submit(self._check_version)
+		self.hits += 1
+		return self.data
+
+	def reload(self, stamp=None):
+		"""
+		Reads the whole table, waiting on the worker thread
+		:return: None
+		"""
+		self._swap(*self.backend.run(self._load))
+
+	def put(self, *keys: str):
+		"""
+		Writes the current values of changed entries in one transaction
+		:param keys: The keys of the entries that were added or changed
+		:return: None
+		"""
+		rows = {key: dict(self.data[key]) for key in keys if key in self.data}
+
+		def write(conn):
+			with conn:
+				for key, value in rows.items():
+					if self.kind == 'locations':
+						_put_location(conn, key, value)
+					else:
+						conn.execute('INSERT OR REPLACE INTO members (name, data) VALUES (?, ?)',
+									 (key, json.dumps(value)))
+		self.backend.submit(write)
+		self.writes += 1
+
+	def delete(self, *keys: str):
+		"""
+		Deletes removed entries in one transaction
+		:param keys: The keys of the entries that were removed
+		:return: None
+		"""
+		def write(conn):
+			with conn:
+				for key in keys:
+					if self.kind == 'locations':
+						_delete_location(conn, key)
+					else:
+						conn.execute('DELETE FROM members WHERE name = ?', (key,))
+		self.backend.submit(write)
+		self.writes += 1
+
+	def commit(self):
+		"""
+		Writes every entry of the table
+		:return: None
+		"""
+		self.put(*self.data)
+
+	def stats(self):
+		"""
+		:return: A dict of the hit, reload and write counts for this table
+		"""
+		return {'hits': self.hits, 'reloads': self.reloads, 'writes': self.writes}
+
+
+""" SQLite Command Log """
+
+
+class SQLiteCommandLog(CommandLog):
+	"""
+	A CommandLog whose buffered entries are inserted into the command_log table instead of a .jsonl segment
+	"""
+
+	def __init__(self, backend: SQLiteBackend, flush_interval: float = 2.0):
+		"""
+		:param backend: The SQLiteBackend owning the connection
+		:param flush_interval: Seconds between background flushes
+		"""
+		super().__init__(backend.path, flush_interval=flush_interval)
+		self.backend = backend
+
+	async def flush_async(self):
+		async with self.lock:
+			entries, self.buffer = self.buffer, []
+			if entries:
+				await self.backend.call(self._insert, entries)
+				self.written += len(entries)
+
+	def _write(self, entries: list):
+		self.backend.run(self._insert, entries)
+		self.written += len(entries)
+
+	@staticmethod
+	def _insert(conn: sqlite3.Connection, entries: list):
+		with conn:
+			conn.executemany(log_insert, [_log_row(entry) for entry in entries])
+
+	def read(self, since: float = None):
+		"""
+		Streams every logged entry, oldest first, in batches read on the worker thread
+		:param since: Only yield entries at or after this epoch time
+		:return: A generator of entry dicts
+		"""
+		last_id = 0
+		while True:
+			rows = self.backend.run(lambda conn: conn.execute(
+				'SELECT id, time, command, user_id, user_name, extra FROM command_log WHERE id > ? AND time >= ? '
+				'ORDER BY id LIMIT 1000', (last_id, since or 0)).fetchall())
+			if not rows:
+				return
+			for row_id, entry_time, command, user_id, user_name, extra in rows:
+				yield {"Time": entry_time, "Command": command, "UserID": user_id, "UserName": user_name,
+					   **(json.loads(extra) if extra else {})}
+			last_id = rows[-1][0]
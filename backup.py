@@ -0,0 +1,460 @@
+"""
+Title: MCDB Backups
+Author: Billy Cobb
+Desc: Incremental backups of the .resources folder as content-addressed, compressed chunks, with point-in-time restore
+and a retention policy. Run python backup.py list <backups> or python backup.py restore <backups> <timestamp> <folder>
+to look at or restore backups while the bot is stopped.
+"""
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.request import pathname2url
+
+from metrics import metrics
+from store import dump_json_data, load_json_data, replace_file
+
+
+""" Backup Vars """
+
+
+snapshot_format = '%Y%m%dT%H%M%SZ'  # backup ids are the UTC time they were taken, so they sort oldest first
+min_chunk = 16 * 1024  # bytes before a chunk may end
+max_chunk = 1024 * 1024  # bytes a chunk is cut at if no boundary turns up
+fixed_chunk = 64 * 1024  # binary files are cut at fixed offsets, sqlite pages and snapshot columns stay in place
+boundary_window = 32  # bytes before a record separator hashed to decide if a chunk ends there
+# record separators of json-lines files and json.dump output, and 1 in how many of them ends a chunk, ~40KB chunks
+delimiters = ((b'\n', 256), (b'}, "', 512))
+compress_level = 6
+capture_attempts = 3  # passes over files replaced while a backup read them, a compaction mid-backup needs a second
+skipped_suffixes = ('.tmp', '.prom', '-wal', '-shm', '-journal')  # temporary, derived or sqlite's own files
+append_suffixes = ('.jsonl', '.gz')  # logs only grow or are written once, a backup may hold a slightly older prefix
+sqlite_suffix = '.sqlite3'  # read through sqlite's backup API, a copy of the live file may be torn
+staging_prefix = '.restore-'  # folders restores are staged in, on the same disk as the files they replace
+
+
+def chunk_ends(data: bytes):
+	"""
+	Cuts data into chunks whose ends depend on the bytes around them rather than on offsets, so adding or removing
+	an entry only changes the chunk it is in. Text is cut after the record separators whose preceding bytes hash
+	to 0 mod n, binary data at fixed offsets.
+	:param data: The file's bytes
+	:return: A list of the chunks' end offsets
+	"""
+	sample = data[:max_chunk]
+	delimiter, spacing = next(((delimiter, spacing) for delimiter, spacing in delimiters
+							   if sample.count(delimiter) > len(sample) // 4096), (None, None))
+	if delimiter is None:
+		return list(range(fixed_chunk, len(data), fixed_chunk)) + [len(data)] if data else []
+	ends = []
+	start = 0
+	while start < len(data):
+		limit = min(start + max_chunk, len(data))
+		end = limit
+		pos = start + min_chunk
+		while True:
+			pos = data.find(delimiter, pos, limit)
+			if pos < 0:
+				break
+			pos += len(delimiter)
+			if zlib.crc32(data[pos - boundary_window:pos]) % spacing == 0:
+				end = pos
+				break
+		ends.append(end)
+		start = end
+	return ends
+
+
+def read_sqlite(path: str):
+	"""
+	:param path: String path to a database that may be open in the bot
+	:return: The bytes of a consistent copy of it, made with sqlite's online backup API
+	"""
+	with tempfile.TemporaryDirectory() as folder:
+		copy_path = os.path.join(folder, 'copy.sqlite3')
+		source = sqlite3.connect(f'file:{pathname2url(os.path.abspath(path))}?mode=ro', uri=True)
+		copy = sqlite3.connect(copy_path)
+		try:
+			source.backup(copy)
+		finally:
+			copy.close()
+			source.close()
+		with open(copy_path, 'rb') as file_r:
+			return file_r.read()
+
+
+""" Backup Store """
+
+
+class BackupStore:
+	"""
+	Backups of a folder kept as chunks named by the sha256 of their content and compressed with zlib, so a chunk
+	shared by many backups or files is stored once. Each backup is a manifest listing every file's chunks. Files
+	whose size, modification time and inode match the last backup aren't read again, and the rest only store the
+	chunks the last backup didn't have. Backups and restores run on a worker thread, one at a time.
+	"""
+
+	def __init__(self, root: str, path: str, keep_last: int = 24, keep_daily: int = 14, max_bytes: int = None):
+		"""
+		:param root: String path to the folder backed up
+		:param path: String path to the folder backups are kept in, ideally outside root
+		:param keep_last: Newest backups always kept
+		:param keep_daily: Days that keep their last backup once it isn't one of the newest
+		:param max_bytes: Bytes of chunks the oldest backups are pruned down to, None for no limit
+		"""
+		self.root = root
+		self.path = path
+		self.objects = os.path.join(path, 'objects')
+		self.snapshots = os.path.join(path, 'snapshots')
+		self.keep_last = keep_last
+		self.keep_daily = keep_daily
+		self.max_bytes = max_bytes
+		self.lock = threading.Lock()
+		self.last = None  # manifest of the newest backup, loaded on the first backup
+		self.task = None
+		self.backups = 0
+		self.restores = 0
+		self.errors = 0
+		self.chunks_stored = 0
+		self.chunks_reused = 0
+		self.bytes_read = 0
+		self.bytes_stored = 0  # compressed bytes of new chunks written
+		self.stored_bytes = 0  # compressed bytes of every retained chunk, as of the last prune
+		self.pruned = 0
+		self.last_seconds = 0
+		self.last_read = 0
+
+	""" Files """
+
+	def _files(self):
+		"""
+		Yields the paths of the files to back up, relative to root
+		"""
+		backups = os.path.abspath(self.path)
+		for folder, dirs, files in os.walk(self.root):
+			dirs[:] = sorted(d for d in dirs if not d.startswith(staging_prefix)
+							 and os.path.abspath(os.path.join(folder, d)) != backups)
+			for name in sorted(files):
+				if not name.endswith(skipped_suffixes):
+					yield os.path.relpath(os.path.join(folder, name), self.root)
+
+	def _stamp(self, rel: str):
+		"""
+		:return: A [inode, mtime, size] list for the file, or None if it no longer exists
+		"""
+		try:
+			st = os.stat(os.path.join(self.root, rel))
+		except FileNotFoundError:
+			return None
+		return [st.st_ino, st.st_mtime_ns, st.st_size]
+
+	def _object(self, digest: str):
+		return os.path.join(self.objects, digest[:2], digest[2:])
+
+	def _store(self, data: bytes):
+		"""
+		Stores the chunks of a file that aren't stored yet
+		:return: The list of the chunks' hashes, in order
+		"""
+		digests = []
+		start = 0
+		for end in chunk_ends(data):
+			chunk = data[start:end]
+			start = end
+			digest = hashlib.sha256(chunk).hexdigest()
+			digests.append(digest)
+			path = self._object(digest)
+			if os.path.exists(path):
+				self.chunks_reused += 1
+				continue
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			packed = zlib.compress(chunk, compress_level)
+			with open(path + '.tmp', 'wb') as file_w:
+				file_w.write(packed)
+				file_w.flush()
+				os.fsync(file_w.fileno())
+			os.replace(path + '.tmp', path)
+			self.chunks_stored += 1
+			self.bytes_stored += len(packed)
+		return digests
+
+	def _capture(self, rel: str, previous: dict = None):
+		"""
+		:param rel: The file's path relative to root
+		:param previous: The file's entry in the last backup, reused if the file hasn't changed since
+		:return: The file's manifest entry, or None if it no longer exists
+		"""
+		stamp = self._stamp(rel)
+		if stamp is None:
+			return None
+		# a database in WAL mode changes without its own mtime moving, so it is always read
+		if previous is not None and previous['stamp'] == stamp and not rel.endswith(sqlite_suffix):
+			self.chunks_reused += len(previous['chunks'])
+			return previous
+		path = os.path.join(self.root, rel)
+		try:
+			if rel.endswith(sqlite_suffix):
+				data = read_sqlite(path)
+			else:
+				with open(path, 'rb') as file_r:
+					data = file_r.read()
+		except FileNotFoundError:
+			return None
+		self.bytes_read += len(data)
+		self.last_read += len(data)
+		return {'stamp': stamp, 'size': len(data), 'chunks': self._store(data)}
+
+	""" Backups """
+
+	def ids(self):
+		"""
+		:return: The ids of the retained backups, oldest first
+		"""
+		if not os.path.isdir(self.snapshots):
+			return []
+		return sorted(name[:-5] for name in os.listdir(self.snapshots) if name.endswith('.json'))
+
+	def manifest(self, backup_id: str):
+		"""
+		:return: The backup's manifest dict, or None if it can't be read
+		"""
+		return load_json_data(os.path.join(self.snapshots, backup_id + '.json'))
+
+	def summaries(self):
+		"""
+		:return: A list of (id, file count, bytes) tuples for the retained backups, newest first
+		"""
+		summaries = []
+		for backup_id in reversed(self.ids()):
+			manifest = self.manifest(backup_id)
+			if manifest is not None:
+				summaries.append((backup_id, len(manifest['files']), manifest['bytes']))
+		return summaries
+
+	def find(self, when: str):
+		"""
+		:param when: A backup id, an ISO date and time in UTC such as 2026-10-17T12:00 or unix seconds
+		:return: The id of the newest backup taken at or before then, or None if there isn't one
+		"""
+		when = when.strip()
+		try:
+			moment = datetime.strptime(when, snapshot_format).replace(tzinfo=timezone.utc)
+		except ValueError:
+			try:
+				moment = datetime.fromisoformat(when)
+				if moment.tzinfo is None:
+					moment = moment.replace(tzinfo=timezone.utc)
+			except ValueError:
+				try:
+					moment = datetime.fromtimestamp(float(when), timezone.utc)
+				except (ValueError, OverflowError, OSError):
+					return None
+		wanted = moment.strftime(snapshot_format)
+		found = [backup_id for backup_id in self.ids() if backup_id <= wanted]
+		return found[-1] if found else None
+
+	@metrics.timed('mcdb_io_seconds', op='backup')
+	def backup(self, rescan: bool = False):
+		"""
+		Takes a backup of root, only reading the files changed since the last one, then applies the retention policy
+		:param rescan: Read every file again, even those that look unchanged
+		:return: The new backup's id, or None if it failed
+		"""
+		with self.lock:
+			start = time.perf_counter()
+			self.last_read = 0
+			try:
+				if self.last is None:
+					ids = self.ids()
+					self.last = (self.manifest(ids[-1]) if ids else None) or {'files': {}}
+				previous = {} if rescan else self.last['files']
+				files = {}
+				pending = list(self._files())
+				for _ in range(capture_attempts):
+					for rel in pending:
+						entry = self._capture(rel, previous.get(rel))
+						if entry is not None:
+							files[rel] = entry
+						else:
+							files.pop(rel, None)
+					# files replaced while the others were read are read again, so a snapshot and its journal
+					# always come from the same side of a compaction
+					pending = [rel for rel, entry in files.items() if not rel.endswith(append_suffixes)
+							   and not rel.endswith(sqlite_suffix) and self._stamp(rel) != entry['stamp']]
+					if not pending:
+						break
+				backup_id = self._new_id()
+				manifest = {'id': backup_id, 'time': time.time(),
+							'bytes': sum(entry['size'] for entry in files.values()), 'files': files}
+				os.makedirs(self.snapshots, exist_ok=True)
+				if not dump_json_data(manifest, os.path.join(self.snapshots, backup_id + '.json')):
+					raise OSError('the manifest could not be written')
+				self.last = manifest
+				self.backups += 1
+				self._prune()
+			except (OSError, ValueError, sqlite3.Error) as e:
+				self.errors += 1
+				print(f'BackupStore ERROR: backup of {self.root} failed ({e})')
+				return None
+			finally:
+				self.last_seconds = time.perf_counter() - start
+			return backup_id
+
+	def _new_id(self):
+		"""
+		:return: An id for a backup taken now, a second later than the newest one if that was taken this second
+		"""
+		moment = time.time()
+		ids = self.ids()
+		backup_id = datetime.fromtimestamp(moment, timezone.utc).strftime(snapshot_format)
+		while ids and backup_id <= ids[-1]:
+			moment += 1
+			backup_id = datetime.fromtimestamp(moment, timezone.utc).strftime(snapshot_format)
+		return backup_id
+
+	def _prune(self):
+		"""
+		Drops the backups the retention policy doesn't keep and the chunks only they used, then the oldest kept
+		backups while the chunks take more than max_bytes. The newest backup is always kept.
+		:return: None
+		"""
+		ids = self.ids()
+		last_of_day = {}
+		for backup_id in ids:
+			last_of_day[backup_id[:8]] = backup_id
+		keep = set(ids[-self.keep_last:] if self.keep_last else ids[-1:])
+		keep.update(sorted(last_of_day.values())[-self.keep_daily:] if self.keep_daily else ())
+		for backup_id in ids:
+			if backup_id not in keep:
+				os.remove(os.path.join(self.snapshots, backup_id + '.json'))
+				self.pruned += 1
+
+		kept = sorted(keep)
+		chunks = {}
+		refs = Counter()
+		for backup_id in kept:
+			manifest = self.manifest(backup_id)
+			if manifest is None:
+				raise ValueError(f'backup {backup_id} can not be read')
+			chunks[backup_id] = {digest for entry in manifest['files'].values() for digest in entry['chunks']}
+			refs.update(chunks[backup_id])
+		sizes = {}
+		if os.path.isdir(self.objects):
+			for folder in os.listdir(self.objects):
+				for name in os.listdir(os.path.join(self.objects, folder)):
+					path = os.path.join(self.objects, folder, name)
+					if folder + name in refs:
+						sizes[folder + name] = os.path.getsize(path)
+					else:
+						os.remove(path)  # unused, or a .tmp left by a backup that crashed
+		total = sum(sizes.values())
+		while self.max_bytes is not None and total > self.max_bytes and len(kept) > 1:
+			oldest = kept.pop(0)
+			os.remove(os.path.join(self.snapshots, oldest + '.json'))
+			self.pruned += 1
+			for digest in chunks.pop(oldest):
+				refs[digest] -= 1
+				if not refs[digest] and digest in sizes:
+					os.remove(self._object(digest))
+					total -= sizes.pop(digest)
+		self.stored_bytes = total
+
+	""" Restores """
+
+	def _chunk(self, digest: str):
+		"""
+		:return: The chunk's bytes
+		:raises ValueError: if the chunk is missing or doesn't match its hash
+		"""
+		try:
+			with open(self._object(digest), 'rb') as file_r:
+				chunk = zlib.decompress(file_r.read())
+		except (FileNotFoundError, zlib.error) as e:
+			raise ValueError(f'chunk {digest} is missing or damaged ({e})')
+		if hashlib.sha256(chunk).hexdigest() != digest:
+			raise ValueError(f'chunk {digest} does not match its hash')
+		return chunk
+
+	@metrics.timed('mcdb_io_seconds', op='restore')
+	def restore(self, backup_id: str, folder: str, select=None):
+		"""
+		Writes the files of a backup into a folder, checking every chunk against its hash. Each file is written to a
+		temporary file that replaces it once complete.
+		:param backup_id: The backup's id
+		:param folder: String path to the folder to write the files to
+		:param select: A callable taking a file's path relative to root, only files it returns True for are written
+		:return: The list of relative paths written
+		:raises ValueError: if the backup can't be read or a chunk is damaged
+		"""
+		with self.lock:
+			manifest = self.manifest(backup_id)
+			if manifest is None:
+				raise ValueError(f'backup {backup_id} can not be read')
+			written = []
+			for rel, entry in manifest['files'].items():
+				if select is not None and not select(rel):
+					continue
+				path = os.path.join(folder, rel)
+				os.makedirs(os.path.dirname(path), exist_ok=True)
+				with open(path + '.tmp', 'wb') as file_w:
+					for digest in entry['chunks']:
+						file_w.write(self._chunk(digest))
+					file_w.flush()
+					os.fsync(file_w.fileno())
+				replace_file(path + '.tmp', path)
+				written.append(rel)
+			self.restores += 1
+			return written
+
+	""" Background Task """
+
+	def start(self, loop: asyncio.AbstractEventLoop, interval: float):
+		"""
+		Starts taking a backup every interval secs on the loop's default executor, if it isn't already
+		:param loop: The event loop the bot runs on
+		:param interval: Secs between backups
+		:return: None
+		"""
+		if self.task is None or self.task.done():
+			self.task = loop.create_task(self.run(loop, interval))
+
+	async def run(self, loop: asyncio.AbstractEventLoop, interval: float):
+		while True:
+			await asyncio.sleep(interval)
+			await loop.run_in_executor(None, self.backup)
+
+	def stats(self):
+		"""
+		:return: A dict of backup, restore, chunk and byte counts, the retained chunk bytes and the last backup's
+		read throughput
+		"""
+		return {'backups': self.backups, 'restores': self.restores, 'errors': self.errors, 'pruned': self.pruned,
+				'chunks_stored': self.chunks_stored, 'chunks_reused': self.chunks_reused,
+				'bytes_read': self.bytes_read, 'bytes_stored': self.bytes_stored, 'stored_bytes': self.stored_bytes,
+				'last_seconds': self.last_seconds,
+				'last_read_bytes_per_sec': self.last_read / self.last_seconds if self.last_seconds else 0}
+
+
+if __name__ == '__main__':
+	if len(sys.argv) == 3 and sys.argv[1] == 'list':
+		for backup_id, files, size in BackupStore('.', sys.argv[2]).summaries():
+			print(f'{backup_id}  {files} files  {size:,} bytes')
+	elif len(sys.argv) == 5 and sys.argv[1] == 'restore':
+		backups = BackupStore('.', sys.argv[2])
+		backup_id = backups.find(sys.argv[3])
+		if backup_id is None:
+			print(f'No backup was taken at or before {sys.argv[3]}')
+			sys.exit(1)
+		print(f'Restored {len(backups.restore(backup_id, sys.argv[4]))} files from backup {backup_id}')
+	else:
+		print('usage: python backup.py list <backups folder>\n'
+			  '       python backup.py restore <backups folder> <timestamp> <folder>')
+		sys.exit(2)
@@ -0,0 +1,425 @@
+"""
+Title: MCDB Benchmarks
+Author: Billy Cobb
+Desc: Times the data layer behind the bot's commands on synthetic datasets, without connecting to Discord or a
+Minecraft server. Run with python bench.py [--sizes 1000 100000 1000000] [--out results.json]
+[--compare old_results.json] [--pool process], a compared run exits with status 1 if an operation got slower than
+the threshold.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from types import SimpleNamespace
+
+import mcdb
+from backup import BackupStore
+from backends import SQLiteBackend
+from columnar import ColumnarBackend
+from cmdlog import CommandLog
+from guilds import GuildData, ServerEntry
+from presence import PresenceHistory
+from status import StatusPoller
+from store import DataStore
+from workers import WorkerPool, pool_kinds
+
+
+""" Synthetic Data """
+
+
+words = ['zombie', 'skeleton', 'spider', 'blaze', 'spawner', 'village', 'farm', 'portal', 'fortress', 'bastion',
+		 'temple', 'monument', 'stronghold', 'mansion', 'outpost', 'mine', 'base', 'tower', 'iron', 'gold', 'slime',
+		 'witch', 'hut', 'ruin', 'shipwreck', 'igloo', 'mesa', 'ocean', 'river', 'end', 'city', 'storage']
+dimension_weights = {'overworld': 70, 'nether': 25, 'end': 5}
+log_start = datetime(2021, 1, 1).timestamp()  # the synthetic CommandLog.json starts here, one entry a second
+warmup_ops = 5  # untimed calls made before each operation is timed
+
+
+def location_name(rng: random.Random, i: int):
+	return f'{rng.choice(words)} {rng.choice(words)} {i}'
+
+
+def generate(folder: str, size: int, seed: int):
+	"""
+	Writes a Locations.json, Members.json and legacy CommandLog.json with size entries each, streaming the json so
+	the million entry files don't need building in memory first. Existing files are reused.
+	:param folder: Directory to write the files to
+	:param size: Number of entries in each file
+	:param seed: Seed for the random generator, the same seed always gives the same files
+	:return: A paths dict for the files
+	"""
+	paths = {'locations': os.path.join(folder, 'Locations.json'), 'members': os.path.join(folder, 'Members.json'),
+			 'legacy_log': os.path.join(folder, 'CommandLog.json')}
+	if all(os.path.exists(path) for path in paths.values()):
+		return paths
+	os.makedirs(folder, exist_ok=True)
+	rng = random.Random(seed)
+	dims, weights = list(dimension_weights), list(dimension_weights.values())
+
+	def write(path, entries):
+		with open(path + '.tmp', 'w') as file_w:
+			file_w.write('{\n')
+			for i, (key, value) in enumerate(entries):
+				file_w.write(f'{"," if i else ""}{json.dumps(key)}: {json.dumps(value)}\n')
+			file_w.write('}\n')
+		os.replace(path + '.tmp', path)  # a run stopped part way doesn't leave a file that looks finished
+
+	write(paths['locations'], ((location_name(rng, i), {
+		'Dimension': rng.choices(dims, weights)[0], 'X': rng.randint(-30000, 30000), 'Y': rng.randint(5, 250),
+		'Z': rng.randint(-30000, 30000)}) for i in range(size)))
+	write(paths['members'], ((f'player{i}', {
+		'LastSeen': datetime.fromtimestamp(log_start + rng.randint(0, size)).strftime("%m/%d/%Y %H:%M:%S"),
+		'IsAdmin': rng.random() < 0.05}) for i in range(size)))
+	write(paths['legacy_log'], ((datetime.fromtimestamp(log_start + i).strftime("%m/%d/%Y %H:%M:%S"), {
+		'Command': f"find ('{rng.choice(words)}',)", 'UserID': rng.randint(1, 500),
+		'UserName': f'user{rng.randint(1, 500)}#0001'}) for i in range(size)))
+	return paths
+
+
+""" Fakes """
+
+
+class FakeAuthor(SimpleNamespace):
+	def __str__(self):
+		return f'{self.name}#0001'
+
+
+def fake_context(user_id: int, guild_id: int = None):
+	"""
+	:return: A stand-in for a discord Context with the attributes the helpers read
+	"""
+	author = FakeAuthor(id=user_id, name=f'user{user_id}')
+	guild = SimpleNamespace(id=guild_id) if guild_id is not None else None
+	return SimpleNamespace(author=author, guild=guild, message=SimpleNamespace(author=author))
+
+
+def fake_status(names: list, description: str = 'A benchmark server'):
+	"""
+	:return: A stand-in for an mcstatus PingResponse with the attributes the helpers read
+	"""
+	raw = {'description': {'text': description},
+		   'players': {'online': len(names), 'max': 100, 'sample': [{'name': name, 'id': ''} for name in names]}}
+	return SimpleNamespace(raw=raw, players=SimpleNamespace(online=len(names), max=100), latency=1.0)
+
+
+""" Timing """
+
+
+def percentile(samples: list, fraction: float):
+	ordered = sorted(samples)
+	return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def measure(fn, args, ops: int, max_secs: float, mem_ops: int):
+	"""
+	Calls fn once per argument, timing each call, until ops calls are made or max_secs have passed. A few more calls
+	are then made under tracemalloc for their peak allocation, which is kept out of the timings since it slows them.
+	:param fn: The operation
+	:param args: An iterator of arguments, one per call
+	:param ops: Most calls to time
+	:param max_secs: Longest time to spend timing calls, at least 3 are always made
+	:param mem_ops: Calls to make under tracemalloc
+	:return: A result dict of call count, p50 and p99 latency in microsecs, calls per sec and peak KB allocated
+	"""
+	for _, arg in zip(range(warmup_ops), args):  # fills caches and lazily built state before the timed calls
+		fn(arg)
+	gc.collect()
+	samples = []
+	deadline = time.perf_counter() + max_secs
+	for arg in args:
+		start = time.perf_counter_ns()
+		fn(arg)
+		samples.append(time.perf_counter_ns() - start)
+		if len(samples) >= ops or (len(samples) >= 3 and time.perf_counter() > deadline):
+			break
+	peak = 0
+	if mem_ops:
+		gc.collect()
+		tracemalloc.start()
+		base = tracemalloc.get_traced_memory()[0]
+		for _, arg in zip(range(mem_ops), args):
+			fn(arg)
+		peak = tracemalloc.get_traced_memory()[1] - base
+		tracemalloc.stop()
+	return {'n': len(samples), 'p50_us': percentile(samples, 0.5) / 1000, 'p99_us': percentile(samples, 0.99) / 1000,
+			'ops_per_sec': len(samples) / (sum(samples) / 1e9), 'peak_kb': peak / 1024}
+
+
+def measure_once(fn, count: int, traced: bool = True):
+	"""
+	Times a single bulk operation over count entries, such as loading a dataset. It is run a second time first under
+	tracemalloc for its peak allocation, so fn must be safe to repeat.
+	:param fn: The operation
+	:param count: Number of entries the operation covers
+	:param traced: False to skip the tracemalloc run
+	:return: A result dict in the same form as measure's, with entries per sec as the throughput
+	"""
+	peak = 0
+	if traced:
+		gc.collect()
+		tracemalloc.start()
+		fn()
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+	gc.collect()
+	start = time.perf_counter_ns()
+	fn()
+	elapsed = time.perf_counter_ns() - start
+	return {'n': 1, 'p50_us': elapsed / 1000, 'p99_us': elapsed / 1000, 'ops_per_sec': count / (elapsed / 1e9),
+			'peak_kb': peak / 1024}
+
+
+""" Benchmarks """
+
+
+def bench_size(size: int, args: argparse.Namespace):
+	"""
+	Runs every operation against a dataset of the given size
+	:return: A dict of operation name -> result dict
+	"""
+	data = generate(os.path.join(args.data, f'{size}-{args.seed}'), size, args.seed)
+	work = tempfile.mkdtemp(prefix='mcdb-bench-')
+	try:
+		paths = {'backend': args.backend, 'locations': os.path.join(work, 'Locations.json'),
+				 'members': os.path.join(work, 'Members.json'), 'log': os.path.join(work, 'CommandLog.jsonl'),
+				 'legacy_log': data['legacy_log']}
+		shutil.copy(data['locations'], paths['locations'])
+		shutil.copy(data['members'], paths['members'])
+		rng = random.Random(args.seed)
+		results = {}
+		backend = None
+
+		def load(indexed: bool = True):
+			nonlocal backend, guild
+			if guild is not None:
+				guild.store.close()
+			if backend is not None:
+				backend.close()
+			if args.backend == 'sqlite':
+				# migrated once, a repeated load reads the database the first one wrote
+				backend = SQLiteBackend(os.path.join(work, 'mcdb.sqlite3'))
+				backend.migrate(paths)
+			elif args.backend == 'columnar':
+				backend = ColumnarBackend(os.path.join(work, 'Locations.mcdb'), paths['members'],
+										  journaled=args.journal)
+				backend.migrate(paths)
+			guild = GuildData(mcdb.home_key, DataStore(paths, backend=backend, journaled=args.journal), backend)
+			if indexed:
+				mcdb.attach_indexes(guild)
+			guild.store.load()
+
+		guild = None
+		results['load'] = measure_once(load, size, traced=args.mem_ops > 0)
+		# the migrated table alone, without building the indexes the commands query from it as every guild load does
+		results['load_table'] = measure_once(lambda: load(indexed=False), size, traced=args.mem_ops > 0)
+		load()
+		store, locs = guild.store, guild.store.locations
+		names = list(locs)
+		member_names = list(store.members)
+
+		# the command log starts empty and update_log only appends, the read goes through the legacy log too
+		mcdb.command_log = CommandLog(paths['log'], legacy_path=paths['legacy_log'])
+		ctx = fake_context(1234, guild_id=None)
+
+		total = warmup_ops + args.ops + args.mem_ops
+		added = []
+
+		def add(loc):
+			name, dim, x, y, z = loc
+			if mcdb.parse_dimension(dim) is not None:
+				store.add_location(name, mcdb.parse_dimension(dim), int(x), int(y), int(z))
+				added.append(name)
+
+		def remove(name):
+			store.remove_location(name)
+
+		def find(query):
+			total_found, found = mcdb.cached_query(guild, ('find', query, 0),
+												   lambda: guild.search_index.search(query, limit=mcdb.search_chunk))
+			for kind, loc in found[:10]:  # the first page, the rest are formatted as the user pages
+				mcdb.format_location(loc, locs[loc])
+
+		def pick(dim):
+			mcdb.format_location(*mcdb.random_location(guild, dim))
+
+		def near(point):
+			dim, x, y, z = point
+			nearest = mcdb.cached_query(guild, ('near', dim, x, y, z, 5, False),
+										lambda: guild.spatial_index.nearest(dim, x, y, z, k=5))
+			for dist, loc, _ in nearest:
+				mcdb.format_location(loc, locs[loc], dist)
+
+		# the first query after a change, answered where the bot's worker pool answers it
+		loop = asyncio.new_event_loop()
+		mcdb.worker_pool = WorkerPool(args.pool, min_locations=mcdb.offload_min_locations)
+		mcdb.worker_pool.start(loop)
+		changes = iter(range(total * 2))
+
+		def near_after_add(point):
+			dim, x, y, z = point
+			store.add_location(f'query bench {next(changes)}', dim, x, y, z)
+			loop.run_until_complete(mcdb.run_query(guild, ('near', dim, x, y, z, 5, False), 'nearest', dim, x, y, z,
+												   k=5))
+
+		def find_after_add(query):
+			store.add_location(f'query bench {next(changes)}', 'overworld', 0, 64, 0)
+			loop.run_until_complete(mcdb.run_query(guild, ('find', query, 0), 'search', query,
+												   limit=mcdb.search_chunk, offset=0))
+
+		def log(command):
+			mcdb.update_log(command, ctx)
+
+		server = ServerEntry('bench.example.com', StatusPoller('bench.example.com'), store.files['members'],
+							 PresenceHistory(os.path.join(work, 'Presence.jsonl')))
+
+		def members(online):
+			mcdb.update_members(server, fake_status(online))
+
+		def member_info(online):
+			info = mcdb.updated_member_info(server, online)
+			for _, line in zip(range(10), info[2]):  # the first page of member lines
+				pass
+
+		def query():
+			name = rng.choice(names)
+			if rng.random() < 0.8:  # most searches are part of a name, the rest misspell a word in it
+				start = rng.randrange(max(len(name) - 4, 1))
+				return name[start:start + rng.randint(4, 8)]
+			word = rng.choice(name.split())
+			i = rng.randrange(len(word))
+			return word[:i] + rng.choice('aeiou') + word[i + 1:]
+
+		def online_sample():
+			return rng.sample(member_names, min(len(member_names), 12))
+
+		dims = list(dimension_weights)
+		ops = [
+			('add', add, ((f'bench {i} {rng.choice(words)}', rng.choice('one'), rng.randint(-30000, 30000),
+						   rng.randint(5, 250), rng.randint(-30000, 30000)) for i in range(total))),
+			('find', find, (query() for _ in range(total))),
+			('random', pick, (rng.choice([None, *dims]) for _ in range(total))),
+			('near', near, ((rng.choice(dims), rng.randint(-30000, 30000), 64, rng.randint(-30000, 30000))
+							for _ in range(total))),
+			('near_after_add', near_after_add, ((rng.choice(dims), rng.randint(-30000, 30000), 64,
+												 rng.randint(-30000, 30000)) for _ in range(total))),
+			('find_after_add', find_after_add, (query() for _ in range(total))),
+			('update_log', log, (f"find ('{rng.choice(words)}',)" for _ in range(total))),
+			('update_members', members, (online_sample() for _ in range(total))),
+			('updated_member_info', member_info, (online_sample() for _ in range(total))),
+		]
+		for name, fn, op_args in ops:
+			results[name] = measure(fn, iter(op_args), args.ops, args.max_secs, args.mem_ops)
+			if name == 'add':
+				results['remove'] = measure(remove, iter(list(added)), args.ops, args.max_secs, args.mem_ops)
+
+		mcdb.worker_pool.close()
+		loop.close()
+		mcdb.command_log.flush()
+		results['log_read'] = measure_once(lambda: sum(1 for _ in mcdb.command_log.read()), size,
+										   traced=args.mem_ops > 0)
+		results['close'] = measure_once(store.close, size, traced=False)  # compacts whatever was journaled
+
+		# the legacy log is copied in so backups cover locations, members and the command log, 3 * size entries
+		shutil.copy(data['legacy_log'], os.path.join(work, 'CommandLog.json'))
+		backups = BackupStore(work, os.path.join(work, 'backups'))
+
+		def backup_full():
+			shutil.rmtree(backups.path, ignore_errors=True)
+			backups.last = None
+			backups.backup()
+
+		results['backup_full'] = measure_once(backup_full, 3 * size, traced=False)
+		for i in range(100):  # a few changes since the full backup, compacted so Locations.json is rewritten
+			store.add_location(f'backup bench {i}', 'overworld', 0, 64, 0)
+		store.close()
+		# every file is read again but only the chunks holding the changes are stored
+		results['backup_incremental'] = measure_once(lambda: backups.backup(rescan=True), 3 * size, traced=False)
+		backup_id = backups.ids()[-1]
+		results['restore'] = measure_once(lambda: backups.restore(backup_id, os.path.join(work, 'restored')),
+										  3 * size, traced=False)
+		if backend is not None:
+			backend.close()
+		return results
+	finally:
+		shutil.rmtree(work, ignore_errors=True)
+
+
+""" Reporting """
+
+
+def print_results(size: int, results: dict, previous: dict = None, threshold: float = 1.25):
+	"""
+	Prints a table of one dataset's results, with the change in p50 and p99 against a previous run if given
+	:return: A list of the operations slower than threshold times their previous p50 or p99
+	"""
+	print(f'\n{size:,} entries')
+	print(f'{"operation":<20}{"n":>7}{"p50 us":>12}{"p99 us":>12}{"ops/s":>14}{"peak KB":>12}'
+		  + (f'{"p50 x":>9}{"p99 x":>9}' if previous else ''))
+	regressions = []
+	for name, result in results.items():
+		line = f'{name:<20}{result["n"]:>7}{result["p50_us"]:>12.1f}{result["p99_us"]:>12.1f}' \
+			   f'{result["ops_per_sec"]:>14,.0f}{result["peak_kb"]:>12.1f}'
+		old = (previous or {}).get(name)
+		if old:
+			p50, p99 = result['p50_us'] / old['p50_us'], result['p99_us'] / old['p99_us']
+			line += f'{p50:>9.2f}{p99:>9.2f}'
+			if p50 > threshold or p99 > threshold:
+				regressions.append(f'{size}/{name}')
+				line += '  REGRESSION'
+		print(line)
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Benchmarks the MCDB data layer on synthetic datasets')
+	parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+	parser.add_argument('--ops', type=int, default=1000, help='most calls timed per operation')
+	parser.add_argument('--max-secs', type=float, default=10, help='longest time spent timing one operation')
+	parser.add_argument('--mem-ops', type=int, default=10,
+						help='calls per operation made under tracemalloc, 0 skips the memory measurements')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--backend', choices=['json', 'sqlite', 'columnar'], default='json')
+	parser.add_argument('--journal', action='store_true', help='journal changes instead of rewriting the files')
+	parser.add_argument('--pool', choices=pool_kinds, default=mcdb.worker_pool_kind,
+						help='worker pool kind answering the queries timed after an add')
+	parser.add_argument('--data', default=os.path.join(tempfile.gettempdir(), 'mcdb-bench'),
+						help='directory the generated datasets are kept in between runs')
+	parser.add_argument('--out', help='write the results to this json file')
+	parser.add_argument('--compare', help='a results json file from an earlier run to compare against')
+	parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio reported as a regression')
+	args = parser.parse_args()
+
+	previous = {}
+	if args.compare:
+		with open(args.compare, 'r') as file_r:
+			previous = json.load(file_r)['results']
+	meta = {'date': datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+			'platform': platform.platform(), 'machine': platform.machine(), 'seed': args.seed,
+			'backend': args.backend, 'journal': args.journal, 'pool': args.pool, 'ops': args.ops}
+	print(' '.join(f'{key}={value}' for key, value in meta.items()))
+
+	results, regressions = {}, []
+	for size in args.sizes:
+		results[str(size)] = bench_size(size, args)
+		regressions += print_results(size, results[str(size)], previous.get(str(size)), args.threshold)
+
+	if args.out:
+		with open(args.out, 'w') as file_w:
+			json.dump({'meta': meta, 'results': results}, file_w, indent=4)
+	if regressions:
+		print(f'\n{len(regressions)} regressions: {", ".join(regressions)}')
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
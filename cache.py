@@ -0,0 +1,99 @@
+"""
+Title: MCDB Query Cache
+Author: Billy Cobb
+Desc: Keeps recent find/near/within results so repeated queries skip the indexes until the locations change
+"""
+
+import time
+from collections import OrderedDict
+
+
+missing = object()  # returned by get() for a result that isn't cached
+
+
+""" Query Cache """
+
+
+class QueryCache:
+	"""
+	An LRU cache of query results with a time to live. Every result is stored with the store generation it was
+	computed at, and the whole cache is dropped the first time it is used at a newer generation, so results never
+	outlive an add, remove or reload.
+	"""
+
+	def __init__(self, max_entries: int = 256, ttl: float = 300):
+		"""
+		:param max_entries: Most results kept, the least recently used is evicted past this
+		:param ttl: Secs a result is kept even if the locations don't change
+		"""
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.entries = OrderedDict()  # key -> (expiry monotonic time, result), least recently used first
+		self.generation = None
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.expirations = 0
+		self.invalidations = 0
+
+	def _check_generation(self, generation: int):
+		if generation != self.generation:
+			if self.entries:
+				self.invalidations += 1
+				self.entries.clear()
+			self.generation = generation
+
+	def get(self, key: tuple, generation: int):
+		"""
+		:param key: The normalized query arguments, starting with the command name
+		:param generation: The store's current generation
+		:return: The cached result, or missing if it isn't cached for this generation
+		"""
+		self._check_generation(generation)
+		entry = self.entries.get(key)
+		if entry is not None:
+			if entry[0] > time.monotonic():
+				self.hits += 1
+				self.entries.move_to_end(key)
+				return entry[1]
+			self.expirations += 1
+			del self.entries[key]
+		self.misses += 1
+		return missing
+
+	def put(self, key: tuple, generation: int, result):
+		"""
+		Caches a result, results computed at a generation the cache has already moved past are dropped
+		:param key: The normalized query arguments, starting with the command name
+		:param generation: The store generation the result was computed at
+		:param result: The result
+		:return: None
+		"""
+		if generation != self.generation:
+			return
+		self.entries[key] = (time.monotonic() + self.ttl, result)
+		self.entries.move_to_end(key)
+		if len(self.entries) > self.max_entries:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+
+	def lookup(self, key: tuple, generation: int, compute):
+		"""
+		Returns a cached result, computing and caching it on a miss
+		:param key: The normalized query arguments, starting with the command name
+		:param generation: The store's current generation
+		:param compute: A callable returning the result
+		:return: The result
+		"""
+		result = self.get(key, generation)
+		if result is missing:
+			result = compute()
+			self.put(key, generation, result)
+		return result
+
+	def stats(self):
+		"""
+		:return: A dict of cached result, hit, miss, eviction, expiration and invalidation counts
+		"""
+		return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+				'expirations': self.expirations, 'invalidations': self.invalidations}
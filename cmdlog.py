@@ -0,0 +1,229 @@
+"""
+Title: MCDB Command Log
+Author: Billy Cobb
+Desc: Append-only json-lines command log with rotation, optional gzip of old segments and buffered async flushing
+"""
+
+import asyncio
+import glob
+import gzip
+import json
+import os
+import shutil
+import time
+from datetime import datetime
+
+from metrics import metrics
+
+
+""" Command Log """
+
+
+class CommandLog:
+	"""
+	Commands are buffered in memory by append() and written as one json object per line by a background task,
+	so logging a command never waits on disk. The active segment is rotated once it grows past max_bytes or
+	gets older than max_age, and rotated segments can be gzipped.
+	"""
+
+	def __init__(self, path: str, max_bytes: int = 8 * 1024 * 1024, max_age: float = None, compress: bool = True,
+				 flush_interval: float = 2.0, legacy_path: str = None):
+		"""
+		:param path: String path to the active .jsonl segment
+		:param max_bytes: Size in bytes the active segment is rotated at
+		:param max_age: Age in seconds the active segment is rotated at, None to rotate on size only
+		:param compress: gzip segments once they are rotated
+		:param flush_interval: Seconds between background flushes
+		:param legacy_path: Path to an old CommandLog.json dict log to read before the segments
+		"""
+		self.path = path
+		self.max_bytes = max_bytes
+		self.max_age = max_age
+		self.compress = compress
+		self.flush_interval = flush_interval
+		self.legacy_path = legacy_path
+		self.buffer = []
+		self.opened = None  # time of the first entry in the active segment
+		self.task = None
+		self.lock = None  # made by the first flush_async, on 3.7 a Lock binds to the loop of the thread creating it
+		self.appended = 0
+		self.written = 0
+		self.rotations = 0
+		self.listeners = []  # callables run with every entry as it is appended
+
+	def append(self, entry: dict):
+		"""
+		Queues an entry to be written, stamping it with the current time if it has none
+		:param entry: A json serializable dict describing the command
+		:return: None
+		"""
+		entry.setdefault("Time", time.time())
+		self.buffer.append(entry)
+		self.appended += 1
+		for listener in self.listeners:
+			listener(entry)
+
+	def start(self, loop: asyncio.AbstractEventLoop):
+		"""
+		Starts the background flush task if it isn't already running
+		:param loop: The event loop the bot runs on
+		:return: None
+		"""
+		if self.task is None or self.task.done():
+			self.task = loop.create_task(self.run())
+
+	async def run(self):
+		"""
+		Flushes the buffer every flush_interval seconds on a worker thread
+		:return: None
+		"""
+		while True:
+			await asyncio.sleep(self.flush_interval)
+			await self.flush_async()
+
+	async def flush_async(self):
+		"""
+		Writes everything buffered so far without blocking the event loop
+		:return: None
+		"""
+		if self.lock is None:
+			self.lock = asyncio.Lock()
+		async with self.lock:
+			entries, self.buffer = self.buffer, []
+			if entries:
+				await asyncio.get_running_loop().run_in_executor(None, self._write, entries)
+
+	def flush(self):
+		"""
+		Writes everything buffered so far on the calling thread, used at shutdown
+		:return: None
+		"""
+		entries, self.buffer = self.buffer, []
+		if entries:
+			self._write(entries)
+
+	@metrics.timed('mcdb_io_seconds', op='log_write')
+	def _write(self, entries: list):
+		"""
+		Appends entries to the active segment, rotating it first if it is due
+		:param entries: The buffered entries
+		:return: None
+		"""
+		if self.opened is None:
+			self.opened = self._first_time()
+		if self._due():
+			self.rotate()
+		lines = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries)
+		with open(self.path, 'a') as file_a:
+			file_a.write(lines)
+		if self.opened is None:
+			self.opened = entries[0]["Time"]
+		self.written += len(entries)
+
+	def _first_time(self):
+		"""
+		:return: The time of the first entry in the active segment, or None if it is empty or missing
+		"""
+		try:
+			with open(self.path, 'r') as file_r:
+				return json.loads(file_r.readline())["Time"]
+		except (FileNotFoundError, ValueError, KeyError):
+			return None
+
+	def _due(self):
+		"""
+		:return: True if the active segment should be rotated before writing to it
+		"""
+		try:
+			size = os.path.getsize(self.path)
+		except FileNotFoundError:
+			return False
+		if size >= self.max_bytes:
+			return True
+		return self.max_age is not None and self.opened is not None and time.time() - self.opened >= self.max_age
+
+	def rotate(self):
+		"""
+		Renames the active segment to a timestamped segment and gzips it if compression is on
+		:return: None
+		"""
+		if not os.path.exists(self.path):
+			return
+		base, ext = os.path.splitext(self.path)
+		stamp = datetime.fromtimestamp(self.opened or time.time()).strftime("%Y%m%d-%H%M%S")
+		target = f'{base}.{stamp}{ext}'
+		n = 1
+		while os.path.exists(target) or os.path.exists(target + '.gz'):
+			target = f'{base}.{stamp}-{n}{ext}'
+			n += 1
+		os.replace(self.path, target)
+		if self.compress:
+			with open(target, 'rb') as file_r, gzip.open(target + '.gz', 'wb') as file_gz:
+				shutil.copyfileobj(file_r, file_gz)
+			os.remove(target)
+		self.opened = None
+		self.rotations += 1
+
+	def segments(self):
+		"""
+		:return: Paths of the rotated segments followed by the active segment, oldest first
+		"""
+		base, ext = os.path.splitext(self.path)
+		rotated = glob.glob(f'{glob.escape(base)}.*{ext}') + glob.glob(f'{glob.escape(base)}.*{ext}.gz')
+		rotated = [path for path in rotated if path != self.path]
+
+		def order(path):
+			# CommandLog.<date>-<time>[-<n>].jsonl[.gz]
+			parts = path[len(base) + 1:].split('.')[0].split('-')
+			return parts[:2], int(parts[2]) if len(parts) > 2 and parts[2].isdigit() else 0
+		rotated.sort(key=order)
+		if os.path.exists(self.path):
+			rotated.append(self.path)
+		return rotated
+
+	def read(self, since: float = None):
+		"""
+		Streams every written entry, oldest first, across the legacy log and all segments
+		:param since: Only yield entries at or after this epoch time
+		:return: A generator of entry dicts
+		"""
+		if self.legacy_path is not None:
+			yield from read_legacy_log(self.legacy_path, since)
+		for path in self.segments():
+			opener = gzip.open if path.endswith('.gz') else open
+			with opener(path, 'rt') as file_r:
+				for line in file_r:
+					try:
+						entry = json.loads(line)
+					except ValueError:
+						continue  # a partially written last line
+					if since is None or entry.get("Time", 0) >= since:
+						yield entry
+
+	def stats(self):
+		"""
+		:return: A dict of appended, written, buffered and rotation counts
+		"""
+		return {'appended': self.appended, 'written': self.written, 'buffered': len(self.buffer),
+				'rotations': self.rotations}
+
+
+def read_legacy_log(path: str, since: float = None):
+	"""
+	Streams the entries of an old CommandLog.json, which was a dict keyed by "%m/%d/%Y %H:%M:%S" timestamps
+	:param path: String path to the old log
+	:param since: Only yield entries at or after this epoch time
+	:return: A generator of entry dicts in the json-lines format
+	"""
+	try:
+		with open(path, 'r') as file_r:
+			log = json.load(file_r)
+	except (FileNotFoundError, ValueError):
+		return
+	for stamp, entry in log.items():
+		try:
+			entry_time = datetime.strptime(stamp, "%m/%d/%Y %H:%M:%S").timestamp()
+		except ValueError:
+			continue
+		if since is None or entry_time >= since:
+			yield {"Time": entry_time, **entry}
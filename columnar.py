@@ -0,0 +1,346 @@
+"""
+Title: MCDB Columnar Store
+Author: Billy Cobb
+Desc: Locations kept as parallel typed arrays with one name table, saved as a binary snapshot that is memory-mapped
+when it is opened. Run python columnar.py import|export <from> <to> to convert between Locations.json and a snapshot.
+"""
+
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from collections.abc import MutableMapping
+
+from journal import Journal, journal_path
+from store import ResidentFile, load_json_data, dump_json_data, replace_file
+
+
+""" Columnar Vars """
+
+
+dimension_names = ['overworld', 'nether', 'end']  # a location's dimension is stored as its index in this list
+dimension_codes = {name: code for code, name in enumerate(dimension_names)}
+snapshot_magic = b'MCDBLOC2'
+snapshot_header = struct.Struct('<8sQQQ')  # magic, location count, name table bytes, tag table bytes
+legacy_magic = b'MCDBLOC1'
+legacy_header = struct.Struct('<8sQQ')  # snapshots written before tags, read but no longer written
+coord_type = 'i'  # 32 bit signed, Minecraft coordinates stay inside +-30 million
+
+
+""" Location Table """
+
+
+class LocationTable(MutableMapping):
+	"""
+	The stored locations as columns: x, y and z in 32 bit int arrays, the dimension as a one byte code and the names
+	in a list whose positions are the row numbers. Most locations have no tags, so tags are kept in a dict of only
+	the tagged names. It reads like the dict of {"Dimension", "X", "Y", "Z"} dicts the json store keeps, building
+	each location dict as it is looked up. Opened from a snapshot the columns are views of the mapped file until the
+	first change copies them into arrays.
+	"""
+
+	def __init__(self):
+		self.names = []
+		self.ids = {}  # name -> row
+		self.xs = array(coord_type)
+		self.ys = array(coord_type)
+		self.zs = array(coord_type)
+		self.dims = array('B')
+		self.tags = {}  # name -> list of tags, only for tagged locations
+		self.mapped = None  # the mmap the columns are views of, None once they are arrays
+		self.views = []
+
+	@classmethod
+	def from_dict(cls, locations: dict):
+		"""
+		:param locations: A Locations.json style dict
+		:return: A LocationTable holding the same locations
+		"""
+		table = cls()
+		for name, loc in locations.items():
+			table[name] = loc
+		return table
+
+	@classmethod
+	def from_snapshot(cls, path: str):
+		"""
+		Maps a snapshot file and reads its name table, the coordinate columns are only paged in as they are read
+		:param path: String path to the snapshot
+		:return: The LocationTable
+		:raises ValueError: if the file isn't a complete snapshot
+		"""
+		with open(path, 'rb') as file_r:
+			size = os.fstat(file_r.fileno()).st_size
+			if size < legacy_header.size:
+				raise ValueError('file is too short for a snapshot header')
+			mapped = mmap.mmap(file_r.fileno(), 0, access=mmap.ACCESS_READ)
+		header = legacy_header if mapped[:len(legacy_magic)] == legacy_magic else snapshot_header
+		magic, count, names_size, *tags_size = header.unpack_from(mapped) if size >= header.size else (b'', 0, 0)
+		tags_size = tags_size[0] if tags_size else 0  # legacy snapshots have no tag table
+		column = array(coord_type).itemsize * count
+		if magic not in (snapshot_magic, legacy_magic) or \
+				size != header.size + 3 * column + count + names_size + tags_size:
+			mapped.close()
+			raise ValueError('not a location snapshot, or it was cut short')
+		table = cls()
+		view = memoryview(mapped)
+		offset = header.size
+		columns = []
+		for width, code in ((column, coord_type), (column, coord_type), (column, coord_type), (count, 'B')):
+			columns.append(view[offset:offset + width].cast(code))
+			offset += width
+		names = bytes(view[offset:offset + names_size]).decode('utf-8')
+		if tags_size:
+			table.tags = json.loads(bytes(view[offset + names_size:offset + names_size + tags_size]).decode('utf-8'))
+		table.names = names.split('\0') if count else []
+		table.ids = dict(zip(table.names, range(count)))
+		table.views = [*columns, view]
+		table.xs, table.ys, table.zs, table.dims = columns
+		table.mapped = mapped
+		if sys.byteorder != 'little':  # snapshots are little endian, big endian hosts copy and swap up front
+			table._writable()
+		return table
+
+	@staticmethod
+	def _copy(column):
+		copied = array(column.format)
+		copied.frombytes(column.cast('B'))
+		if copied.itemsize > 1 and sys.byteorder != 'little':
+			copied.byteswap()
+		return copied
+
+	def _release(self, mapped):
+		for view in self.views:
+			view.release()
+		self.views = []
+		mapped.close()
+
+	def _writable(self):
+		"""
+		Copies columns that are views of the mapped snapshot into arrays before they are changed
+		:return: None
+		"""
+		if self.mapped is not None:
+			self.xs, self.ys, self.zs, self.dims = (self._copy(col) for col in (self.xs, self.ys, self.zs, self.dims))
+			self._release(self.mapped)
+			self.mapped = None
+
+	def close(self):
+		"""
+		Unmaps the snapshot, the table can't be read afterwards unless it had already been changed
+		:return: None
+		"""
+		if self.mapped is not None:
+			self._release(self.mapped)
+			self.mapped = None
+
+	def __getitem__(self, name: str):
+		i = self.ids[name]
+		loc = {"Dimension": dimension_names[self.dims[i]], "X": self.xs[i], "Y": self.ys[i], "Z": self.zs[i]}
+		if name in self.tags:
+			loc["Tags"] = list(self.tags[name])
+		return loc
+
+	def __setitem__(self, name: str, loc: dict):
+		if '\0' in name:
+			raise ValueError('location names may not contain NUL')
+		code = dimension_codes[loc["Dimension"]]
+		self._writable()
+		i = self.ids.get(name)
+		if i is None:
+			self.ids[name] = len(self.names)
+			self.names.append(name)
+			self.xs.append(loc["X"])
+			self.ys.append(loc["Y"])
+			self.zs.append(loc["Z"])
+			self.dims.append(code)
+		else:
+			self.xs[i], self.ys[i], self.zs[i], self.dims[i] = loc["X"], loc["Y"], loc["Z"], code
+		if loc.get("Tags"):
+			self.tags[name] = list(loc["Tags"])
+		else:
+			self.tags.pop(name, None)
+
+	def __delitem__(self, name: str):
+		self._writable()
+		i = self.ids.pop(name)
+		self.tags.pop(name, None)
+		last = len(self.names) - 1
+		if i != last:  # the last row fills the gap so the columns stay dense
+			moved = self.names[last]
+			self.names[i] = moved
+			self.ids[moved] = i
+			for col in (self.xs, self.ys, self.zs, self.dims):
+				col[i] = col[last]
+		self.names.pop()
+		for col in (self.xs, self.ys, self.zs, self.dims):
+			col.pop()
+
+	def __contains__(self, name):
+		return name in self.ids
+
+	def __iter__(self):
+		return iter(self.names)
+
+	def __len__(self):
+		return len(self.names)
+
+	def rows(self):
+		"""
+		:return: A generator of (name, dimension, x, y, z) tuples without building location dicts
+		"""
+		xs, ys, zs, dims = self.xs, self.ys, self.zs, self.dims
+		for i, name in enumerate(self.names):
+			yield name, dimension_names[dims[i]], xs[i], ys[i], zs[i]
+
+	def copy(self):
+		"""
+		:return: An unmapped LocationTable holding the same rows, its columns copied whole rather than row by row
+		"""
+		table = LocationTable()
+		table.names = list(self.names)
+		table.ids = dict(self.ids)
+		table.tags = dict(self.tags)  # tag lists are replaced rather than changed, so they can be shared
+		table.xs, table.ys, table.zs, table.dims = (col.__copy__() if isinstance(col, array) else self._copy(col)
+													for col in (self.xs, self.ys, self.zs, self.dims))
+		return table
+
+	def nbytes(self):
+		"""
+		:return: Bytes held by the coordinate and dimension columns, mapped or not
+		"""
+		return sum(len(col) * col.itemsize for col in (self.xs, self.ys, self.zs, self.dims))
+
+	def write_snapshot(self, path: str, sync: bool = True):
+		"""
+		Writes and syncs the table to a temporary file that then replaces the snapshot, so a crash never leaves a
+		partly written one
+		:param path: String path to the snapshot
+		:param sync: Sync the file to disk, not needed for throwaway snapshots such as worker hand-offs
+		:return: None
+		"""
+		names = '\0'.join(self.names).encode('utf-8')
+		tags = json.dumps(self.tags, separators=(',', ':')).encode('utf-8') if self.tags else b''
+		with open(path + '.tmp', 'wb') as file_w:
+			file_w.write(snapshot_header.pack(snapshot_magic, len(self.names), len(names), len(tags)))
+			for col in (self.xs, self.ys, self.zs, self.dims):
+				if sys.byteorder != 'little' and col.itemsize > 1:
+					col = array(col.typecode, col)
+					col.byteswap()
+				file_w.write(col)
+			file_w.write(names)
+			file_w.write(tags)
+			if sync:
+				file_w.flush()
+				os.fsync(file_w.fileno())
+		if sync:
+			replace_file(path + '.tmp', path)
+		else:
+			os.replace(path + '.tmp', path)
+
+
+""" Snapshot File """
+
+
+class SnapshotFile(ResidentFile):
+	"""
+	A resident LocationTable kept in a snapshot file, reloaded like a json ResidentFile when the file changes
+	outside of the bot. Every change rewrites the snapshot, which is only the columns and name table.
+	"""
+
+	empty = LocationTable
+
+	def _read(self):
+		if not os.path.exists(self.path):
+			return LocationTable()
+		try:
+			# the old table is left for the garbage collector to unmap, paged results may still be reading it
+			return LocationTable.from_snapshot(self.path)
+		except (ValueError, UnicodeDecodeError, OSError) as e:
+			print(f'SnapshotFile() ERROR: {self.path} could not be read ({e})')
+			return None
+
+	def _write(self, data):
+		try:
+			data.write_snapshot(self.path)
+		except OSError as e:
+			print(f'SnapshotFile() ERROR: {self.path} could not be written ({e})')
+			return False
+		return True
+
+	def _freeze(self):
+		return self.data.copy()
+
+	def stats(self):
+		"""
+		:return: A dict of the hit, reload and write counts, location count and column bytes
+		"""
+		data = self.data if self.data is not None else LocationTable()
+		return {**super().stats(), 'locations': len(data), 'column_bytes': data.nbytes(),
+				'mapped': data.mapped is not None}
+
+
+""" Columnar Backend """
+
+
+class ColumnarBackend:
+	"""
+	Keeps the locations in a snapshot file and the members in their json file, optionally journaling changes to both.
+	Mapping the snapshot makes loading the table itself fast, but the indexes attached to the store are still built
+	from every row when it is loaded, so opening a large guild is still bound by those rebuilds. bench.py times the
+	two as load_table and load.
+	"""
+
+	def __init__(self, path: str, members_path: str = None, journaled: bool = False):
+		"""
+		:param path: String path to the locations snapshot
+		:param members_path: String path to Members.json, None for namespaces without members
+		:param journaled: Journal changes instead of rewriting the snapshot and Members.json on every change
+		"""
+		self.path = path
+		self.members_path = members_path
+		self.journaled = journaled
+		self.locations = SnapshotFile(path, Journal(journal_path(path)) if journaled else None)
+
+	def tables(self):
+		"""
+		:return: The resident tables for a DataStore
+		"""
+		tables = {'locations': self.locations}
+		if self.members_path is not None:
+			journal = Journal(journal_path(self.members_path)) if self.journaled else None
+			tables['members'] = ResidentFile(self.members_path, journal)
+		return tables
+
+	def migrate(self, paths: dict):
+		"""
+		Converts Locations.json into the snapshot the first time the backend is used
+		:param paths: The json_files dict
+		:return: None
+		"""
+		if os.path.exists(self.path) or not os.path.exists(paths['locations']):
+			return
+		locations = load_json_data(paths['locations'])
+		if locations is not None:
+			LocationTable.from_dict(locations).write_snapshot(self.path)
+			print(f'Migrated {len(locations)} locations to {self.path}')
+
+	def close(self):
+		if isinstance(self.locations.data, LocationTable):
+			self.locations.data.close()
+
+
+if __name__ == '__main__':
+	if len(sys.argv) != 4 or sys.argv[1] not in ('import', 'export'):
+		print('usage: python columnar.py import Locations.json Locations.mcdb\n'
+			  '       python columnar.py export Locations.mcdb Locations.json')
+		sys.exit(2)
+	if sys.argv[1] == 'import':
+		source = load_json_data(sys.argv[2])
+		if source is None:
+			sys.exit(1)
+		LocationTable.from_dict(source).write_snapshot(sys.argv[3])
+	else:
+		dump_json_data(dict(LocationTable.from_snapshot(sys.argv[2]).items()), sys.argv[3])
@@ -0,0 +1,464 @@
+"""
+Title: MCDB Guild Registry
+Author: Billy Cobb
+Desc: Per-guild location namespaces loaded on demand and evicted when idle, and the Minecraft servers each guild
+has registered, pinged together with bounded concurrency
+"""
+
+import asyncio
+import hashlib
+import os
+import re
+import time
+
+from backends import SQLiteBackend
+from columnar import ColumnarBackend
+from presence import PresenceHistory
+from status import StatusPoller
+from store import DataStore, ResidentFile, load_json_data, dump_json_data
+
+
+def file_stamp(path: str):
+	"""
+	:return: A (mtime, size) tuple for a file, or None if it does not exist
+	"""
+	try:
+		st = os.stat(path)
+	except FileNotFoundError:
+		return None
+	return st.st_mtime_ns, st.st_size
+
+
+def server_folder(ip: str):
+	"""
+	:param ip: A server IP as given to addserver
+	:return: A folder name for the server that can't leave the folder it is joined to. host:port names keep their
+	old host_port folder, anything else outside [A-Za-z0-9._-] or starting with a dot is replaced and suffixed by a
+	hash of the IP so different IPs never share a folder.
+	"""
+	name = ip.replace(':', '_')
+	safe = re.sub(r'[^A-Za-z0-9._-]', '_', name)
+	if safe != name or safe.startswith('.'):
+		safe = f"{safe.lstrip('.')}-{hashlib.sha1(ip.encode('utf-8')).hexdigest()[:12]}"
+	return safe
+
+
+""" Guild Data """
+
+
+home_key = 'home'  # namespace of the home guild and DMs, kept in the original .resources files
+
+
+class GuildData:
+	"""
+	Everything one guild's commands work on. Indexes are attached as attributes by the registry's setup callable.
+	"""
+
+	def __init__(self, key: str, store: DataStore, backend: SQLiteBackend = None):
+		"""
+		:param key: The guild's namespace key
+		:param store: The guild's DataStore
+		:param backend: The guild's SQLiteBackend or ColumnarBackend, if it uses one
+		"""
+		self.key = key
+		self.store = store
+		self.backend = backend
+		self.last_used = time.monotonic()
+
+
+class GuildRegistry:
+	"""
+	Opens a guild's namespace the first time one of its commands runs and closes it again once it has been idle
+	for idle_timeout secs, so only the guilds in use keep their data resident. The home namespace is never evicted.
+	"""
+
+	def __init__(self, paths: dict, root: str, setup, home_guild_id: int = None, idle_timeout: float = 1800):
+		"""
+		:param paths: The json_files dict, its 'backend' and 'journal' settings apply to every guild
+		:param root: Directory holding one folder per guild
+		:param setup: A callable run with every newly opened GuildData to attach its indexes
+		:param home_guild_id: Id of the guild whose data lives in the original .resources files
+		:param idle_timeout: Secs without a command before a guild's data is evicted
+		"""
+		self.paths = paths
+		self.root = root
+		self.setup = setup
+		self.home_guild_id = home_guild_id
+		self.idle_timeout = idle_timeout
+		self.guilds = {}  # namespace key -> GuildData
+		self.opening = {}  # namespace key -> task loading it off the event loop, shared by everything waiting on it
+		self.closing = {}  # namespace key -> task closing it off the event loop after it was evicted
+		self.task = None
+		self.loads = 0
+		self.evictions = 0
+
+	def key(self, guild_id: int = None):
+		"""
+		:param guild_id: A Discord guild id, None for DMs
+		:return: The namespace key for the guild
+		"""
+		if guild_id is None or guild_id == self.home_guild_id:
+			return home_key
+		return str(guild_id)
+
+	def add_home(self, store: DataStore, backend: SQLiteBackend = None):
+		"""
+		Registers the already loaded home namespace
+		:return: The home GuildData
+		"""
+		guild = GuildData(home_key, store, backend)
+		self.setup(guild)
+		self.guilds[home_key] = guild
+		return guild
+
+	async def open(self, guild_id: int = None):
+		"""
+		Returns a guild's data, loading it on the loop's default executor if it isn't resident. Every command or request
+		for the guild that arrives while it loads waits on the same load
+		:param guild_id: A Discord guild id, None for DMs
+		:return: The GuildData
+		"""
+		key = self.key(guild_id)
+		guild = self.guilds.get(key)
+		if guild is None:
+			task = self.opening.get(key)
+			if task is None:
+				task = self.opening[key] = asyncio.ensure_future(self._open(key))
+			guild = await asyncio.shield(task)  # a cancelled command doesn't cancel the load others wait on
+		guild.last_used = time.monotonic()
+		return guild
+
+	async def _open(self, key: str):
+		try:
+			closing = self.closing.get(key)
+			if closing is not None:
+				await asyncio.wait({closing})  # an eviction is still writing the files this load reads
+			guild = await asyncio.get_running_loop().run_in_executor(None, self._load, key)
+			self.guilds[key] = guild
+			self.loads += 1
+			return guild
+		finally:
+			self.opening.pop(key, None)
+
+	def _load(self, key: str):
+		"""
+		Loads a guild's namespace from its folder, creating the folder the first time. Only touches the new guild's
+		files and backend, so it runs on a worker thread
+		:param key: The namespace key
+		:return: The GuildData, not yet resident
+		"""
+		folder = os.path.join(self.root, key)
+		os.makedirs(folder, exist_ok=True)
+		paths = {'locations': os.path.join(folder, 'Locations.json')}
+		if not os.path.exists(paths['locations']):
+			dump_json_data({}, paths['locations'])
+		backend = None
+		journaled = self.paths.get('journal', False)
+		if self.paths.get('backend') == 'sqlite':
+			backend = SQLiteBackend(os.path.join(folder, 'mcdb.sqlite3'))
+			backend.migrate({**paths, 'members': os.path.join(folder, 'Members.json'),
+							 'log': os.path.join(folder, 'CommandLog.jsonl')})
+		elif self.paths.get('backend') == 'columnar':
+			backend = ColumnarBackend(os.path.join(folder, 'Locations.mcdb'), journaled=journaled)
+			backend.migrate(paths)
+		store = DataStore(paths, backend=backend, journaled=journaled)
+		guild = GuildData(key, store, backend)
+		self.setup(guild)
+		store.load()
+		return guild
+
+	async def evict_idle(self):
+		"""
+		Drops every guild that hasn't run a command for idle_timeout secs
+		:return: The number of guilds evicted
+		"""
+		now = time.monotonic()
+		idle = [key for key, guild in self.guilds.items()
+				if key != home_key and now - guild.last_used >= self.idle_timeout]
+		for key in idle:
+			await self.evict(key)
+		return len(idle)
+
+	async def evict(self, key: str):
+		"""
+		Closes a guild's namespace on the loop's default executor, it is loaded again by its next command, which
+		waits for the close to finish first
+		:param key: The namespace key, never the home key
+		:return: True if the guild was resident
+		"""
+		guild = self.guilds.pop(key, None)
+		if guild is None:
+			return False
+		task = self.closing[key] = asyncio.ensure_future(self._evict(key, guild))
+		await asyncio.shield(task)
+		return True
+
+	async def _evict(self, key: str, guild: GuildData):
+		try:
+			await asyncio.get_running_loop().run_in_executor(None, self._close, guild)
+			self.evictions += 1
+		finally:
+			self.closing.pop(key, None)
+
+	@staticmethod
+	def _close(guild: GuildData):
+		guild.store.close()  # compacts journaled changes while the backend is still open
+		if guild.backend is not None:
+			guild.backend.close()
+
+	def close(self):
+		"""
+		Closes every resident guild, the home guild included, used at shutdown
+		:return: None
+		"""
+		for guild in self.guilds.values():
+			self._close(guild)
+		self.guilds = {}
+
+	def start(self, loop: asyncio.AbstractEventLoop, interval: float = 60):
+		"""
+		Starts the background eviction task if it isn't already running
+		:param loop: The event loop the bot runs on
+		:param interval: Secs between eviction checks
+		:return: None
+		"""
+		if self.task is None or self.task.done():
+			self.task = loop.create_task(self.run(interval))
+
+	async def run(self, interval: float):
+		while True:
+			await asyncio.sleep(interval)
+			await self.evict_idle()
+
+	def stats(self):
+		"""
+		:return: A dict of resident guild, load and eviction counts
+		"""
+		return {'resident': len(self.guilds), 'loads': self.loads, 'evictions': self.evictions}
+
+
+""" Server Registry """
+
+
+class ServerEntry:
+	"""
+	A registered Minecraft server, its status poller, the members seen on it and when they were online
+	"""
+
+	def __init__(self, ip: str, poller: StatusPoller, members, presence: PresenceHistory):
+		"""
+		:param ip: A string containing the server IP
+		:param poller: The server's StatusPoller
+		:param members: A resident file or table holding the server's members
+		:param presence: The server's PresenceHistory
+		"""
+		self.ip = ip
+		self.poller = poller
+		self.members = members
+		self.presence = presence
+
+
+class ServerRegistry:
+	"""
+	The Minecraft servers registered by each guild. A server registered by several guilds is pinged once, and one
+	task pings every due server concurrently with at most max_concurrent pings in flight.
+	"""
+
+	def __init__(self, path: str, members_root: str, on_status, interval: float = 30, timeout: float = 5,
+				 max_concurrent: int = 16, owns=None):
+		"""
+		:param path: String path to Servers.json, which maps namespace keys to lists of server IPs
+		:param members_root: Directory holding one folder of Members.json and Presence.jsonl per server
+		:param on_status: A callable run with (ServerEntry, PingResponse) after every successful ping
+		:param interval: Secs between pings of a responding server
+		:param timeout: Secs before a ping is treated as failed
+		:param max_concurrent: Most pings in flight at once
+		:param owns: A callable telling whether this process owns a namespace key when the bot runs as several
+		shard processes, None when it owns every key
+		"""
+		self.path = path
+		self.members_root = members_root
+		self.on_status = on_status
+		self.interval = interval
+		self.timeout = timeout
+		self.owns = owns
+		self.semaphore = asyncio.Semaphore(max_concurrent)
+		self.stamp = file_stamp(path)
+		self.guild_servers = (load_json_data(path) if self.stamp is not None else None) or {}
+		self.servers = {}  # ip -> ServerEntry
+		self.task = None
+		self.polls = set()  # background polls in flight
+		for key, ips in self.guild_servers.items():
+			if owns is None or owns(key):
+				for ip in ips:
+					self.entry(ip)
+
+	def entry(self, ip: str, members=None, presence: PresenceHistory = None):
+		"""
+		Returns the entry for a server, creating it the first time
+		:param ip: A string containing the server IP
+		:param members: The resident members file or table to use, defaults to members_root/<folder>/Members.json
+		:param presence: The PresenceHistory to use, defaults to one kept in members_root/<folder>/Presence.jsonl
+		:return: The ServerEntry
+		"""
+		server = self.servers.get(ip)
+		if server is not None:
+			if members is not None:
+				server.members = members
+			if presence is not None:
+				server.presence = presence
+		if server is None:
+			folder = os.path.join(self.members_root, server_folder(ip))
+			if members is None or presence is None:
+				os.makedirs(folder, exist_ok=True)
+			if members is None:
+				members = ResidentFile(os.path.join(folder, 'Members.json'))
+				if not os.path.exists(members.path):
+					dump_json_data({}, members.path)
+			if presence is None:
+				presence = PresenceHistory(os.path.join(folder, 'Presence.jsonl'))
+			poller = StatusPoller(ip, interval=self.interval, timeout=self.timeout)
+			server = ServerEntry(ip, poller, members, presence)
+			poller.listeners.append(lambda status: self._status(server, status))
+			self.servers[ip] = server
+		return server
+
+	def _status(self, server: ServerEntry, status):
+		if self.records(server.ip):
+			server.presence.load()  # catches up on anything recorded by the process that recorded it before
+			self.on_status(server, status)
+
+	def records(self, ip: str):
+		"""
+		A server registered by guilds in several shard processes is pinged in the background and recorded by the
+		process owning the first of those guilds, the others read its files
+		:param ip: A string containing the server IP
+		:return: True if this process records who joins and leaves the server
+		"""
+		if self.owns is None:
+			return True
+		keys = [key for key, ips in self.guild_servers.items() if ip in ips]
+		return bool(keys) and self.owns(min(keys))
+
+	def refresh(self):
+		"""
+		Picks up the servers registered by guilds other shard processes own. Each process is the only one changing
+		its own guilds' lists, so those are kept from memory.
+		:return: None
+		"""
+		stamp = file_stamp(self.path)
+		if self.owns is None or stamp == self.stamp:
+			return
+		self.stamp = stamp
+		latest = (load_json_data(self.path) if stamp is not None else None) or {}
+		self.guild_servers = {**latest, **{key: ips for key, ips in self.guild_servers.items() if self.owns(key)}}
+
+	def _save(self):
+		dump_json_data(self.guild_servers, self.path)
+		self.stamp = file_stamp(self.path)
+
+	def for_guild(self, key: str):
+		"""
+		:param key: A namespace key
+		:return: The guild's ServerEntry list, in the order they were registered
+		"""
+		servers = [self.entry(ip) for ip in self.guild_servers.get(key, [])]
+		for server in servers:
+			if not self.records(server.ip):
+				server.presence.load()  # recorded by another shard process, Members.json reloads on its own
+		return servers
+
+	def register(self, key: str, ip: str):
+		"""
+		Registers a server for a guild
+		:return: True if it was registered, False if the guild already had it
+		"""
+		self.refresh()
+		ips = self.guild_servers.setdefault(key, [])
+		if ip in ips:
+			return False
+		ips.append(ip)
+		self.entry(ip)
+		self._save()
+		return True
+
+	def unregister(self, key: str, ip: str):
+		"""
+		Unregisters a server from a guild, it stops being pinged once no guild has it
+		:return: True if it was unregistered, False if the guild didn't have it
+		"""
+		self.refresh()
+		ips = self.guild_servers.get(key, [])
+		if ip not in ips:
+			return False
+		ips.remove(ip)
+		still = [other for other, others in self.guild_servers.items() if ip in others]
+		if not any(self.owns is None or self.owns(other) for other in still):
+			server = self.servers.pop(ip, None)
+			if server is not None and not still:  # otherwise another shard process carries on recording it
+				server.presence.close()
+		self._save()
+		return True
+
+	def close(self):
+		"""
+		Ends the open presence sessions of every server this process records, run once the bot stops pinging them
+		:return: None
+		"""
+		for server in self.servers.values():
+			if self.records(server.ip):
+				server.presence.close()
+
+	async def _poll(self, server: ServerEntry):
+		async with self.semaphore:
+			return await server.poller.poll()
+
+	async def ping(self, servers: list, max_age: float = None):
+		"""
+		Gets a status for each server at once, reusing cached statuses younger than max_age
+		:param servers: The ServerEntry list
+		:param max_age: Oldest cached status in secs to reuse, None to always ping
+		:return: A list of PingResponses (or None for unreachable servers) in the same order
+		"""
+		async def status(server):
+			if max_age is not None and server.poller.status is not None and server.poller.age <= max_age:
+				return server.poller.status
+			async with self.semaphore:
+				return await server.poller.get(max_age=max_age)
+		return await asyncio.gather(*(status(server) for server in servers))
+
+	def start(self, loop: asyncio.AbstractEventLoop):
+		"""
+		Starts the background ping task if it isn't already running
+		:param loop: The event loop the bot runs on
+		:return: None
+		"""
+		if self.task is None or self.task.done():
+			self.task = loop.create_task(self.run())
+
+	def stats(self):
+		"""
+		:return: A dict of server and in flight poll counts and the ping counts summed over every server
+		"""
+		pollers = [server.poller.stats() for server in self.servers.values()]
+		return {'servers': len(self.servers), 'polls': len(self.polls),
+				**{key: sum(stats[key] for stats in pollers) for key in ('pings', 'failures', 'coalesced')}}
+
+	async def run(self, tick: float = 1):
+		"""
+		Every tick, starts pinging the servers whose next ping is due, all at once within the concurrency bound
+		:param tick: Secs between checks for due servers
+		:return: None
+		"""
+		loop = asyncio.get_running_loop()
+		while True:
+			self.refresh()
+			now = time.monotonic()
+			for server in list(self.servers.values()):
+				if server.poller.next_ping <= now and self.records(server.ip):
+					server.poller.next_ping = float('inf')  # not due again until its poll finishes
+					# not awaited so one slow server doesn't hold back the others' schedules
+					poll = loop.create_task(self._poll(server))
+					self.polls.add(poll)
+					poll.add_done_callback(self.polls.discard)
+			await asyncio.sleep(tick)
@@ -0,0 +1,248 @@
+"""
+Title: MCDB Write Journal
+Author: Billy Cobb
+Desc: Append-only json-lines journal of changes to a resident file, group committed with fsync on one writer thread
+and replayed over the last snapshot when the file is loaded
+"""
+
+import json
+import os
+import threading
+from concurrent.futures import Future
+
+from metrics import metrics
+
+
+""" Journal Vars """
+
+
+compact_bytes = 4 * 1024 * 1024  # journal size a resident file is compacted into a new snapshot at
+
+
+def journal_path(path: str):
+	"""
+	:param path: String path to the snapshot the journal belongs to
+	:return: The journal's path, Locations.json -> Locations.journal
+	"""
+	return os.path.splitext(path)[0] + '.journal'
+
+
+""" Journal """
+
+
+class Journal:
+	"""
+	Changes are queued by put() and delete() and written by a single writer thread. Whatever is queued while the
+	thread is syncing the last batch goes out as the next batch with one write and one fsync, so a burst of changes
+	costs a handful of syncs rather than one per change. Each change returns a future that is resolved once it is
+	on disk. Records are ["p", key, value] or ["d", key], a torn last line from a crash is cut off when replayed.
+	"""
+
+	def __init__(self, path: str, compact_bytes: int = compact_bytes):
+		"""
+		:param path: String path to the .journal file
+		:param compact_bytes: Size in bytes the owner should compact the journal at
+		"""
+		self.path = path
+		self.compact_bytes = compact_bytes
+		self.size = os.path.getsize(path) if os.path.exists(path) else 0  # bytes written or queued
+		self.pending = []  # (line bytes, future) tuples waiting for the writer
+		self.last = None  # future of the most recently queued change
+		self.cond = threading.Condition()
+		self.write_lock = threading.Lock()  # held while a batch is written, truncate() waits on it
+		self.thread = None
+		self.file = None
+		self.closing = False
+		self.appended = 0
+		self.commits = 0
+		self.replayed = 0
+		self.errors = 0
+
+	def _append(self, record: list):
+		"""
+		Queues a record for the writer thread, starting it on the first change
+		:param record: A json serializable list
+		:return: A concurrent.futures.Future resolved once the record is synced
+		"""
+		line = (json.dumps(record, separators=(',', ':')) + '\n').encode('utf-8')
+		future = Future()
+		with self.cond:
+			if self.thread is None:
+				self.closing = False
+				self.thread = threading.Thread(target=self._run, name='mcdb-journal', daemon=True)
+				self.thread.start()
+			self.pending.append((line, future))
+			self.size += len(line)
+			self.cond.notify()
+		self.appended += 1
+		self.last = future
+		return future
+
+	def put(self, key: str, value):
+		"""
+		:param key: The key of an entry that was added or changed
+		:param value: Its json serializable value
+		:return: A future resolved once the change is synced
+		"""
+		return self._append(['p', key, value])
+
+	def delete(self, key: str):
+		"""
+		:param key: The key of an entry that was removed
+		:return: A future resolved once the change is synced
+		"""
+		return self._append(['d', key])
+
+	def _run(self):
+		"""
+		Writer thread: writes and syncs everything queued, one batch at a time, until closed
+		:return: None
+		"""
+		while True:
+			with self.cond:
+				while not self.pending and not self.closing:
+					self.cond.wait()
+				if not self.pending:
+					return
+				batch, self.pending = self.pending, []
+			with self.write_lock:
+				try:
+					self._commit(b''.join(line for line, _ in batch))
+				except OSError as e:
+					self.errors += 1
+					print(f'Journal ERROR: {self.path} could not be written ({e})')
+					for _, future in batch:
+						future.set_exception(e)
+					continue
+			metrics.observe('mcdb_journal_batch_records', len(batch))
+			for _, future in batch:
+				future.set_result(None)
+
+	@metrics.timed('mcdb_io_seconds', op='journal_commit')
+	def _commit(self, lines: bytes):
+		if self.file is None:
+			self.file = open(self.path, 'ab')
+		self.file.write(lines)
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.commits += 1
+
+	def flush(self):
+		"""
+		Waits until every change queued so far is on disk, failures are already reported by the writer
+		:return: None
+		"""
+		if self.last is not None:
+			self.last.exception()
+
+	def replay(self):
+		"""
+		Reads the synced records, oldest first, and cuts off a torn last line so new records start on a clean line
+		:return: A list of records
+		"""
+		self.flush()
+		try:
+			with open(self.path, 'rb') as file_r:
+				data = file_r.read()
+		except FileNotFoundError:
+			return []
+		records, end = [], 0
+		for line in data.splitlines(keepends=True):
+			if not line.endswith(b'\n'):
+				break
+			try:
+				record = json.loads(line)
+			except ValueError:
+				break
+			records.append(record)
+			end += len(line)
+		if end < len(data):
+			print(f'Journal: {self.path} ended in a partial record, {len(data) - end} bytes were dropped')
+			with self.write_lock:
+				os.truncate(self.path, end)
+		self.size = end
+		self.replayed += len(records)
+		return records
+
+	def apply(self, data):
+		"""
+		Replays the journal over a freshly loaded snapshot
+		:param data: The snapshot's dict, or a mapping with the same interface
+		:return: The number of records applied
+		"""
+		records = self.replay()
+		for record in records:
+			if record[0] == 'p':
+				data[record[1]] = record[2]
+			elif record[0] == 'd':
+				data.pop(record[1], None)
+		return len(records)
+
+	def truncate(self):
+		"""
+		Empties the journal once its changes are in a new snapshot
+		:return: None
+		"""
+		self.flush()
+		with self.write_lock:
+			if self.file is not None:
+				self.file.truncate(0)
+				os.fsync(self.file.fileno())
+			elif os.path.exists(self.path):
+				os.truncate(self.path, 0)
+		self.size = 0
+
+	def mark(self):
+		"""
+		:return: (bytes, future) for every record queued so far, the bytes are what discard() drops once a snapshot
+		holds their changes and the future is resolved once they are all synced
+		"""
+		with self.cond:
+			return self.size, self.last
+
+	def discard(self, end: int):
+		"""
+		Drops the first bytes of the journal once a new snapshot holds their changes, keeping the records appended
+		since. The kept records are written to a temporary file that replaces the journal.
+		:param end: Bytes from mark(), every record in them must already be synced
+		:return: None
+		"""
+		with self.write_lock:
+			try:
+				with open(self.path, 'rb') as file_r:
+					file_r.seek(end)
+					kept = file_r.read()
+			except FileNotFoundError:
+				kept = b''
+			with open(self.path + '.tmp', 'wb') as file_w:
+				file_w.write(kept)
+				file_w.flush()
+				os.fsync(file_w.fileno())
+			if self.file is not None:
+				self.file.close()
+				self.file = None  # the writer reopens the new journal for its next batch
+			os.replace(self.path + '.tmp', self.path)
+		with self.cond:
+			self.size -= end
+
+	def close(self):
+		"""
+		Writes everything queued and stops the writer thread
+		:return: None
+		"""
+		with self.cond:
+			self.closing = True
+			self.cond.notify()
+			thread, self.thread = self.thread, None
+		if thread is not None:
+			thread.join()
+		if self.file is not None:
+			self.file.close()
+			self.file = None
+
+	def stats(self):
+		"""
+		:return: A dict of journal size, appended, commit, replayed and error counts
+		"""
+		return {'bytes': self.size, 'appended': self.appended, 'commits': self.commits, 'replayed': self.replayed,
+				'errors': self.errors}
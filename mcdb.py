@@ -7,11 +7,40 @@ Desc: A Minecraft coordinate and player database Discord bot script
 import discord
 from discord.ext import commands
 import asyncio
+import aiohttp
+import io
 import mcstatus
-from mcstatus import MinecraftServer
-import json
-import random as rand
-from datetime import datetime
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+from store import DataStore
+from journal import journal_path
+from backup import BackupStore, snapshot_format, staging_prefix
+from api import LocationAPI
+from cmdlog import CommandLog
+from backends import SQLiteBackend, SQLiteCommandLog
+from columnar import ColumnarBackend
+from guilds import GuildRegistry, ServerRegistry, home_key
+from presence import PresenceHistory
+from spatial import SpatialIndex
+try:
+	from tiles import TileCache, max_zoom
+except ImportError:  # Pillow isn't installed, the map command is turned off
+	TileCache, max_zoom = None, None
+from route import RouteIndex, position
+from tags import TagIndex, parse_tags
+from search import SearchIndex
+from paginator import Paginator
+from reactions import ReactionDispatcher
+from cache import QueryCache, missing
+from sampling import RandomIndex
+from metrics import metrics, flatten, instrument_http, instrument_rate_limits
+from transfer import read_locations, write_locations, export_formats
+from usage import UsageRollups
+from shards import ShardConfig, launch, process_path, process_paths
+from workers import WorkerPool, SnapshotIndex, query_indexes
 
 
 """ Client Vars """
@@ -20,17 +49,124 @@ from datetime import datetime
 token = ''  # insert Discord bot token here
 cmd_prefix = '%'
 listening_to = cmd_prefix
-client = commands.Bot(command_prefix=cmd_prefix, help_command=None, case_insensitive=True)
 minecraft_server_ip = ''  # insert Minecraft server ip here
+status_interval = 30  # secs between background server pings
+status_timeout = 5  # secs before a server ping is treated as failed
+status_max_age = 10  # oldest cached server status in secs the server command will show without a new ping
+max_concurrent_pings = 16  # most server pings in flight at once
+home_guild_id = None  # insert the id of the guild whose data is kept in the original .resources files
+guild_idle_timeout = 1800  # secs without a command before a guild's locations are evicted from memory
+metrics_interval = 15  # secs between writes of the Prometheus metrics file
+max_import_bytes = 8 * 1024 * 1024  # largest attachment the import command will download
+max_import_rows = 100000  # most rows the import command will read from one file
+max_export_bytes = 8 * 1024 * 1024  # Discord's attachment limit for bots
+query_cache_size = 256  # most find/near/within results cached per guild
+portal_tag = 'portal'  # locations filed under this tag are the Nether portals route can travel through
+max_route_stops = 25  # most stops one route command will order
+query_cache_ttl = 300  # secs a cached result is kept while the locations don't change
+api_host = '127.0.0.1'  # address the read-only HTTP API binds, keep it local unless a proxy sits in front
+api_port = None  # port of the read-only HTTP API, None to not serve it
+worker_pool_kind = 'inline'  # 'process' queries large guilds on worker processes, else every query runs on the loop
+worker_count = None  # workers in the pool, None for one per core
+offload_min_locations = 20000  # guilds with fewer locations are queried on the event loop, a hand-off costs more
+shard_count = None  # gateway shards, None for one unsharded connection, 0 for the count Discord recommends
+shard_processes = 1  # processes the shards are split across, each answering its own guilds from the shared .resources
+backup_interval = 3600  # secs between incremental backups of .resources, None to not take any
+backup_keep_last = 24  # newest backups always kept
+backup_keep_daily = 14  # days whose last backup is also kept
+backup_max_bytes = 2 * 1024 ** 3  # compressed bytes the oldest backups are pruned down to, None for no limit
+
+shard = ShardConfig.from_env()  # the shards this process runs, set by the launcher when shard_processes > 1
+if shard.shard_ids is not None or shard_count is not None:
+	client = commands.AutoShardedBot(command_prefix=cmd_prefix, help_command=None, case_insensitive=True,
+									 shard_count=shard.shard_count or shard_count or None, shard_ids=shard.shard_ids)
+else:
+	client = commands.Bot(command_prefix=cmd_prefix, help_command=None, case_insensitive=True)
+# tells shard processes which guilds' data, servers and usage are theirs, None when one process has every guild
+owns = shard.owns if shard.processes > 1 else None
 
 
 """ Global Vars """
 
 
 json_files = {
-	'log': './.resources/CommandLog.json',
+	# 'json' keeps the data in the files below, 'sqlite' keeps it in the sqlite database and 'columnar' keeps the
+	# locations in the memory-mapped snapshot, which loads the table quickly but still rebuilds the indexes from it
+	'backend': 'json',
+	'journal': True,  # append changes to a group committed .journal file and only rewrite the data files to compact
+	'sqlite': './.resources/mcdb.sqlite3',
+	'snapshot': './.resources/Locations.mcdb',
+	'log': './.resources/CommandLog.jsonl',
+	'legacy_log': './.resources/CommandLog.json',
 	'locations': './.resources/Locations.json',
-	'members': './.resources/Members.json'
+	'members': './.resources/Members.json',
+	'presence': './.resources/Presence.jsonl',  # joins and leaves seen on minecraft_server_ip
+	'guilds': './.resources/guilds',  # one folder of locations per guild other than the home guild
+	'servers': './.resources/Servers.json',  # the Minecraft servers registered by each guild
+	'server_members': './.resources/servers',  # one Members.json and Presence.jsonl per other server
+	'metrics': './.resources/mcdb.prom',  # Prometheus text file, point a node exporter's textfile collector here
+	'backups': './.backups'  # content-addressed backups of .resources, kept outside it on purpose
+}
+
+if json_files['backend'] == 'sqlite':
+	storage_backend = SQLiteBackend(json_files['sqlite'])
+	storage_backend.migrate(json_files)  # copies the json files into a new database, no-op once migrated
+	store = DataStore(json_files, backend=storage_backend)
+	command_log = SQLiteCommandLog(storage_backend)
+elif json_files['backend'] == 'columnar':
+	storage_backend = ColumnarBackend(json_files['snapshot'], json_files['members'], journaled=json_files['journal'])
+	storage_backend.migrate(json_files)  # converts Locations.json into a new snapshot, no-op once migrated
+	store = DataStore(json_files, backend=storage_backend)
+	command_log = CommandLog(process_path(json_files['log'], shard.process),
+							 legacy_path=json_files['legacy_log'] if not shard.process else None)
+else:
+	storage_backend = None
+	# resident copy of locations and members shared by every command
+	store = DataStore(json_files, journaled=json_files['journal'])
+	# rotates the log at 8MB and gzips old segments, entries are flushed in the background every 2 secs, each shard
+	# process appends to its own
+	command_log = CommandLog(process_path(json_files['log'], shard.process),
+							 legacy_path=json_files['legacy_log'] if not shard.process else None)
+# the logs other shard processes write, or wrote in earlier runs, only read when counting usage from before this run
+shard_logs = [] if json_files['backend'] == 'sqlite' else [
+	CommandLog(path, legacy_path=json_files['legacy_log'] if path == json_files['log'] else None)
+	for path in process_paths(json_files['log']) if path != command_log.path]
+# runs the queries of large guilds, imports and exports off the event loop, its threads also run blocking file I/O
+worker_pool = WorkerPool(worker_pool_kind, worker_count, min_locations=offload_min_locations)
+search_chunk = 50  # ranked find results fetched from the search index at a time while paging
+
+
+def attach_indexes(guild):
+	"""
+	Attaches the indexes commands query to a newly opened guild namespace
+	:param guild: The GuildData
+	:return: None
+	"""
+	guild.spatial_index = guild.store.attach(SpatialIndex())  # per-dimension grid used by near, within and box
+	guild.search_index = guild.store.attach(SearchIndex())  # trigram index over location names used by find
+	guild.tag_index = guild.store.attach(TagIndex())  # tag -> names posting sets used by find's tag: facets
+	guild.random_index = guild.store.attach(RandomIndex())  # per-dimension name arrays random picks from
+	# results of repeated queries, dropped whenever the store's generation moves on
+	guild.query_cache = QueryCache(max_entries=query_cache_size, ttl=query_cache_ttl)
+	if TileCache is not None:
+		guild.tiles = guild.store.attach(TileCache())  # rendered map tiles, only those near a change are dropped
+	# portal graph and travel distances between routed locations, only those to a changed location are dropped
+	guild.routes = guild.store.attach(RouteIndex(portal_tag))
+	# columnar copy of the locations frozen for the worker pool, only kept once the guild first hands off work
+	guild.snapshots = guild.store.attach(SnapshotIndex(guild.key, lambda: guild.store.locations))
+
+
+# the home guild uses the store above, other guilds are loaded on their first command and evicted when idle
+guilds = GuildRegistry(json_files, json_files['guilds'], attach_indexes, home_guild_id=home_guild_id,
+					   idle_timeout=guild_idle_timeout)
+guilds.add_home(store, storage_backend)
+# routes reactions to open paginated messages, users may have 3 open at once and channels 10
+reaction_dispatcher = ReactionDispatcher(max_per_user=3, max_per_channel=10)
+
+dimensions = {  # dimension symbols accepted by commands
+	'o': 'overworld',
+	'n': 'nether',
+	'e': 'end'
 }
 
 
@@ -46,59 +182,12 @@ authorized_users = {  # dict is for storing authorized Discord ids (used for rem
 
 }
 
-
-""" Helper Functions """
-
-
-def load_json_data(path: str):
-	"""
-	Loads a Python dict from a json file
-	:param path: String path to the json file
-	:return: a Python dict of the json data
-	"""
-	try:
-		file_r = open(path, "r")
-	except FileNotFoundError:
-		print('load_json_data() ERROR: File was not found')
-		return None
-	try:
-		file_data = json.load(file_r)
-	except json.decoder.JSONDecodeError:
-		print('load_json_data() ERROR: Improper file type or format')
-		return None
-	file_r.close()
-	return file_data
-
-
-def dump_json_data(file_data: dict, path: str):
-	"""
-	Dumps a Python dict to a json file
-	:param file_data: The Python dict to be converted and dumped
-	:param path: String path to the json file
-	:return: None
-	"""
-	try:
-		file_w = open(path, "w")
-	except FileNotFoundError:
-		print('dump_json_data() ERROR: File was not found')
-		return None
-	try:
-		json.dump(file_data, file_w)
-	except json.decoder.JSONDecodeError:
-		print('dump_json_data() ERROR: Improper file type or format')
-		return None
-	file_w.close()
+# times every Discord REST call and counts the rate limits discord.py reports
+instrument_http(client.http)
+instrument_rate_limits()
 
 
-def get_server_status(server_ip: str):
-	"""
-	Looks up a provided server ip and returns its status
-	:param server_ip: A string containing the server IP
-	:return: The server status (An mcstatus PingResponse object)
-	"""
-	server = MinecraftServer.lookup(server_ip)
-	status = server.status()
-	return status
+""" Helper Functions """
 
 
 def get_server_description(status: mcstatus.pinger.PingResponse):
@@ -126,129 +215,317 @@ def get_members_online(status: mcstatus.pinger.PingResponse):
 	return None
 
 
-async def update_members(interval: int, members_online: list):
-	"""
-	Checks for members online in set intervals to update their last seen status
-	:param interval: The time interval between auto updates
-	:param members_online: The list of current members online
-	:return:
-	"""
-	while True:
-		if members_online is not None:
-			members = load_json_data(json_files['members'])
-			for i in members_online:
-				if i in members:
-					members[i]["LastSeen"] = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
-				else:
-					#  IsAdmin is set to False by default and is updated manually
-					members[i] = {"LastSeen": datetime.now().strftime("%m/%d/%Y %H:%M:%S"), "IsAdmin": False}
-			dump_json_data(members, json_files['members'])
-		await asyncio.sleep(interval)
-
-
-def predicate(message, l, r):
-	"""
-	:param message: The Discord message being monitored
-	:param l: Checks for a message with a lesser index value in the message list
-	:param r: Checks for a message with a greater index value in the message list
-	:return: The output value of the check function
-	"""
-	def check(reaction, user):
-		"""
-		Checks what reaction to a message the user selected
-		:param reaction: The reaction added by the user
-		:param user: The users id
-		:return: True if the user sent the message and selected a supplied reaction, else False
-		"""
-		if reaction.message.id != message.id or user == client.user:
-			return False
-		if reaction.emoji == emojis['close']:
-			return True
-		if l and reaction.emoji == emojis['left_arrow']:
-			return True
-		if r and reaction.emoji == emojis['right_arrow']:
-			return True
-		return False
-	return check
-
-
-def update_log(command: str, file: str, ctx: discord.ext.commands.context.Context):
-	log = load_json_data(file)
-	log[datetime.now().strftime("%m/%d/%Y %H:%M:%S")] = {"Command": f"{command}",
-														 "UserID": ctx.message.id,
-														 "UserName": f"{ctx.author}"}
-	dump_json_data(log, file)
-
-def updated_member_info(file: str, members_online: list):
-	"""
-	Provides an Updated member_list string, total_members int, and admin_online int for the server() command embed
-	:param file: The json file containing members
+def update_members(server, status: mcstatus.pinger.PingResponse):
+	"""
+	Records who joined and left since the last ping, run by the server registry after every successful ping. Only
+	the changes are written, and Members.json is only written when a new member is seen.
+	:param server: The ServerEntry that was pinged
+	:param status: An mcstatus PingResponse object
+	:return: None
+	"""
+	members_online = get_members_online(status) or []
+	joined, left = server.presence.sample(members_online, status.players.online)
+	if joined:
+		members = server.members.get()
+		new_members = [i for i in joined if i not in members]
+		for i in new_members:
+			#  IsAdmin is set to False by default and is updated manually
+			members[i] = {"IsAdmin": False}
+		if new_members:
+			server.members.put(*new_members)
+
+
+# hourly and daily command counts per guild, counted as commands are logged and rebuilt from the log on startup
+usage = UsageRollups(scope=lambda entry: guilds.key(entry.get("GuildID")), owns=owns)
+command_log.listeners.append(usage.add)
+# pings every registered server in the background, minecraft_server_ip belongs to the home guild
+servers = ServerRegistry(json_files['servers'], json_files['server_members'], update_members,
+						 interval=status_interval, timeout=status_timeout, max_concurrent=max_concurrent_pings,
+						 owns=owns)
+if minecraft_server_ip and shard.owns(home_key):
+	servers.guild_servers.setdefault(home_key, [minecraft_server_ip])
+	servers.entry(minecraft_server_ip, members=store.files['members'],
+				  presence=PresenceHistory(json_files['presence']))
+# serves the resident locations and presence to local tools such as the web map, started by on_ready if api_port is set
+# its index queries go through run_query like the commands', so large guilds are queried on the worker pool
+http_api = LocationAPI(guilds, servers, lambda *args, **kwargs: run_query(*args, **kwargs), owns=owns)
+# incremental backups of all of .resources, taken by the process serving the home guild and started by on_ready
+backups = BackupStore(os.path.dirname(json_files['locations']), json_files['backups'], keep_last=backup_keep_last,
+					  keep_daily=backup_keep_daily, max_bytes=backup_max_bytes)
+restore_lock = asyncio.Lock()  # one restore at a time, they share a staging folder
+
+# component counters shown by the stats command and written to the metrics file as gauges
+metrics.add_stats('store', store.stats)
+metrics.add_stats('log', command_log.stats)
+metrics.add_stats('reactions', reaction_dispatcher.stats)
+metrics.add_stats('guilds', guilds.stats)
+metrics.add_stats('servers', servers.stats)
+metrics.add_stats('cache', lambda: cache_stats())
+if TileCache is not None:
+	metrics.add_stats('tiles', lambda: cache_stats('tiles'))
+metrics.add_stats('routes', lambda: cache_stats('routes'))
+metrics.add_stats('tags', lambda: cache_stats('tag_index'))
+metrics.add_stats('usage', lambda: usage.stats())
+metrics.add_stats('api', lambda: http_api.stats())
+metrics.add_stats('workers', worker_pool.stats)
+metrics.add_stats('backups', backups.stats)
+if shard.processes > 1:
+	metrics.add_stats('shard', shard.stats)
+	metrics.const_labels = (('process', str(shard.process)),)  # every process writes its own metrics file
+
+
+def guild_id(ctx: discord.ext.commands.context.Context):
+	"""
+	:param ctx: The context of the command called
+	:return: The id of the guild the command was sent in, or None in DMs
+	"""
+	return ctx.guild.id if ctx.guild is not None else None
+
+
+async def guild_data(ctx: discord.ext.commands.context.Context):
+	"""
+	Gets the location namespace of the guild a command was sent in, loading it off the event loop if it isn't resident
+	:param ctx: The context of the command called
+	:return: The GuildData
+	"""
+	return await guilds.open(guild_id(ctx))
+
+
+def command_responded(ctx: discord.ext.commands.context.Context):
+	"""
+	Records the time from a command being invoked to its first reply, only the first call for a command counts
+	:param ctx: The context of the command called
+	:return: None
+	"""
+	start = getattr(ctx, 'metrics_start', None)
+	if start is not None:
+		ctx.metrics_start = None
+		metrics.observe('mcdb_command_seconds', time.perf_counter() - start, command=ctx.command.name)
+
+
+def cached_query(guild, key: tuple, compute):
+	"""
+	Returns a query result from the guild's cache, computing it if it isn't cached for the current locations
+	:param guild: The GuildData
+	:param key: The normalized query arguments, starting with the command name
+	:param compute: A callable returning the result
+	:return: The result
+	"""
+	return guild.query_cache.lookup(key, guild.store.generation, compute)
+
+
+async def run_query(guild, key: tuple, method: str, *args, **kwargs):
+	"""
+	Returns a query result from the guild's cache, running it if it isn't cached for the current locations. Large
+	guilds are queried on the worker pool against a snapshot of their locations, the rest on the event loop.
+	:param guild: The GuildData
+	:param key: The normalized query arguments, starting with the command name
+	:param method: The index method, 'nearest', 'within', 'box' or 'search'
+	:param args: The method's arguments
+	:return: The result
+	"""
+	generation = guild.store.generation
+	result = guild.query_cache.get(key, generation)
+	if result is missing:
+		result = await worker_pool.query(guild.snapshots, generation, getattr(guild, query_indexes[method]), method,
+										 *args, **kwargs)
+		guild.query_cache.put(key, generation, result)  # dropped if the locations changed while it ran
+	return result
+
+
+def cache_stats(attr: str = 'query_cache'):
+	"""
+	:param attr: The guild attribute holding the cache or index, 'query_cache', 'tiles', 'routes' or 'tag_index'
+	:return: The cache's stats summed over every resident guild
+	"""
+	totals = {}
+	for guild in guilds.guilds.values():
+		for key, value in getattr(guild, attr).stats().items():
+			totals[key] = totals.get(key, 0) + value
+	return totals
+
+
+def update_log(command: str, ctx: discord.ext.commands.context.Context):
+	"""
+	Queues a command to be appended to the command log, the write happens in the background
+	:param command: The command and its arguments
+	:param ctx: The context of the command called
+	:return: None
+	"""
+	command_log.append({"Command": f"{command}", "UserID": ctx.author.id, "UserName": f"{ctx.author}",
+						"GuildID": guild_id(ctx)})
+
+
+def last_seen(server, name: str):
+	"""
+	:param server: The ServerEntry the member plays on
+	:param name: The member's name
+	:return: A string of when the member was last online, from the presence history or else Members.json
+	"""
+	seen = server.presence.seen(name)
+	if seen == 0:
+		return 'online now'
+	if seen is not None:
+		return datetime.fromtimestamp(seen).strftime("%m/%d/%Y %H:%M:%S")
+	# members last seen before the presence history was kept still have the old LastSeen string
+	return server.members.get().get(name, {}).get('LastSeen', 'never')
+
+
+def format_duration(secs: float):
+	"""
+	:param secs: A length of time in secs
+	:return: The length as a string of days, hours and minutes
+	"""
+	minutes = int(secs) // 60
+	days, minutes = divmod(minutes, 24 * 60)
+	hours, minutes = divmod(minutes, 60)
+	parts = [f'{days}d'] if days else []
+	if days or hours:
+		parts.append(f'{hours}h')
+	parts.append(f'{minutes}m')
+	return ' '.join(parts)
+
+
+def parse_range(arg: str):
+	"""
+	Parses a time range such as 30m, 12h, 7d or 2w
+	:param arg: The range argument, 'all' for the whole history
+	:return: The epoch time the range starts at, or None if the argument isn't a range
+	"""
+	units = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+	arg = arg.lower()
+	if arg == 'all':
+		return 0
+	if len(arg) < 2 or arg[-1] not in units or not arg[:-1].isdigit():
+		return None
+	return int(time.time()) - int(arg[:-1]) * units[arg[-1]]
+
+
+def updated_member_info(server, members_online: list):
+	"""
+	Provides a total_members int, admin_online int and member status lines for the server() command embed
+	:param server: The ServerEntry the status is from
 	:param members_online: A list from the server status that has members currently online
-	:return: A tuple containing member_list string, total_members int, and admin_online int
+	:return: A tuple containing total_members int, admin_online int and a generator of member status strings
 	"""
-	# gets data from Members.json
-	members = load_json_data(file)
+	# gets data from the server's resident Members.json
+	members = server.members.get()
 
-	total_members = 0
 	admin_online = 0
-	member_list = ''  # Used for member_status embed
-	for i in members:
-		total_members += 1
-		if i in members_online:
-			members[i]["LastSeen"] = datetime.now().strftime("%m/%d/%Y %H:%M:%S")
-			member_list += f"{i}  {emojis['online']}\n*Last seen:* {members[i]['LastSeen']}\n"
-			if members[i]["IsAdmin"]:
-				admin_online += 1
-		else:
-			member_list += f"{i}  {emojis['offline']}\n*Last seen:* {members[i]['LastSeen']}\n"
-	member_list += '\n\n\n\nPage 2/2'
+	for i in members_online:
+		if i in members and members[i]["IsAdmin"]:
+			admin_online += 1
 
-	# updates data in Members.json
-	dump_json_data(members, json_files['members'])
-	return total_members, admin_online, member_list
+	def member_lines():
+		# Used for member_status embed pages, formatted as the user pages through them
+		for i in members:
+			status_emoji = emojis['online'] if i in members_online else emojis['offline']
+			yield f"{i}  {status_emoji}\n*Last seen:* {last_seen(server, i)}\n"
+	return len(members), admin_online, member_lines()
 
 
-async def reaction_controlled_embed(ctx: discord.ext.commands.context.Context, messages: list, timeout: float):
+async def reaction_controlled_embed(ctx: discord.ext.commands.context.Context, messages, timeout: float,
+									file: discord.File = None):
 	"""
-	Passes a list of embedded messages and provides reaction controls for them on Discord for users
+	Sends a set of embedded messages and provides reaction controls for them on Discord for users. The controls are
+	added once and each page turn only edits the message and removes the user's reaction.
 	:param ctx: The context of the command called
-	:param messages: The list of embeds
+	:param messages: The list of embeds, or a Paginator that builds its pages as they are visited
+	:param timeout: Secs the user has to react before the message is deleted
+	:param file: An attachment sent with the first page, such as an image the embed shows
 	:return: None
 	"""
-	msg_tag = ctx.author.mention
+	pages = messages if isinstance(messages, Paginator) else Paginator.from_embeds(messages)
+
+	def page(i: int):
+		embed = pages.get(i)
+		if pages.page_count != 1:
+			embed.set_footer(text=pages.label(i))
+		return embed
+
 	index = 0
-	msg = None
-	send_flag = True
-	while True:
-		if send_flag:
-			res = await ctx.send(msg_tag, embed=messages[index])
-			send_flag = False
-		else:
-			res = await msg.edit(embed=messages[index])
-		if res is not None:
-			msg = res
-		l = index != 0
-		r = index != len(messages) - 1
-		if l:
+	msg = await ctx.send(ctx.author.mention, embed=page(index), file=file)
+	command_responded(ctx)
+	# reactions on the message are routed to this session by on_reaction_add
+	controls = {emojis['close'], emojis['left_arrow'], emojis['right_arrow']}
+	session = reaction_dispatcher.open(msg.id, ctx.author.id, ctx.channel.id, controls, timeout)
+	try:
+		if pages.has_page(1):
 			await msg.add_reaction(emojis['left_arrow'])
-		if r:
 			await msg.add_reaction(emojis['right_arrow'])
 		await msg.add_reaction(emojis['close'])
-		try:
-			react, user = await client.wait_for('reaction_add', check=predicate(msg, l, r), timeout=timeout)
-		except asyncio.TimeoutError:  # user has 60.0 secs to react to message else it is deleted and loop exits
-			await msg.delete()
-			break
-		if react.emoji == emojis['close']:  # deletes message if close emoji is selected
-			await msg.delete()
-			break
-		if react.emoji == emojis['left_arrow']:
-			index -= 1
-			await msg.clear_reaction(emojis['left_arrow'])
-		elif react.emoji == emojis['right_arrow']:
-			index += 1
-			await msg.clear_reaction(emojis['right_arrow'])
-		await msg.clear_reaction(emojis['close'])
+		while True:
+			event = await session.next()
+			if event is None:  # user has timeout secs to react to message else it is deleted and loop exits
+				await msg.delete()
+				break
+			react, user = event
+			if react == emojis['close']:  # deletes message if close emoji is selected
+				await msg.delete()
+				break
+			new_index = index - 1 if react == emojis['left_arrow'] else index + 1
+			with metrics.timer('mcdb_page_turn_seconds'):
+				try:
+					await msg.remove_reaction(react, user)  # leaves the controls in place for the next turn
+				except discord.Forbidden:
+					pass  # without manage messages the user has to unreact before pressing the same arrow again
+				if pages.has_page(new_index):
+					index = new_index
+					await msg.edit(embed=page(index))
+	finally:
+		reaction_dispatcher.close(msg.id)
+
+
+async def change_servers(ctx: discord.ext.commands.context.Context, args: tuple, change, title: str, unchanged: str):
+	"""
+	Shared body of addserver and removeserver, only authorized users may change a guild's servers
+	:param ctx: Command context passed
+	:param args: The command arguments, the first is the server ip
+	:param change: servers.register or servers.unregister
+	:param title: Embed title when the change is made
+	:param unchanged: Description ending when the change had nothing to do
+	:return: None
+	"""
+	if ctx.message.author.id not in authorized_users.values():
+		unauth_user_err = discord.Embed(title=f'**UNAUTHORIZED USER**', color=0xFFFF00,
+										description='This command is only for use by certain users')
+		unauth_user_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [unauth_user_err], 20)
+		return
+	if len(args) != 1:
+		format_err = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
+								   description='Supply just the server ip, i.e. play.example.com:25565')
+		format_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [format_err], 20)
+		return
+	ip = args[0].lower()
+	if change(guilds.key(guild_id(ctx)), ip):
+		result = discord.Embed(title=title, color=0x04FF00, description=ip)
+	else:
+		result = discord.Embed(title='**NOTHING CHANGED**', color=0xFFFF00, description=f'{ip} {unchanged}')
+	result.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+	await reaction_controlled_embed(ctx, [result], 20)
+
+
+async def guild_server(ctx: discord.ext.commands.context.Context, ip: str = None):
+	"""
+	Gets one of the servers registered by the guild a command was sent in, replying with an error if there is none
+	:param ctx: Command context passed
+	:param ip: The server ip, defaults to the first registered
+	:return: The ServerEntry, or None if the guild has no such server
+	"""
+	registered = servers.for_guild(guilds.key(guild_id(ctx)))
+	if ip is not None:
+		registered = [entry for entry in registered if entry.ip == ip]
+
+	# formatting no server error
+	if not registered:
+		no_server_err = discord.Embed(title=f'**NO SERVER REGISTERED**', color=0xFF9E00,
+									  description=f'Register a server with {cmd_prefix}addserver [ip] first')
+		no_server_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [no_server_err], 20)
+		return None
+	return registered[0]
 
 
 def get_distance(loc_name: str, loc1x: int, loc1y: int, loc1z: int, loc2x: int, loc2y: int, loc2z: int):
@@ -266,6 +543,165 @@ def get_distance(loc_name: str, loc1x: int, loc1y: int, loc1z: int, loc2x: int,
 	return loc_name, (((loc2x-loc1x)**2)+((loc2y-loc1y)**2)+((loc2z-loc1z)**2))**0.5
 
 
+def parse_dimension(arg: str):
+	"""
+	Converts a dimension argument (i.e. o, Nether, END) to the dimension name stored with locations
+	:param arg: The dimension argument supplied by the user
+	:return: The full dimension name, or None if the argument is not a dimension
+	"""
+	arg = arg.lower().replace(",", "")
+	if not arg or arg not in (arg[0], dimensions.get(arg[0])):
+		return None
+	return dimensions.get(arg[0])
+
+
+def parse_coords(args: tuple):
+	"""
+	Converts coordinate arguments to ints, ignoring trailing commas
+	:param args: The coordinate arguments supplied by the user
+	:return: A list of ints, or None if any argument is not an integer
+	"""
+	try:
+		return [int(arg.replace(",", "")) for arg in args]
+	except ValueError:
+		return None
+
+
+def parse_facets(args: tuple):
+	"""
+	Splits find arguments into facets and the words of the name
+	:param args: The find arguments supplied by the user, i.e. ('tag:spawner', 'tag:nether', 'near:0,64,0', 'blaze')
+	:return: A tuple of (tags, (x, y, z) or None, radius or None, name words), or None if a facet is malformed
+	"""
+	tags, point, radius, words = [], None, None, []
+	for arg in args:
+		facet, colon, value = arg.partition(':')
+		facet = facet.lower()
+		if colon and facet == 'tag':
+			tags += parse_tags([value])
+		elif colon and facet == 'near':
+			point = parse_coords(tuple(coord for coord in value.split(',') if coord))
+			if point is None or len(point) != 3:
+				return None
+		elif colon and facet == 'within':
+			radius = parse_coords((value,))
+			if radius is None or radius[0] < 0:
+				return None
+			radius = radius[0]
+		else:
+			words.append(arg)
+	if radius is not None and point is None:
+		return None
+	return tags, point, radius, words
+
+
+def format_location(name: str, loc: dict, dist: float = None):
+	"""
+	Formats a stored location for an embed field
+	:param name: Name of the location
+	:param loc: The stored location dict
+	:param dist: Distance to the location, shown if supplied
+	:return: The formatted location string
+	"""
+	location_string = f'***{name}***\n*dim:* **{loc["Dimension"]}**, *x:* **{loc["X"]}**, *y:* **{loc["Y"]}**,\
+ *z:* **{loc["Z"]}**'
+	if loc.get("Tags"):
+		location_string += f', *tags:* **{", ".join(loc["Tags"])}**'
+	if dist is not None:
+		location_string += f', *dist:* **{round(dist)}**'
+	return location_string + '\n'
+
+
+def random_location(guild, dim: str = None):
+	"""
+	:param guild: The GuildData
+	:param dim: Only pick from this dimension, None to pick from every location
+	:return: A (name, location dict) tuple chosen at random, or None if there are no locations to pick from
+	"""
+	locs = guild.store.locations
+	name = guild.random_index.sample(dim)
+	return (name, locs[name]) if name is not None else None
+
+
+def result_pages(title: str, description: str, field_name: str, lines, color: int = 0x04FF00, head: list = None):
+	"""
+	Wraps a stream of result lines in a Paginator whose pages are embeds holding the lines in one field
+	:param title: Title of every page
+	:param description: Description of every page
+	:param field_name: Name of the field holding the results
+	:param lines: An iterable of formatted result strings
+	:param color: Embed color
+	:param head: Already built embeds shown before the result pages
+	:return: A Paginator for reaction_controlled_embed
+	"""
+	def build(text: str):
+		page = discord.Embed(title=title, color=color, description=description)
+		page.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		page.add_field(name=field_name, value=text, inline=True)
+		return page
+	return Paginator(lines, build, head=head)
+
+
+def home_state_files():
+	"""
+	:return: The paths of the home namespace's locations and members files and their journals, relative to
+	.resources
+	"""
+	if json_files['backend'] == 'sqlite':
+		paths = [storage_backend.path]
+	else:
+		paths = [file.path for file in store.files.values()]
+		paths += [journal_path(path) for path in paths]
+	return {os.path.relpath(path, backups.root) for path in paths}
+
+
+def restored_file(rel: str):
+	"""
+	:param rel: A backed up file's path relative to .resources
+	:return: True if restore puts the file back, the locations and members of the namespaces this process serves
+	"""
+	if rel in home_state_files():
+		return True
+	parts = rel.split(os.sep)
+	folder = os.path.relpath(json_files['guilds'], backups.root).split(os.sep)
+	return (len(parts) == len(folder) + 2 and parts[:len(folder)] == folder
+			and (owns is None or owns(parts[-2])))
+
+
+async def install_backup(staging: str, staged: list):
+	"""
+	Swaps the staged files of a backup in for the locations and members of the namespaces this process serves and
+	reloads them. Every other guild is evicted first, so they load the restored files on their next command.
+	:param staging: String path to the folder the backup was restored to
+	:param staged: The restored paths, relative to staging
+	:return: None
+	"""
+	for key in [key for key in guilds.guilds if key != home_key]:
+		await guilds.evict(key)
+	if guilds.closing:
+		await asyncio.wait(set(guilds.closing.values()))  # idle guilds still being closed by the eviction task
+	store.close()  # compacts the home journals, the restored files replace what they held
+	home = home_state_files()
+	live = {os.path.relpath(os.path.join(folder, name), backups.root)
+			for folder, _, names in os.walk(json_files['guilds']) for name in names}
+	for rel in (live | home) - set(staged):
+		# journals and guilds the backup didn't have yet, and the -wal files of closed guild databases
+		if restored_file(rel) and not (json_files['backend'] == 'sqlite' and rel in home):
+			try:
+				os.remove(os.path.join(backups.root, rel))
+			except FileNotFoundError:
+				pass
+	for rel in staged:
+		path = os.path.join(backups.root, rel)
+		if json_files['backend'] == 'sqlite' and rel in home:
+			# the home database stays open, its tables are copied over on the backend's thread
+			await storage_backend.restore_tables(os.path.join(staging, rel))
+			continue
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		os.replace(os.path.join(staging, rel), path)
+	store.load()
+
+
 """ Client Events """
 
 
@@ -279,8 +715,50 @@ async def on_ready():
 	# Sets activity status
 	await client.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=listening_to))
 	print(f'Client is listening to commands prefixed with {cmd_prefix}', end='\n')
-	# checks for status changes in members being online to update Members.json
-	await update_members(30, get_members_online(get_server_status(minecraft_server_ip)))
+	command_log.start(client.loop)
+	usage.start(client.loop, command_log, *shard_logs)  # counts the commands logged before this run, once
+	# pings the registered servers in the background and checks for members being online to update Members.json
+	servers.start(client.loop)
+	guilds.start(client.loop)
+	# samples event loop lag and writes the Prometheus metrics file every metrics_interval secs
+	metrics.start(client.loop, process_path(json_files['metrics'], shard.process), metrics_interval)
+	if api_port is not None:
+		await http_api.start(api_host, api_port + shard.process)  # each shard process serves its own guilds
+	if backup_interval and shard.owns(home_key):
+		backups.start(client.loop, backup_interval)  # read and compressed on the default executor's threads
+
+
+@client.before_invoke
+async def start_command_timer(ctx):
+	"""
+	Executed before every command, starts its latency timer
+	:param ctx: The context of the command called
+	:return: None
+	"""
+	ctx.metrics_start = time.perf_counter()
+
+
+@client.after_invoke
+async def finish_command_timer(ctx):
+	"""
+	Executed after every command, even a failed one, records commands that never replied and counts the outcome
+	:param ctx: The context of the command called
+	:return: None
+	"""
+	command_responded(ctx)
+	metrics.inc('mcdb_commands_total', command=ctx.command.name, result='failed' if ctx.command_failed else 'ok')
+
+
+@client.event
+async def on_reaction_add(reaction, user):
+	"""
+	Executed when a reaction is added to a cached message, passes it to the session controlling the message
+	:param reaction: The reaction added
+	:param user: The user who added it
+	:return: None
+	"""
+	if user != client.user:
+		reaction_dispatcher.dispatch(reaction.message.id, reaction.emoji, user)
 
 
 @client.event
@@ -299,7 +777,7 @@ async def on_message(message):
 
 @client.command(name='help', description='Provides users with a list of commands')
 async def help(ctx):
-	update_log('help', json_files["log"], ctx)
+	update_log('help', ctx)
 	await ctx.message.delete()
 
 	messages = []
@@ -308,12 +786,27 @@ async def help(ctx):
 									description=f"These are the commands available for use")
 	mcdb_commands.set_author(name=client.user.name, icon_url=client.user.avatar_url)
 	mcdb_commands.add_field(name=f"**Use {cmd_prefix}[command name][params]**", value='help\n'
-																				'add[dim, loc name, x, y, z]\n'
+																				'add[dim, loc name, x, y, z, (tags)]\n'
 																				'remove[loc name]\n'
-																				'find[loc name]\n'
-																				'random\n'
-																				'near[dim, x, y, z]\n'
-																				'server\n', inline=True)
+																				'find[name, (tag:x), (near:x,y,z)]\n'
+																				'random[(dim)]\n'
+																				'near[dim, x, y, z, (count), (cross)]\n'
+																				'within[dim, x, y, z, radius, (cross)]\n'
+																				'box[dim, x1, y1, z1, x2, y2, z2]\n'
+																				'route[dim, start, stops, (portals)]\n'
+																				'map[dim, x, z, (zoom)]\n'
+																				'import[(dim)] + attached file\n'
+																				'export[(dim), (json, jsonl, csv)]\n'
+																				'server[(ip)]\n'
+																				'seen[player]\n'
+																				'playtime[player, (range)]\n'
+																				'peak[(range)]\n'
+																				'usage[(command or user), (range)]\n'
+																				'stats\n'
+																				'restore[(time or id)]\n'
+																				'servers\n'
+																				'addserver[ip]\n'
+																				'removeserver[ip]\n', inline=True)
 	messages.append(mcdb_commands)
 	await reaction_controlled_embed(ctx, messages, 60)
 
@@ -326,9 +819,10 @@ async def add(ctx, *args):
 	:param args: All arguments following the add command
 	:return: None
 	"""
-	update_log(f'add {args}', json_files["log"], ctx)
+	update_log(f'add {args}', ctx)
 	await ctx.message.delete()
-	locs = load_json_data("./.resources/Locations.json")
+	guild = await guild_data(ctx)
+	locs = guild.store.locations
 
 	messages = []
 	# formatting error message
@@ -345,7 +839,9 @@ async def add(ctx, *args):
 								'Overworld Zombie Spawner:\n'
 								'O, Zombie Spawner, 53, 35, 639\n\n'
 								'Nether Bastian:\n'
-								'N Bastian -239 36 513```', inline=True)
+								'N Bastian -239 36 513\n\n'
+								'Tags may follow the coordinates:\n'
+								'N Bastian -239 36 513 loot piglins```', inline=True)
 
 	# formatting location name already exists
 	already_exists_err = discord.Embed(title=f'**NAME ALREADY IN USE**', color=0xFFFF00,
@@ -355,16 +851,18 @@ async def add(ctx, *args):
 	# checks to see that message is formatted correctly
 	new_loc = []
 	print(len(args))
-	if len(args) != 5:
+	if len(args) < 5:
 		messages.append(format_err)
 		await reaction_controlled_embed(ctx, messages, 20)
 		return
+	tags = parse_tags(args[5:])  # anything after the coordinates files the location under tags
+	args = args[:5]
 	for i in range(len(args)):
 		new_loc.append(args[i].lower().replace(",", ""))  # removes commas from all components
 		if i != 1:
 			new_loc[i].replace(" ", "")  # removes spaces from all components except for name
 	if new_loc[1] not in locs:
-		if new_loc[0].lower() == "o" or "n" or "e":
+		if parse_dimension(new_loc[0]) is not None:
 			try:
 				int(new_loc[2])
 				int(new_loc[3])
@@ -373,15 +871,8 @@ async def add(ctx, *args):
 				messages.append(format_err)
 				await reaction_controlled_embed(ctx, messages, 20)
 				return
-			if new_loc[0] == "o":
-				new_loc[0] = "overworld"
-			elif new_loc[0] == "n":
-				new_loc[0] = "nether"
-			else:
-				new_loc[0] = "end"
-			locs[new_loc[1]] = {"Dimension": new_loc[0], "X": int(new_loc[2]), "Y": int(new_loc[3]),
-								"Z": int(new_loc[4])}
-			dump_json_data(locs, json_files['locations'])
+			new_loc[0] = parse_dimension(new_loc[0])
+			guild.store.add_location(new_loc[1], new_loc[0], int(new_loc[2]), int(new_loc[3]), int(new_loc[4]), tags)
 		else:
 			print(new_loc[0])
 			messages.append(format_err)
@@ -400,10 +891,8 @@ async def remove(ctx, *args):
 	:param args: The name of the location to be removed
 	:return: None
 	"""
-	update_log(f'remove {args}', json_files["log"], ctx)
+	update_log(f'remove {args}', ctx)
 	await ctx.message.delete()
-	locs = load_json_data("./.resources/Locations.json")
-
 	# formatting location name already exists
 	unknown_loc_err = discord.Embed(title=f'**UNKNOWN LOCATION**', color=0xFF9E00,
 									   description='The name you tried to remove does not exist in the database')
@@ -416,76 +905,141 @@ async def remove(ctx, *args):
 
 	messages = []
 	if ctx.message.author.id in authorized_users.values():
-		flag = locs.pop(args, None)
+		flag = (await guild_data(ctx)).store.remove_location(' '.join(args).lower())
 		if not flag:
 			messages.append(unknown_loc_err)
 			await reaction_controlled_embed(ctx, messages, 20)
-			return
-		dump_json_data(locs, json_files['locations'])
 		return
 	messages.append(unauth_user_err)
 	await reaction_controlled_embed(ctx, messages, 20)
 
 
-@client.command(name='find', description='Returns location data of all POI having names which contain the input name')
+@client.command(name='find', description='Returns location data of all POI having names which contain or are\
+similar to the input name')
 async def find(ctx, *args):
 	"""
-	Finds and returns all locations in Locations.json that contain the search query in their name
+	Finds and returns the locations whose names match the search query, best matches first
 	:param ctx: The message context
 	:param args: The query term being searched
 	:return: None
 	"""
-	update_log(f'find {args}', json_files["log"], ctx)
+	update_log(f'find {args}', ctx)
 	await ctx.message.delete()
-	query = ''
-	try:
-		for i in args:
-			query += i.lower()
-		locs = load_json_data(json_files['locations'])
-		flag = True
-		location_string = f''
-		for i in locs:
-			if query in i:
-				location_string += f'***{i}***\n*dim:* **{locs[i]["Dimension"]}**, *x:* **{locs[i]["X"]}**,\
-				 *y:* **{locs[i]["Y"]}**, *z:* **{locs[i]["Z"]}**\n'
-				if flag:
-					flag = False  # sets flag to false so we know not to send an unknown_loc_err
-	except IndexError:
-		query = False
+	guild = await guild_data(ctx)
+	locs = guild.store.locations
+
+	facets = parse_facets(args)
+	if facets is None:
+		# formatting format error message
+		format_err = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
+								   description="The search provided was not formatted correctly")
+		format_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		format_err.add_field(name=f'***EXAMPLES:***', value='name [tag:tag ...] [near:x,y,z] [within:radius]\n\n\
+		**Example:**\n blaze tag:spawner tag:nether near:0,64,0 within:500', inline=True)
+		await reaction_controlled_embed(ctx, [format_err], 20)
+		return
+	tags, point, radius, words = facets
+	query = ' '.join(' '.join(words).lower().replace(",", "").split())
+	if tags or point is not None:
+		await find_facets(ctx, guild, tags, query, point, radius)
+		return
+
+	def search(offset: int):
+		return cached_query(guild, ('find', query, offset),
+							lambda: guild.search_index.search(query, limit=search_chunk, offset=offset))
+	total, found = await run_query(guild, ('find', query, 0), 'search', query, limit=search_chunk, offset=0)
 
 	messages = []
 	# formatting unknown location error
 	unknown_loc_err = discord.Embed(title=f'**UNKNOWN LOCATION**', color=0xFF9E00,
 									description='The name you tried to find does not exist in the database')
 	unknown_loc_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
-	if flag or not query:
+	if not found:
 		messages.append(unknown_loc_err)
 		await reaction_controlled_embed(ctx, messages, 20)
 		return
 
+	def location_lines():
+		# ranks the next chunk of matches only when the user pages past the ones already fetched
+		chunk, offset = found, 0
+		while True:
+			for kind, loc in chunk:
+				if loc in locs:
+					yield format_location(loc, locs[loc])
+			if len(chunk) < search_chunk:
+				return
+			offset += search_chunk
+			chunk = search(offset)[1]
+
 	# formatting valid locations
-	valid_locations = discord.Embed(title=f'**REQUESTED LOCATIONS**', color=0x04FF00,
-									description=f"These are the stored locations that had names similar to '{query}'")
-	valid_locations.set_author(name=client.user.name, icon_url=client.user.avatar_url)
-	valid_locations.add_field(name=f"**Locations related to '{query}':**", value=location_string, inline=True)
+	valid_locations = result_pages('**REQUESTED LOCATIONS**',
+								   f"{total} stored locations had names similar to '{query}'",
+								   f"**Locations related to '{query}':**", location_lines())
+	await reaction_controlled_embed(ctx, valid_locations, 60)
 
-	messages.append(valid_locations)
-	await reaction_controlled_embed(ctx, messages, 60)
+
+async def find_facets(ctx, guild, tags: list, query: str, point: tuple, radius: int):
+	"""
+	Sends the locations matching a find query's tag, name and distance facets
+	:param ctx: The message context
+	:param guild: The GuildData
+	:param tags: Tags the locations must all have
+	:param query: Text the names must contain, '' for any name
+	:param point: (x, y, z) to order the locations by distance from, None to order them by name
+	:param radius: Most blocks from the point, None for any distance
+	:return: None
+	"""
+	locs = guild.store.locations
+	generation = guild.store.generation
+	key = ('facets', tuple(tags), query, point, radius)
+	found = guild.query_cache.get(key, generation)
+	if found is missing:
+		# large guilds intersect the facets on the worker pool, like find's name search
+		found = await worker_pool.facets(guild.snapshots, generation, guild, tags, query, point, radius)
+		guild.query_cache.put(key, generation, found)
+	facets = [f"tagged {', '.join(tags)}"] if tags else []
+	if query:
+		facets.append(f"named like '{query}'")
+	if point is not None:
+		facets.append(f"within {radius} blocks of {', '.join(map(str, point))}" if radius is not None else
+					  f"nearest {', '.join(map(str, point))} first")
+
+	if not found:
+		# formatting no matches error
+		no_match_err = discord.Embed(title=f'**UNKNOWN LOCATION**', color=0xFF9E00,
+									 description=f"No stored locations are {' and '.join(facets)}")
+		no_match_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [no_match_err], 20)
+		return
+
+	found_lines = (format_location(loc, locs[loc], dist) for dist, loc in found if loc in locs)
+	found_pages = result_pages('**REQUESTED LOCATIONS**', f"{len(found)} stored locations {', '.join(facets)}",
+							   '***Matching:***', found_lines)
+	await reaction_controlled_embed(ctx, found_pages, 60)
 
 
 @client.command(name='random', description='Returns a random location, if dimension is specified a random location in\
 that dimension is returned')
-async def random(ctx):
+async def random(ctx, *args):
 	"""
 	Provides a randomly selected location from Locations.json
 	:param ctx: The message context
+	:param args: Optionally the dimension to pick from
 	:return: None
 	"""
-	update_log('random', json_files["log"], ctx)
+	update_log(f'random {args}', ctx)
 	await ctx.message.delete()
-	locs = load_json_data(json_files['locations'])
-
-	choice = rand.choice(list(locs.items()))
+	guild = await guild_data(ctx)
+
+	dim = parse_dimension(args[0]) if args else None
+	choice = random_location(guild, dim) if not args or dim is not None else None
+	if choice is None:
+		no_locs_err = discord.Embed(title=f'**UNKNOWN LOCATION**', color=0xFF9E00,
+									description='There are no stored locations to pick from' if not args or dim
+									else 'Supply an optional dimension, i.e. random n')
+		no_locs_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [no_locs_err], 20)
+		return
 
 	messages = []
 	# formatting selected location
@@ -499,79 +1053,373 @@ async def random(ctx):
 	await reaction_controlled_embed(ctx, messages, 60)
 
 
-@client.command(name='near', description='Returns the five closest location in the same dimension as the input\
+@client.command(name='near', description='Returns the closest locations in the same dimension as the input\
 coordinates')
 async def near(ctx, *args):
 	"""
-	Returns the five nearest locations in the same dimension as the input coordinates
+	Returns the nearest locations in the same dimension as the input coordinates
 	:param ctx: The message context
-	:param args: The reference location
+	:param args: The reference location, an optional number of results and an optional cross flag
 	:return: None
 	"""
-	update_log(f'near {args}', json_files["log"], ctx)
+	update_log(f'near {args}', ctx)
 	await ctx.message.delete()
-	locs = load_json_data(json_files['locations'])
+	guild = await guild_data(ctx)
+	locs = guild.store.locations
 
 	messages = []
 	# formatting format error message
 	format_err = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
 									  description="The location data provided was not formatted correctly")
 	format_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
-	format_err.add_field(name=f'***EXAMPLES:***', value='dimension, x-coord, y-coord, z-coord\nor\
-	\ndimension x-coord y-coord z-coord\n\n\
-	**Example:**\n o, 100, 72, -3200\nor\nN -67 -84 -900', inline=True)
+	format_err.add_field(name=f'***EXAMPLES:***', value='dimension, x-coord, y-coord, z-coord, [count], [cross]\nor\
+	\ndimension x-coord y-coord z-coord [count] [cross]\n\n\
+	**Example:**\n o, 100, 72, -3200\nor\nN -67 -84 -900 10 cross', inline=True)
+
+	# cross also searches the linked dimension using the 8:1 nether/overworld scale
+	cross = len(args) > 0 and args[-1].lower() == 'cross'
+	if cross:
+		args = args[:-1]
+	dim = parse_dimension(args[0]) if args else None
+	coords = parse_coords(args[1:])
+	if dim is None or coords is None or len(coords) not in (3, 4):
+		messages.append(format_err)
+		await reaction_controlled_embed(ctx, messages, 20)
+		return
+	k = coords.pop() if len(coords) == 4 else 5
+	k = max(1, min(k, 100))
 
-	if len(args) != 4:
+	nearest = await run_query(guild, ('near', dim, *coords, k, cross), 'nearest', dim, *coords, k=k, cross=cross)
+	near_by_lines = (format_location(loc, locs[loc], dist) for dist, loc, _ in nearest if loc in locs)
+
+	# formatting near by messages
+	near_by_pages = result_pages('**NEAREST LOCATIONS**', f"A list of the nearest locations to the input coordinates",
+								 '***Near by:***', near_by_lines)
+	await reaction_controlled_embed(ctx, near_by_pages, 60)
+
+
+@client.command(name='within', description='Returns the locations within a radius of the input coordinates')
+async def within(ctx, *args):
+	"""
+	Returns the locations within a radius of the input coordinates, nearest first
+	:param ctx: The message context
+	:param args: The reference location, the radius and an optional cross flag
+	:return: None
+	"""
+	update_log(f'within {args}', ctx)
+	await ctx.message.delete()
+	guild = await guild_data(ctx)
+	locs = guild.store.locations
+
+	messages = []
+	# formatting format error message
+	format_err = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
+							   description="The location data provided was not formatted correctly")
+	format_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+	format_err.add_field(name=f'***EXAMPLES:***', value='dimension x-coord y-coord z-coord radius [cross]\n\n\
+	**Example:**\n o, 100, 72, -3200, 500\nor\nN -67 -84 -900 100 cross', inline=True)
+
+	cross = len(args) > 0 and args[-1].lower() == 'cross'
+	if cross:
+		args = args[:-1]
+	dim = parse_dimension(args[0]) if args else None
+	coords = parse_coords(args[1:])
+	if dim is None or coords is None or len(coords) != 4 or coords[3] < 0:
 		messages.append(format_err)
 		await reaction_controlled_embed(ctx, messages, 20)
 		return
 
-	try:
-		int(args[1])
-		int(args[2])
-		int(args[3])
-	except ValueError:
+	found = await run_query(guild, ('within', dim, *coords, cross), 'within', dim, *coords, cross=cross)
+	within_lines = (format_location(loc, locs[loc], dist) for dist, loc, _ in found if loc in locs)
+
+	within_pages = result_pages('**LOCATIONS IN RANGE**',
+								f"{len(found)} locations within {coords[3]} blocks, nearest shown first",
+								'***In range:***', within_lines)
+	await reaction_controlled_embed(ctx, within_pages, 60)
+
+
+@client.command(name='box', description='Returns the locations inside a box between two corner coordinates')
+async def box(ctx, *args):
+	"""
+	Returns the locations inside the axis aligned box between two corners
+	:param ctx: The message context
+	:param args: The dimension followed by the coordinates of two opposite corners
+	:return: None
+	"""
+	update_log(f'box {args}', ctx)
+	await ctx.message.delete()
+	guild = await guild_data(ctx)
+	locs = guild.store.locations
+
+	messages = []
+	# formatting format error message
+	format_err = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
+							   description="The location data provided was not formatted correctly")
+	format_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+	format_err.add_field(name=f'***EXAMPLES:***', value='dimension x1 y1 z1 x2 y2 z2\n\n\
+	**Example:**\n o, -100, 0, -100, 100, 255, 100', inline=True)
+
+	dim = parse_dimension(args[0]) if args else None
+	coords = parse_coords(args[1:])
+	if dim is None or coords is None or len(coords) != 6:
 		messages.append(format_err)
 		await reaction_controlled_embed(ctx, messages, 20)
 		return
 
-	def key_func(loc: tuple):
-		return loc[1]
-
-	distances = []
-	for i in locs:
-		if locs[i]["Dimension"][0] == args[0].lower():
-			distances.append(get_distance(i, locs[i]["X"], locs[i]["Y"], locs[i]["Z"],
-										  int(args[1]), int(args[2]), int(args[3])))
-	distances.sort(key=key_func, reverse=True)
-	near_by_list = ''
-	for i in range(5):
-		if not distances:
-			break
-		loc = distances.pop()[0]
-		near_by_list += f'***{loc}***\n*dim:* **{locs[loc]["Dimension"]}**,\
-	 *x:* **{locs[loc]["X"]}**, *y:* **{locs[loc]["Y"]}**, *z:* **{locs[loc]["Z"]}**\n'
-
-	# formatting near by message
-	near_by_msg = discord.Embed(title='**NEAREST LOCATIONS**', color=0x04FF00,
-								description=f"A list of the nearest locations to the input coordinates")
-	near_by_msg.set_author(name=client.user.name, icon_url=client.user.avatar_url)
-	near_by_msg.add_field(name=f'***Near by:***', value=near_by_list, inline=True)
-	messages.append(near_by_msg)
-	await reaction_controlled_embed(ctx, messages, 60)
+	if hasattr(guild.backend, 'locations_in_box'):
+		found = sorted(await guild.backend.locations_in_box(dim, *coords))
+	else:
+		found = sorted(await run_query(guild, ('box', dim, *coords), 'box', dim, *coords))
+	box_lines = (format_location(loc, locs[loc]) for loc in found if loc in locs)
+
+	box_pages = result_pages('**LOCATIONS IN AREA**', f"{len(found)} locations inside the requested area",
+							 '***In area:***', box_lines)
+	await reaction_controlled_embed(ctx, box_pages, 60)
+
+
+@client.command(name='route', description='Orders a trip from a stored location through several others, optionally\
+ through the locations tagged as Nether portals')
+async def route(ctx, *args):
+	"""
+	Returns a short order to visit stored locations in, and the distance of each leg
+	:param ctx: The message context
+	:param args: The dimension travelled in, the starting location, the locations to visit and an optional portals
+	flag to also travel through the locations tagged with portal_tag
+	:return: None
+	"""
+	update_log(f'route {args}', ctx)
+	await ctx.message.delete()
+	guild = await guild_data(ctx)
+	locs = guild.store.locations
+
+	messages = []
+	# formatting format error message
+	format_err = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
+							   description="The route provided was not formatted correctly")
+	format_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+	format_err.add_field(name=f'***EXAMPLES:***', value=f'dimension start stop [stop ...] [portals]\n\n\
+	**Example:**\n o spawn "zombie spawner" village\nor\no spawn bastion fortress portals\n\n\
+	Names with spaces go in quotes, at most {max_route_stops} stops. portals travels through the Nether portals, the \
+locations tagged {portal_tag}, i.e. add n "spawn portal" 10 64 20 {portal_tag}', inline=True)
+
+	# portals also travels through the guild's nether portals, every block walked counting once whichever dimension
+	# it is in, so a block walked in the nether covers 8 in the overworld
+	portals = len(args) > 0 and args[-1].lower() == 'portals'
+	if portals:
+		args = args[:-1]
+	dim = parse_dimension(args[0]) if args else None
+	names = [arg.lower().replace(",", "") for arg in args[1:]]
+	if dim is None or len(names) < 2 or len(names) - 1 > max_route_stops:
+		messages.append(format_err)
+		await reaction_controlled_embed(ctx, messages, 20)
+		return
+
+	# formatting unknown or unreachable locations
+	unknown = [name for name in names if name not in locs or position(locs[name], dim) is None]
+	if unknown:
+		unknown_err = discord.Embed(title='**UNKNOWN LOCATION**', color=0xFF9E00,
+									description=f"These locations don't exist or can't be reached from the {dim}")
+		unknown_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		unknown_err.add_field(name='***Not found:***', value='\n'.join(unknown)[:1024], inline=True)
+		messages.append(unknown_err)
+		await reaction_controlled_embed(ctx, messages, 20)
+		return
+
+	total, legs = guild.routes.route(locs, dim, names[0], names[1:], portals)
+
+	def route_line(step: int, name: str, leg: float, via: tuple):
+		line = f'**{step}.** ' + format_location(name, locs[name], leg if step else None)
+		if via is not None:
+			line += f'*via:* **{via[0]}** to **{via[1]}**\n'
+		return line
+
+	route_lines = (route_line(step, *leg) for step, leg in enumerate(legs))
+	portal_note = ', through the nether portals' if portals and guild.routes.portals else ''
+	route_pages = result_pages('**ROUTE**', f"{len(legs) - 1} stops, {round(total)} blocks in the {dim}{portal_note}",
+							   '***Visit in order:***', route_lines)
+	await reaction_controlled_embed(ctx, route_pages, 60)
+
+
+async def download_attachment(attachment: discord.Attachment, path: str):
+	"""
+	Streams an attachment to a file in chunks so it is never held in memory whole
+	:param attachment: The message attachment
+	:param path: String path to write it to
+	:return: None
+	"""
+	with metrics.timer('mcdb_io_seconds', op='attachment_download'):
+		async with aiohttp.ClientSession() as session:
+			async with session.get(attachment.url) as response:
+				response.raise_for_status()
+				with open(path, 'wb') as file_w:
+					async for chunk in response.content.iter_chunked(64 * 1024):
+						file_w.write(chunk)
+
+
+@client.command(name='map', description='Returns a map of the stored locations around a position')
+async def map_locations(ctx, *args):
+	"""
+	Draws the stored locations around a position from the guild's cached map tiles
+	:param ctx: Command context passed
+	:param args: The dimension, x and z of the position and an optional zoom
+	:return: None
+	"""
+	update_log(f'map {args}', ctx)
+	await ctx.message.delete()
+	if TileCache is None:
+		no_map = discord.Embed(title='**MAP UNAVAILABLE**', color=0xFF9E00,
+							   description='Maps need the Pillow package, which isn\'t installed where the bot runs')
+		no_map.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [no_map], 20)
+		return
+	guild = await guild_data(ctx)
+
+	dim = parse_dimension(args[0]) if args else None
+	coords = parse_coords(args[1:])
+	if coords is not None and len(coords) == 2:
+		coords.append(2)
+	if dim is None or coords is None or len(coords) != 3 or not 0 <= coords[2] <= max_zoom:
+		format_err = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
+								   description=f'Supply a dimension, x and z and optionally a zoom from 0 to \
+{max_zoom}, i.e. o, 100, -250, 3. Each zoom level out halves the scale, at {max_zoom} a pixel is one block.')
+		format_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [format_err], 20)
+		return
+
+	x, z, zoom = coords
+	png = await guild.tiles.view(guild.spatial_index.grids.get(dim), dim, x, z, zoom)
+	map_embed = discord.Embed(title=f'**{dim.upper()} MAP**', color=0x04FF00,
+							  description=f'Stored locations around {x}, {z}, the blue cross is the given position')
+	map_embed.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+	map_embed.set_image(url='attachment://map.png')
+	await reaction_controlled_embed(ctx, [map_embed], 120, file=discord.File(io.BytesIO(png), 'map.png'))
+
+
+@client.command(name='import', description='Adds every location in an attached CSV, JSON, JSON-lines or waypoint\
+ file to the database')
+async def import_locations(ctx, *args):
+	"""
+	Reads an attached location file off the event loop, validates every row and adds the valid ones in one write
+	:param ctx: Command context passed
+	:param args: Optionally the dimension for rows that don't give one, such as Xaero's waypoint files
+	:return: None
+	"""
+	update_log(f'import {args}', ctx)
+	guild = await guild_data(ctx)
+	attachment = ctx.message.attachments[0] if ctx.message.attachments else None
+	default_dim = parse_dimension(args[0]) if args else None
+
+	# formatting error messages
+	error = None
+	if ctx.message.author.id not in authorized_users.values():
+		error = discord.Embed(title=f'**UNAUTHORIZED USER**', color=0xFFFF00,
+							  description='This command is only for use by certain users')
+	elif attachment is None or len(args) > 1 or (args and default_dim is None):
+		error = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
+							  description='Attach a .csv, .json, .jsonl, Xaero .txt or VoxelMap .points file, \
+optionally giving the dimension for rows without one, i.e. import n')
+	elif attachment.size > max_import_bytes:
+		error = discord.Embed(title='**FILE TOO LARGE**', color=0xFF9E00,
+							  description=f'Files may be at most {max_import_bytes // (1024 * 1024)}MB')
+	if error is not None:
+		await ctx.message.delete()
+		error.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [error], 20)
+		return
+
+	with tempfile.TemporaryDirectory() as folder:
+		path = os.path.join(folder, 'import')
+		# downloaded before the message is deleted, which also deletes the attachment
+		await download_attachment(attachment, path)
+		await ctx.message.delete()
+		with metrics.timer('mcdb_io_seconds', op='import_parse'):
+			fmt, rows, errors = await worker_pool.cpu('import', read_locations, path, attachment.filename,
+													  default_dim, max_import_rows)
+
+	locs = guild.store.locations
+	errors += [(row_no, f'{row[0]} is already stored') for row_no, row in rows if row[0] in locs]
+	added = guild.store.add_locations(row for _, row in rows if row[0] not in locs)  # one write for every row
+	await guild.store.durable()  # the summary is only sent once the rows are synced
+	errors.sort()
+
+	summary = discord.Embed(title='**LOCATIONS IMPORTED**', color=0x04FF00 if added else 0xFF9E00,
+							description=f'Added {len(added)} of {len(added) + len(errors)} rows from \
+{attachment.filename} ({fmt}), {len(errors)} rows had errors')
+	summary.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+	error_lines = (f"*row {row_no}:* {message}\n" if row_no else f"{message}\n" for row_no, message in errors)
+	import_pages = result_pages('**IMPORT ERRORS**', f'Rows of {attachment.filename} that were not added',
+								'**Errors**', error_lines, color=0xFF9E00, head=[summary]) if errors else [summary]
+	await reaction_controlled_embed(ctx, import_pages, 60)
+
+
+@client.command(name='export', description='Sends the database, or one dimension of it, as a gzipped attachment')
+async def export_locations(ctx, *args):
+	"""
+	Writes the stored locations to a gzipped file off the event loop and sends it as an attachment
+	:param ctx: Command context passed
+	:param args: Optionally a dimension and a format, json (the Locations.json layout), jsonl or csv
+	:return: None
+	"""
+	update_log(f'export {args}', ctx)
+	await ctx.message.delete()
+	guild = await guild_data(ctx)
+
+	dim, fmt = None, 'json'
+	for arg in args:
+		if arg.lower() in export_formats:
+			fmt = arg.lower()
+		elif parse_dimension(arg) is not None:
+			dim = parse_dimension(arg)
+		else:
+			format_err = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
+									   description='Optionally supply a dimension and a format of json, jsonl or \
+csv, i.e. export n csv')
+			format_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+			await reaction_controlled_embed(ctx, [format_err], 20)
+			return
+
+	filename = f'Locations{"-" + dim if dim else ""}.{fmt}.gz'
+	with tempfile.TemporaryDirectory() as folder:
+		path = os.path.join(folder, filename)
+		with metrics.timer('mcdb_io_seconds', op='export_write'):
+			# written by a worker from a snapshot, so adds and removes made meanwhile don't change what it reads
+			count = await worker_pool.export(guild.snapshots, guild.store.generation, path, dim, fmt)
+		if os.path.getsize(path) > max_export_bytes:
+			too_large_err = discord.Embed(title='**EXPORT TOO LARGE**', color=0xFF9E00,
+										  description='The compressed export is over Discord\'s attachment limit, \
+try exporting one dimension at a time')
+			too_large_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+			await reaction_controlled_embed(ctx, [too_large_err], 20)
+			return
+		await ctx.send(f'{ctx.author.mention} {count} locations', file=discord.File(path, filename=filename))
+	command_responded(ctx)
 
 
 @client.command(name='server', description='Returns server and player info at the time of request')
-async def server(ctx):
+async def server(ctx, *args):
 	"""
 	Responds to a call of the server command by a user and supplies server and member statuses
 	:param ctx: Command context passed
+	:param args: Optionally the ip of one of the guild's registered servers, defaults to the first registered
 	:return: None
 	"""
-	update_log('server', json_files["log"], ctx)
+	update_log(f'server {args}', ctx)
 	await ctx.message.delete()  # deletes users message to prevent buildup of commands
 
-	status = get_server_status(minecraft_server_ip)
+	entry = await guild_server(ctx, args[0] if args else None)
+	if entry is None:
+		return
+
+	# shares the poller's cached status, only pinging if it is stale
+	status = await entry.poller.get(max_age=status_max_age)
+
+	# formatting unreachable server error
+	if status is None:
+		unreachable_err = discord.Embed(title=f'**SERVER UNREACHABLE**', color=0xFF9E00,
+										description=f'{entry.ip} did not respond, try again later')
+		unreachable_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [unreachable_err], 20)
+		return
 
 	num_members_online = status.players.online
 	server_latency = status.latency  # in ms
@@ -588,29 +1436,370 @@ async def server(ctx):
 	else:
 		server_desc = ''
 
-	member_info = updated_member_info(json_files['members'], members_online)
-
-	# list of embedded messages to be sent
-	messages = []
+	member_info = updated_member_info(entry, members_online)
 
-	server_info = discord.Embed(title=f'**{minecraft_server_ip} SERVER INFO**',
+	server_info = discord.Embed(title=f'**{entry.ip} SERVER INFO**',
 			description=f"*{server_desc}*", color=0xBA74EE)
 	server_info.set_author(name=client.user.name, icon_url=client.user.avatar_url)
 	server_info.add_field(name=f"**Server Info**",
-					value=f'***Latency:*** {server_latency}ms\n***Total Members:*** {member_info[0]}\n\
-					***Members online:*** {num_members_online}\n***Admin Online***: {member_info[1]}\n\n\n\nPage 1/2',
-						  inline=True)
-	messages.append(server_info)
+					value=f'***Latency:*** {server_latency}ms\n***Checked:*** {round(entry.poller.age)}s ago\n\
+					***Total Members:*** {member_info[0]}\n***Members online:*** {num_members_online}\n\
+					***Admin Online***: {member_info[1]}', inline=True)
 
-	member_status = discord.Embed(title=f'**{minecraft_server_ip} MEMBER STATUS**',
-					description=f"*{server_desc}*", color=0xBA74EE)
-	member_status.set_author(name=client.user.name, icon_url=client.user.avatar_url)
-	member_status.add_field(name='**Member Status**', value=member_info[2], inline=True)
-	messages.append(member_status)
+	# member status pages follow the server info page and are built as the user pages to them
+	messages = result_pages(f'**{entry.ip} MEMBER STATUS**', f"*{server_desc}*", '**Member Status**',
+							member_info[2], color=0xBA74EE, head=[server_info])
 
 	# loop to send embedded messages and allow for reaction controls
 	await reaction_controlled_embed(ctx, messages, 60)
 
 
+@client.command(name='seen', description='Returns when a player was last online on the guild\'s server')
+async def seen(ctx, *args):
+	"""
+	Looks up when a player was last online in the server's presence history
+	:param ctx: Command context passed
+	:param args: The player name
+	:return: None
+	"""
+	update_log(f'seen {args}', ctx)
+	await ctx.message.delete()
+
+	if len(args) != 1:
+		format_err = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
+								   description='Supply just the player name, i.e. Notch')
+		format_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [format_err], 20)
+		return
+	entry = await guild_server(ctx)
+	if entry is None:
+		return
+
+	seen_info = discord.Embed(title=f'**{args[0]} LAST SEEN**', color=0xBA74EE,
+							  description=f'{last_seen(entry, args[0])} on {entry.ip}')
+	seen_info.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+	await reaction_controlled_embed(ctx, [seen_info], 60)
+
+
+@client.command(name='playtime', description='Returns how long a player has been online on the guild\'s server')
+async def playtime(ctx, *args):
+	"""
+	Sums a player's sessions in the server's presence history
+	:param ctx: Command context passed
+	:param args: The player name and an optional range such as 12h, 7d or all, defaults to all
+	:return: None
+	"""
+	update_log(f'playtime {args}', ctx)
+	await ctx.message.delete()
+
+	start = parse_range(args[1]) if len(args) == 2 else 0
+	if len(args) not in (1, 2) or start is None:
+		format_err = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
+								   description='Supply the player name and optionally a range in m, h, d or w, \
+i.e. Notch 7d')
+		format_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [format_err], 20)
+		return
+	entry = await guild_server(ctx)
+	if entry is None:
+		return
+
+	span = f'in the last {args[1].lower()}' if start else 'in total'
+	playtime_info = discord.Embed(title=f'**{args[0]} PLAYTIME**', color=0xBA74EE,
+								  description=f'{format_duration(entry.presence.playtime(args[0], start))} \
+on {entry.ip} {span}')
+	playtime_info.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+	await reaction_controlled_embed(ctx, [playtime_info], 60)
+
+
+@client.command(name='peak', description='Returns the most players online at once on the guild\'s server')
+async def peak(ctx, *args):
+	"""
+	Finds the highest online count in the server's presence history
+	:param ctx: Command context passed
+	:param args: An optional range such as 12h, 7d or all, defaults to all
+	:return: None
+	"""
+	update_log(f'peak {args}', ctx)
+	await ctx.message.delete()
+
+	start = parse_range(args[0]) if len(args) == 1 else 0
+	if len(args) > 1 or start is None:
+		format_err = discord.Embed(title='**FORMATTING ERROR**', color=0x0051FF,
+								   description='Optionally supply a range in m, h, d or w, i.e. 24h')
+		format_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [format_err], 20)
+		return
+	entry = await guild_server(ctx)
+	if entry is None:
+		return
+
+	span = f'in the last {args[0].lower()}' if start else 'in total'
+	found = entry.presence.peak(start)
+	if found is None:
+		description = f'No players have been recorded on {entry.ip} yet'
+	else:
+		count, at = found
+		description = f'**{count}** players online {span}, first reached \
+{datetime.fromtimestamp(at).strftime("%m/%d/%Y %H:%M:%S")}'
+	peak_info = discord.Embed(title=f'**{entry.ip} PEAK PLAYERS**', color=0xBA74EE, description=description)
+	peak_info.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+	await reaction_controlled_embed(ctx, [peak_info], 60)
+
+
+@client.command(name='usage', description='Returns how often commands were used in this guild')
+async def usage_command(ctx, *args):
+	"""
+	Answers usage queries from the hourly and daily rollups without reading the command log
+	:param ctx: Command context passed
+	:param args: An optional command name or user name followed by an optional range, defaults to all
+	:return: None
+	"""
+	update_log(f'usage {args}', ctx)
+	await ctx.message.delete()
+
+	start = parse_range(args[-1]) if args else None
+	target = ' '.join(args[:-1] if start is not None else args).lower()
+	start = start or 0
+	scope = guilds.key(guild_id(ctx))
+	kind, key = 'all', ''
+	if target in client.all_commands:
+		kind, key = 'command', client.all_commands[target].name
+	elif target:
+		# user names are logged as name#discriminator, either the whole name or the part before the # matches
+		matches = [user for user in usage.users(scope) if target in (user.lower(), user.lower().rsplit('#', 1)[0])]
+		if not matches:
+			unknown_err = discord.Embed(title='**UNKNOWN COMMAND OR USER**', color=0xFF9E00,
+										description=f'{target} is not a command or a user who has used one here. \
+Optionally supply a range in m, h, d or w after it, i.e. 7d')
+			unknown_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+			await reaction_controlled_embed(ctx, [unknown_err], 20)
+			return
+		kind, key = 'user', matches[0]
+
+	span = f'in the last {args[-1].lower()}' if start else 'in total'
+	total = usage.count(scope, kind, key, start)
+	headings = {'all': ('**COMMAND USAGE**', f'**{total}** commands were used {span}'),
+				'command': (f'**{key.upper()} USAGE**', f'{cmd_prefix}{key} was used **{total}** times {span}'),
+				'user': (f'**{key.upper()} USAGE**', f'{key} used **{total}** commands {span}')}
+
+	def usage_lines():
+		if kind != 'user':
+			yield '**Top users**\n'
+			for user, count in usage.top(scope, 'user', start, command=key or None)[:10]:
+				yield f'***{user}***: **{count}**\n'
+		if kind != 'command':
+			yield '**Top commands**\n'
+			for command, count in usage.top(scope, 'command', start, user=key or None)[:10]:
+				yield f'***{command}***: **{count}**\n'
+		if start and time.time() - start <= 31 * 86400:  # longer ranges would be pages of empty days
+			hourly = time.time() - start <= 2 * 86400
+			yield '**Activity**\n'
+			for at, count in usage.series(scope, kind, key, start):
+				if count:  # days are UTC days, hours are shown in local time
+					stamp = (datetime.fromtimestamp(at).strftime("%m/%d %H:00") if hourly else
+							 datetime.fromtimestamp(at, timezone.utc).strftime("%m/%d/%Y"))
+					yield f'*{stamp}*: **{count}**\n'
+
+	title, description = headings[kind]
+	usage_pages = result_pages(title, description, '**Usage**', usage_lines(), color=0xBA74EE)
+	await reaction_controlled_embed(ctx, usage_pages, 60)
+
+
+@client.command(name='servers', description='Returns the status of every server registered in this guild')
+async def servers_status(ctx):
+	"""
+	Pings every server registered by the guild at once and lists which are online
+	:param ctx: Command context passed
+	:return: None
+	"""
+	update_log('servers', ctx)
+	await ctx.message.delete()
+
+	registered = servers.for_guild(guilds.key(guild_id(ctx)))
+	statuses = await servers.ping(registered, max_age=status_max_age)
+
+	def server_lines():
+		for entry, status in zip(registered, statuses):
+			if status is None:
+				yield f"***{entry.ip}***  {emojis['offline']}\n*unreachable*\n"
+			else:
+				yield f"***{entry.ip}***  {emojis['online']}\n*players:* **{status.players.online}**, \
+*latency:* **{round(status.latency)}ms**\n"
+
+	server_pages = result_pages('**REGISTERED SERVERS**', f"{len(registered)} servers registered in this guild",
+								'**Servers**', server_lines(), color=0xBA74EE)
+	await reaction_controlled_embed(ctx, server_pages, 60)
+
+
+@client.command(name='stats', description='Returns the bot\'s latency, I/O and Discord API statistics')
+async def stats(ctx):
+	"""
+	Shows the recorded metrics to authorized users
+	:param ctx: Command context passed
+	:return: None
+	"""
+	update_log('stats', ctx)
+	await ctx.message.delete()
+
+	if ctx.message.author.id not in authorized_users.values():
+		unauth_user_err = discord.Embed(title=f'**UNAUTHORIZED USER**', color=0xFFFF00,
+										description='This command is only for use by certain users')
+		unauth_user_err.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [unauth_user_err], 20)
+		return
+
+	def ms(secs):
+		return f'{secs * 1000:.1f}ms' if secs is not None else '-'
+
+	sections = [  # (heading, histogram, label naming each row)
+		('Commands', 'mcdb_command_seconds', 'command'),
+		('Storage', 'mcdb_io_seconds', 'op'),
+		('Server pings', 'mcdb_ping_seconds', 'result'),
+		('Embed builds', 'mcdb_embed_build_seconds', None),
+		('Page turns', 'mcdb_page_turn_seconds', None),
+		('Worker pool', 'mcdb_worker_seconds', 'op'),
+		('Discord API', 'mcdb_discord_request_seconds', 'route'),
+		('Event loop lag', 'mcdb_event_loop_lag_seconds', None)
+	]
+
+	def stats_lines():
+		for heading, name, label in sections:
+			rows = metrics.summary(name)
+			if rows:
+				yield f'**{heading}**\n'
+			for labels, count, p50, p99, total in rows:
+				row = labels.get(label, '') if label else 'all'
+				yield f"***{row}***\n*count:* **{count}**, *p50:* **{ms(p50)}**, *p99:* **{ms(p99)}**\n"
+		limits = metrics.counter_values('mcdb_discord_rate_limited_total')
+		waited = sum(value for _, value in metrics.counter_values('mcdb_discord_rate_limit_wait_seconds_total'))
+		if limits:
+			yield '**Rate limits**\n'
+			for labels, value in limits:
+				yield f"***{labels['scope']}***\n*count:* **{int(value)}**\n"
+			yield f"***waited***\n**{waited:.1f}s**\n"
+		for prefix, fn in metrics.stats.items():
+			values = ', '.join(f'*{key[1:]}:* **{round(value, 2)}**' for key, value in flatten('', fn()))
+			yield f"***{prefix}***\n{values}\n"
+
+	stats_pages = result_pages('**BOT STATS**', 'Latencies since the bot started, p50 and p99 are bucket estimates',
+							   '**Stats**', stats_lines(), color=0x42F584)
+	await reaction_controlled_embed(ctx, stats_pages, 60)
+
+
+@client.command(name='restore', description='Restores the locations and members from a backup, or lists the backups')
+async def restore(ctx, *args):
+	"""
+	Puts the locations and members of the namespaces this process serves back as they were in the newest backup taken
+	at or before a time. The current state is backed up first, so a restore can itself be undone.
+	:param ctx: Command context passed
+	:param args: A backup id, UTC date and time (i.e. 2026-10-17 12:00) or unix time, none to list the backups
+	:return: None
+	"""
+	update_log(f'restore {args}', ctx)
+	await ctx.message.delete()
+	loop = asyncio.get_running_loop()
+
+	# formatting error messages
+	error = None
+	if ctx.message.author.id not in authorized_users.values():
+		error = discord.Embed(title=f'**UNAUTHORIZED USER**', color=0xFFFF00,
+							  description='This command is only for use by certain users')
+	elif not shard.owns(home_key):
+		error = discord.Embed(title='**WRONG SHARD**', color=0xFF9E00,
+							  description='Backups are taken and restored by the process serving the home guild, \
+use restore there or in a DM')
+	if error is not None:
+		error.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [error], 20)
+		return
+
+	def backup_time(backup_id: str):
+		return datetime.strptime(backup_id, snapshot_format).strftime('%m/%d/%Y %H:%M:%S UTC')
+
+	if not args:
+		summaries = await loop.run_in_executor(None, backups.summaries)
+		if not summaries:
+			no_backups = discord.Embed(title='**NO BACKUPS**', color=0xFF9E00,
+									   description='No backups have been taken yet')
+			no_backups.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+			await reaction_controlled_embed(ctx, [no_backups], 20)
+			return
+		lines = (f"***{backup_time(backup_id)}***\n*id:* **{backup_id}**, *files:* **{files}**, *size:* \
+**{size / 1024 ** 2:.1f}MB**\n" for backup_id, files, size in summaries)
+		backup_pages = result_pages('**BACKUPS**', f'{len(summaries)} retained backups, newest first',
+									f'**Use {cmd_prefix}restore[time or id]**', lines, color=0x42F584)
+		await reaction_controlled_embed(ctx, backup_pages, 60)
+		return
+
+	when = ' '.join(args)
+	backup_id = backups.find(when)
+	if backup_id is None:
+		not_found = discord.Embed(title='**BACKUP NOT FOUND**', color=0xFF9E00,
+								  description=f'No backup was taken at or before {when}, use restore without a time \
+to list the backups')
+		not_found.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+		await reaction_controlled_embed(ctx, [not_found], 20)
+		return
+
+	async with restore_lock:
+		staging = os.path.join(backups.root, staging_prefix + backup_id)
+		try:
+			# backed up and staged off the event loop, only the swap and reload below run on it
+			before = await loop.run_in_executor(None, backups.backup)
+			if before is None:
+				raise OSError('the current state could not be backed up first')
+			staged = await loop.run_in_executor(None, backups.restore, backup_id, staging, restored_file)
+			await install_backup(staging, staged)
+			result = discord.Embed(title='**BACKUP RESTORED**', color=0x04FF00,
+								   description=f'Restored {len(staged)} files from the backup of \
+{backup_time(backup_id)}, the state before was backed up as {before}')
+		except (OSError, ValueError) as e:
+			print(f'restore() ERROR: backup {backup_id} could not be restored ({e})')
+			result = discord.Embed(title='**RESTORE FAILED**', color=0xFF9E00,
+								   description=f'Backup {backup_id} could not be restored ({e})')
+		finally:
+			shutil.rmtree(staging, ignore_errors=True)
+	result.set_author(name=client.user.name, icon_url=client.user.avatar_url)
+	await reaction_controlled_embed(ctx, [result], 60)
+
+
+@client.command(name='addserver', description='Registers a Minecraft server for this guild')
+async def addserver(ctx, *args):
+	"""
+	Registers a Minecraft server for the guild so server and the member tracking cover it
+	:param ctx: Command context passed
+	:param args: The server ip
+	:return: None
+	"""
+	update_log(f'addserver {args}', ctx)
+	await ctx.message.delete()
+	await change_servers(ctx, args, servers.register, '**SERVER REGISTERED**', 'was already registered')
+
+
+@client.command(name='removeserver', description='Unregisters a Minecraft server from this guild')
+async def removeserver(ctx, *args):
+	"""
+	Unregisters a Minecraft server from the guild
+	:param ctx: Command context passed
+	:param args: The server ip
+	:return: None
+	"""
+	update_log(f'removeserver {args}', ctx)
+	await ctx.message.delete()
+	await change_servers(ctx, args, servers.unregister, '**SERVER UNREGISTERED**', 'was not registered')
+
+
 if __name__ == '__main__':
-	client.run(token)
\ No newline at end of file
+	if shard_processes > 1 and shard.shards is None:
+		# runs this script once per process, each started with its share of the shards
+		launch(__file__, token, shard_count, shard_processes, home_guild_id)
+	else:
+		worker_pool.start(client.loop)  # starts any worker processes before the bot opens connections
+		if shard.owns(home_key):
+			store.load()  # parse the json files once before any command can run
+		client.run(token)
+		command_log.flush()  # writes anything still buffered once the client has closed
+		servers.close()  # ends the open presence sessions so downtime isn't counted as playtime
+		guilds.close()  # compacts the journals and closes every guild's storage, the home store included
+		worker_pool.close()
\ No newline at end of file
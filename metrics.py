@@ -0,0 +1,349 @@
+"""
+Title: MCDB Metrics
+Author: Billy Cobb
+Desc: Latency histograms and counters for commands, storage, server pings and Discord API calls, with event loop
+lag sampling and a Prometheus text file for a node exporter to scrape
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+
+""" Histogram """
+
+
+default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram:
+	"""
+	Counts observations into fixed buckets of upper bounds in secs, like a Prometheus histogram
+	"""
+
+	def __init__(self, buckets: tuple = default_buckets):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)  # the last count is for observations above every bucket
+		self.sum = 0.0
+		self.count = 0
+
+	def observe(self, value: float):
+		i = 0
+		while i < len(self.buckets) and value > self.buckets[i]:
+			i += 1
+		self.counts[i] += 1
+		self.sum += value
+		self.count += 1
+
+	def quantile(self, q: float):
+		"""
+		Estimates a quantile by interpolating inside the bucket it falls in
+		:param q: The quantile, 0.5 for the median
+		:return: The estimate in secs, or None if nothing has been observed
+		"""
+		if not self.count:
+			return None
+		rank = q * self.count
+		seen = 0
+		for i, count in enumerate(self.counts):
+			if seen + count >= rank and count:
+				lower = self.buckets[i - 1] if i else 0.0
+				upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+				return lower + (upper - lower) * (rank - seen) / count
+			seen += count
+		return self.buckets[-1]
+
+
+""" Metrics """
+
+
+def label_text(labels: tuple):
+	return ','.join(f'{key}="{value}"' for key, value in labels)
+
+
+def flatten(prefix: str, stats: dict):
+	"""
+	:param prefix: Metric name prefix
+	:param stats: A stats() dict, nested dicts add their key to the name
+	:return: A list of (name, value) tuples for the numbers in the dict
+	"""
+	gauges = []
+	for key, value in stats.items():
+		name = f'{prefix}_{key}'
+		if isinstance(value, dict):
+			gauges += flatten(name, value)
+		elif isinstance(value, (int, float)) and not isinstance(value, bool):
+			gauges.append((name, value))
+	return gauges
+
+
+class Metrics:
+	"""
+	The bot's histograms, counters and gauges, keyed by metric name and label set. Observations may come from the
+	event loop or executor threads.
+	"""
+
+	def __init__(self):
+		self.histograms = {}  # name -> {labels tuple -> Histogram}
+		self.counters = {}  # name -> {labels tuple -> float}
+		self.gauges = {}  # name -> callable returning a number
+		self.stats = {}  # prefix -> callable returning a stats() dict, exported as gauges
+		self.help = {}  # name -> help text
+		self.const_labels = ()  # (label, value) pairs added to every rendered series, such as the shard process
+		self.lock = threading.Lock()
+		self.task = None
+
+	def observe(self, name: str, value: float, **labels):
+		"""
+		Records one observation in secs in a histogram
+		:return: None
+		"""
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			series = self.histograms.setdefault(name, {})
+			histogram = series.get(key)
+			if histogram is None:
+				histogram = series[key] = Histogram()
+			histogram.observe(value)
+
+	def inc(self, name: str, amount: float = 1, **labels):
+		"""
+		Adds to a counter
+		:return: None
+		"""
+		key = tuple(sorted(labels.items()))
+		with self.lock:
+			series = self.counters.setdefault(name, {})
+			series[key] = series.get(key, 0) + amount
+
+	@contextmanager
+	def timer(self, name: str, **labels):
+		"""
+		Times the body of a with statement into a histogram
+		"""
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(name, time.perf_counter() - start, **labels)
+
+	def timed(self, name: str, **labels):
+		"""
+		Decorator timing every call of a function or coroutine function into a histogram
+		"""
+		def decorator(fn):
+			if asyncio.iscoroutinefunction(fn):
+				@wraps(fn)
+				async def timed_coroutine(*args, **kwargs):
+					with self.timer(name, **labels):
+						return await fn(*args, **kwargs)
+				return timed_coroutine
+
+			@wraps(fn)
+			def timed_function(*args, **kwargs):
+				with self.timer(name, **labels):
+					return fn(*args, **kwargs)
+			return timed_function
+		return decorator
+
+	def describe(self, name: str, text: str):
+		self.help[name] = text
+
+	def gauge(self, name: str, fn, text: str = None):
+		"""
+		Registers a gauge read when the metrics are rendered
+		:param name: The metric name
+		:param fn: A callable returning the current value
+		:param text: Help text for the metric
+		:return: None
+		"""
+		self.gauges[name] = fn
+		if text is not None:
+			self.help[name] = text
+
+	def add_stats(self, prefix: str, fn):
+		"""
+		Exports every number in a component's stats() dict as a gauge named mcdb_<prefix>_<key>
+		:param prefix: The component name
+		:param fn: The component's stats method
+		:return: None
+		"""
+		self.stats[prefix] = fn
+
+	def summary(self, name: str):
+		"""
+		:param name: A histogram name
+		:return: A list of (labels dict, count, p50, p99, sum) tuples, busiest first
+		"""
+		with self.lock:
+			series = list(self.histograms.get(name, {}).items())
+			rows = [(dict(key), h.count, h.quantile(0.5), h.quantile(0.99), h.sum) for key, h in series]
+		return sorted(rows, key=lambda row: row[1], reverse=True)
+
+	def counter_values(self, name: str):
+		"""
+		:param name: A counter name
+		:return: A list of (labels dict, value) tuples, largest first
+		"""
+		with self.lock:
+			rows = [(dict(key), value) for key, value in self.counters.get(name, {}).items()]
+		return sorted(rows, key=lambda row: row[1], reverse=True)
+
+	def render(self):
+		"""
+		:return: Every metric in the Prometheus text exposition format
+		"""
+		lines = []
+
+		def header(name, kind):
+			if name in self.help:
+				lines.append(f'# HELP {name} {self.help[name]}')
+			lines.append(f'# TYPE {name} {kind}')
+
+		with self.lock:
+			for name, series in sorted(self.histograms.items()):
+				header(name, 'histogram')
+				for key, histogram in series.items():
+					labels = label_text(self.const_labels + key)
+					cumulative = 0
+					for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+						cumulative += count
+						le = f'le="{bound}"'
+						lines.append(f'{name}_bucket{{{labels + "," if labels else ""}{le}}} {cumulative}')
+					suffix = f'{{{labels}}}' if labels else ''
+					lines.append(f'{name}_sum{suffix} {histogram.sum}')
+					lines.append(f'{name}_count{suffix} {histogram.count}')
+			for name, series in sorted(self.counters.items()):
+				header(name, 'counter')
+				for key, value in series.items():
+					labels = label_text(self.const_labels + key)
+					lines.append(f'{name}{{{labels}}} {value}' if labels else f'{name} {value}')
+		gauges = [(name, fn()) for name, fn in self.gauges.items()]
+		for prefix, fn in self.stats.items():
+			gauges += flatten(f'mcdb_{prefix}', fn())
+		labels = f'{{{label_text(self.const_labels)}}}' if self.const_labels else ''
+		for name, value in sorted(gauges):
+			if value is not None:
+				header(name, 'gauge')
+				lines.append(f'{name}{labels} {value}')
+		return '\n'.join(lines) + '\n'
+
+	def write(self, path: str, text: str = None):
+		"""
+		Writes the rendered metrics to a file, replacing it in one step so a scrape never reads half a file
+		:param path: String path ending in .prom for a node exporter's textfile collector
+		:param text: Already rendered metrics, rendered now if None
+		:return: None
+		"""
+		with open(path + '.tmp', 'w') as file_w:
+			file_w.write(self.render() if text is None else text)
+		os.replace(path + '.tmp', path)
+
+	def start(self, loop: asyncio.AbstractEventLoop, path: str, interval: float = 15, lag_interval: float = 0.5):
+		"""
+		Starts the background task sampling event loop lag and writing the metrics file
+		:param loop: The event loop the bot runs on
+		:param path: String path of the Prometheus text file, None to only sample the lag
+		:param interval: Secs between writes of the file
+		:param lag_interval: Secs between event loop lag samples
+		:return: None
+		"""
+		if self.task is None or self.task.done():
+			self.task = loop.create_task(self.run(path, interval, lag_interval))
+
+	async def run(self, path: str, interval: float, lag_interval: float):
+		"""
+		Sleeps lag_interval at a time, recording how late each wake up is as event loop lag
+		:return: None
+		"""
+		loop = asyncio.get_running_loop()
+		next_write = loop.time() + interval
+		while True:
+			expected = loop.time() + lag_interval
+			await asyncio.sleep(lag_interval)
+			now = loop.time()
+			self.observe('mcdb_event_loop_lag_seconds', max(now - expected, 0.0))
+			if path is not None and now >= next_write:
+				next_write = now + interval
+				try:
+					# rendered here since the gauges read state owned by the event loop
+					await loop.run_in_executor(None, self.write, path, self.render())
+				except OSError as e:
+					print(f'Metrics.write() ERROR: {e!r}')
+
+
+metrics = Metrics()  # shared by every module so storage and ping helpers can record without being passed it
+metrics.describe('mcdb_command_seconds', 'Time from a command being invoked to its first reply')
+metrics.describe('mcdb_io_seconds', 'Time spent in storage operations')
+metrics.describe('mcdb_ping_seconds', 'Time spent pinging Minecraft servers')
+metrics.describe('mcdb_embed_build_seconds', 'Time spent building result page embeds')
+metrics.describe('mcdb_page_turn_seconds', 'Time from a page turn reaction to the message being edited')
+metrics.describe('mcdb_discord_request_seconds', 'Discord REST call latency, including rate limit waits')
+metrics.describe('mcdb_discord_rate_limit_wait_seconds_total', 'Secs Discord REST calls were told to wait')
+metrics.describe('mcdb_event_loop_lag_seconds', 'How late the event loop runs a scheduled wake up')
+metrics.describe('mcdb_worker_seconds', 'Time from work being handed to the worker pool to its result')
+
+
+""" Discord Instrumentation """
+
+
+def instrument_http(http, registry: Metrics = metrics):
+	"""
+	Wraps a discord.py HTTPClient's request method to time and count every REST call by route
+	:param http: The client's HTTPClient, client.http
+	:param registry: The Metrics to record into
+	:return: None
+	"""
+	request = http.request
+
+	@wraps(request)
+	async def timed_request(route, **kwargs):
+		start = time.perf_counter()
+		result = 'ok'
+		try:
+			return await request(route, **kwargs)
+		except Exception as e:
+			result = type(e).__name__
+			raise
+		finally:
+			registry.observe('mcdb_discord_request_seconds', time.perf_counter() - start,
+							 route=f'{route.method} {route.path}', result=result)
+	http.request = timed_request
+
+
+class RateLimitFilter(logging.Filter):
+	"""
+	Counts discord.py's rate limit log records. Waits on an exhausted bucket are only logged at debug, so the
+	logger is lowered to debug and this filter drops whatever the logger would not have emitted before.
+	"""
+
+	def __init__(self, registry: Metrics, level: int):
+		super().__init__()
+		self.registry = registry
+		self.level = level
+
+	def filter(self, record: logging.LogRecord):
+		message = str(record.msg)
+		if message.startswith('We are being rate limited'):
+			self.registry.inc('mcdb_discord_rate_limited_total', scope='bucket')
+			self.registry.inc('mcdb_discord_rate_limit_wait_seconds_total', record.args[0], kind='429')
+		elif message.startswith('Global rate limit has been hit'):
+			self.registry.inc('mcdb_discord_rate_limited_total', scope='global')
+		elif message.startswith('A rate limit bucket has been exhausted'):
+			self.registry.inc('mcdb_discord_rate_limited_total', scope='exhausted')
+			self.registry.inc('mcdb_discord_rate_limit_wait_seconds_total', float(record.args[1]), kind='exhausted')
+		return record.levelno >= self.level
+
+
+def instrument_rate_limits(registry: Metrics = metrics, logger_name: str = 'discord.http'):
+	"""
+	Attaches a RateLimitFilter to discord.py's http logger
+	:return: None
+	"""
+	logger = logging.getLogger(logger_name)
+	logger.addFilter(RateLimitFilter(registry, logger.getEffectiveLevel()))
+	logger.setLevel(logging.DEBUG)
@@ -0,0 +1,145 @@
+"""
+Title: MCDB Paginator
+Author: Billy Cobb
+Desc: Builds embed pages on demand from a stream of result lines, keeping every page inside Discord's size limits
+"""
+
+from metrics import metrics
+
+
+""" Paginator Vars """
+
+
+field_char_limit = 1024  # Discord's limit on the characters in one embed field value
+
+
+""" Paginator """
+
+
+class Paginator:
+	"""
+	Splits an iterator of result lines into pages only as far as the user actually pages. A page holds at most
+	per_page lines and never more characters than fit in an embed field. Pages that have been built are cached
+	as text and the embed is made by a build callable each time the page is shown, label() gives the
+	"Page i/N" text to show with it.
+	"""
+
+	def __init__(self, lines, build, per_page: int = 10, max_chars: int = field_char_limit,
+				 head: list = None):
+		"""
+		:param lines: An iterable of strings, each one a result that is never split across pages
+		:param build: A callable taking the page text and returning a discord.Embed
+		:param per_page: Most lines on one page
+		:param max_chars: Most characters of lines on one page
+		:param head: Already built embeds shown before the streamed pages
+		"""
+		self.lines = iter(lines)
+		self.build = build
+		self.per_page = per_page
+		self.max_chars = max_chars
+		self.head = head or []
+		self.pages = []  # text of every streamed page built so far
+		self.pending = None  # a line read from the iterator that didn't fit on the previous page
+		self.exhausted = False
+		self.empty_text = 'No results'
+
+	@classmethod
+	def from_embeds(cls, embeds: list):
+		"""
+		Wraps a list of already built embeds
+		:param embeds: The list of embeds
+		:return: A Paginator over the embeds
+		"""
+		return cls((), None, head=embeds)
+
+	def _next_line(self):
+		"""
+		:return: The next line to place, or None once the iterator is used up
+		"""
+		if self.pending is not None:
+			line, self.pending = self.pending, None
+			return line
+		if self.exhausted:
+			return None
+		try:
+			return next(self.lines)
+		except StopIteration:
+			self.exhausted = True
+			return None
+
+	def _build_next(self):
+		"""
+		Reads lines until the next page is full
+		:return: True if a page was built, else False
+		"""
+		text = ''
+		count = 0
+		while count < self.per_page:
+			line = self._next_line()
+			if line is None:
+				break
+			if len(line) > self.max_chars:
+				line = line[:self.max_chars - 3] + '...'
+			if count and len(text) + len(line) > self.max_chars:
+				self.pending = line
+				break
+			text += line
+			count += 1
+		if not count:
+			return False
+		self.pages.append(text)
+		# peek so the last page knows it is the last one
+		if self.pending is None and not self.exhausted:
+			self.pending = self._next_line()
+		return True
+
+	def has_page(self, index: int):
+		"""
+		Builds pages up to index if they haven't been built yet
+		:param index: Page index, counting the head embeds
+		:return: True if the page exists, else False
+		"""
+		if index < 0:
+			return False
+		if self.build is None:
+			return index < len(self.head)
+		stream_index = index - len(self.head)
+		while stream_index >= len(self.pages):
+			if not self._build_next():
+				# a stream with no results still shows one page saying so
+				return stream_index == 0 and not self.pages and index == len(self.head)
+		return True
+
+	@property
+	def page_count(self):
+		"""
+		:return: The total number of pages, or None while the stream still has unread lines
+		"""
+		if self.build is None:
+			return len(self.head)
+		if not self.exhausted or self.pending is not None:
+			return None
+		return len(self.head) + max(len(self.pages), 1)
+
+	def label(self, index: int):
+		"""
+		:param index: Page index
+		:return: "Page i/N", or "Page i/?" if the number of pages isn't known yet
+		"""
+		count = self.page_count
+		return f'Page {index + 1}/{count if count is not None else "?"}'
+
+	def get(self, index: int):
+		"""
+		Returns the embed for a page, building it if it hasn't been visited yet
+		:param index: Page index, counting the head embeds
+		:return: A discord.Embed, or None if there is no such page
+		"""
+		if not self.has_page(index):
+			return None
+		if index < len(self.head):
+			return self.head[index]
+		stream_index = index - len(self.head)
+		text = self.pages[stream_index] if self.pages else self.empty_text
+		with metrics.timer('mcdb_embed_build_seconds'):
+			return self.build(text)
@@ -0,0 +1,250 @@
+"""
+Title: MCDB Presence History
+Author: Billy Cobb
+Desc: Records players joining and leaving a server as compact sessions and answers seen/playtime/peak queries
+"""
+
+import bisect
+import json
+import os
+import time
+
+
+""" Max Tree """
+
+
+class MaxTree:
+	"""
+	An append-only segment tree over a list of numbers answering range maximum queries in O(log n)
+	"""
+
+	def __init__(self):
+		self.size = 1
+		self.count = 0
+		self.tree = [float('-inf')] * 2
+
+	def append(self, value: float):
+		"""
+		Adds a value to the end of the list
+		:return: None
+		"""
+		if self.count == self.size:
+			leaves = self.tree[self.size:self.size + self.count]
+			self.size *= 2
+			self.tree = [float('-inf')] * (2 * self.size)
+			self.tree[self.size:self.size + len(leaves)] = leaves
+			for i in range(self.size - 1, 0, -1):
+				self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+		i = self.size + self.count
+		self.tree[i] = value
+		self.count += 1
+		i //= 2
+		while i:
+			self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+			i //= 2
+
+	def query(self, lo: int, hi: int):
+		"""
+		:param lo: Index of the first value in the range
+		:param hi: Index of the last value in the range
+		:return: The largest value in the range
+		"""
+		best = float('-inf')
+		lo += self.size
+		hi += self.size + 1
+		while lo < hi:
+			if lo & 1:
+				best = max(best, self.tree[lo])
+				lo += 1
+			if hi & 1:
+				hi -= 1
+				best = max(best, self.tree[hi])
+			lo //= 2
+			hi //= 2
+		return best
+
+
+""" Presence History """
+
+
+class PlayerSessions:
+	"""
+	One player's sessions as parallel sorted lists of start and end times, with running playtime totals
+	"""
+
+	def __init__(self):
+		self.starts = []
+		self.ends = []  # None for a session that is still open
+		self.totals = [0]  # totals[i] is the summed length of the first i closed sessions
+
+	def join(self, t: int):
+		if not self.ends or self.ends[-1] is not None:
+			self.starts.append(t)
+			self.ends.append(None)
+
+	def leave(self, t: int):
+		if self.ends and self.ends[-1] is None:
+			self.ends[-1] = t
+			self.totals.append(self.totals[-1] + t - self.starts[-1])
+
+	@property
+	def online(self):
+		return bool(self.ends) and self.ends[-1] is None
+
+	def playtime(self, start: int, end: int):
+		"""
+		Sums the time played between two epoch times in O(log n)
+		:return: Secs played in the range
+		"""
+		closed = len(self.totals) - 1  # sessions before this index are closed
+		first = bisect.bisect_left(self.ends, start, 0, closed)  # first session ending at or after start
+		last = bisect.bisect_right(self.starts, end) - 1  # last session starting at or before end
+		if last < first:
+			return 0
+		total = 0
+		hi = min(last, closed - 1)
+		if hi >= first:
+			# the closed sessions come from the running totals, less the parts outside the range at either edge
+			total += self.totals[hi + 1] - self.totals[first]
+			total -= max(0, start - self.starts[first])
+			total -= max(0, self.ends[hi] - end)
+		if last == closed:  # the open session counts up to the end of the range
+			total += max(0, end - max(self.starts[last], start))
+		return total
+
+
+class PresenceHistory:
+	"""
+	A server's presence history. Each status sample is compared to the previous one and only the joins, leaves
+	and changes in player count are appended to a json-lines file as [epoch, kind, value] rows, where kind is
+	'+' for a join, '-' for a leave and '#' for the online count.
+	"""
+
+	def __init__(self, path: str):
+		"""
+		:param path: String path to the presence .jsonl file
+		"""
+		self.path = path
+		self.players = {}  # name -> PlayerSessions
+		self.online = set()
+		self.count_times = []  # epoch times the online count changed
+		self.counts = MaxTree()  # the online count from each of those times
+		self.last_count = None
+		self.events = 0
+		self.offset = 0  # bytes of the file replayed or written so far
+		self.load()
+
+	def load(self):
+		"""
+		Replays the presence file from where the last load stopped, so loading again picks up the rows another
+		process recorded since
+		:return: None
+		"""
+		try:
+			size = os.path.getsize(self.path)
+		except FileNotFoundError:
+			return
+		if size <= self.offset:
+			return
+		with open(self.path, 'rb') as file_r:
+			file_r.seek(self.offset)
+			data = file_r.read(size - self.offset)
+		end = data.rfind(b'\n') + 1  # a partially written last line is replayed once it is complete
+		self.offset += end
+		for line in data[:end].splitlines():
+			try:
+				t, kind, value = json.loads(line)
+			except ValueError:
+				continue  # a line torn by a crash
+			self._apply(t, kind, value)
+
+	def _apply(self, t: int, kind: str, value):
+		if kind == '+':
+			self.players.setdefault(value, PlayerSessions()).join(t)
+			self.online.add(value)
+		elif kind == '-':
+			if value in self.players:
+				self.players[value].leave(t)
+			self.online.discard(value)
+		elif kind == '#':
+			self.count_times.append(t)
+			self.counts.append(value)
+			self.last_count = value
+
+	def sample(self, names_online: list, count: int = None, now: int = None):
+		"""
+		Records a status sample, writing only what changed since the last one
+		:param names_online: The names of the players in the sample
+		:param count: The server's online player count, defaults to the number of names
+		:param now: Epoch time of the sample
+		:return: A (joined, left) tuple of name sets
+		"""
+		now = int(now if now is not None else time.time())
+		names_online = set(names_online)
+		count = len(names_online) if count is None else count
+		joined = names_online - self.online
+		left = self.online - names_online
+		events = [(now, '-', name) for name in sorted(left)] + [(now, '+', name) for name in sorted(joined)]
+		if count != self.last_count:
+			events.append((now, '#', count))
+		if events:
+			for event in events:
+				self._apply(*event)
+			lines = ''.join(json.dumps(event, separators=(',', ':')) + '\n' for event in events).encode('utf-8')
+			with open(self.path, 'ab') as file_a:
+				file_a.write(lines)
+			self.offset += len(lines)
+			self.events += len(events)
+		return joined, left
+
+	def close(self, now: int = None):
+		"""
+		Ends every open session, used when the bot stops watching the server
+		:return: None
+		"""
+		self.sample([], 0, now)
+
+	def seen(self, name: str):
+		"""
+		:param name: A player name
+		:return: None if the player was never seen, 0 if they are online now, else the epoch time they left
+		"""
+		sessions = self.players.get(name)
+		if sessions is None:
+			return None
+		if sessions.online:
+			return 0
+		return sessions.ends[-1]
+
+	def playtime(self, name: str, start: int = 0, end: int = None):
+		"""
+		:param name: A player name
+		:param start: Epoch start of the range
+		:param end: Epoch end of the range, defaults to now
+		:return: Secs the player was online in the range
+		"""
+		sessions = self.players.get(name)
+		if sessions is None:
+			return 0
+		return sessions.playtime(start, int(end if end is not None else time.time()))
+
+	def peak(self, start: int = 0, end: int = None):
+		"""
+		:param start: Epoch start of the range
+		:param end: Epoch end of the range, defaults to now
+		:return: A (count, epoch time) tuple of the most players online in the range, or None if there is no data
+		"""
+		end = int(end if end is not None else time.time())
+		hi = bisect.bisect_right(self.count_times, end) - 1
+		if hi < 0:
+			return None
+		lo = max(bisect.bisect_right(self.count_times, start) - 1, 0)  # the count already in effect at start
+		best = self.counts.query(lo, hi)
+		# the earliest time in the range that count was reached, found by narrowing the range in O(log^2 n)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			if self.counts.query(lo, mid) == best:
+				hi = mid
+			else:
+				lo = mid + 1
+		return int(best), max(self.count_times[lo], start)
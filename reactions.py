@@ -0,0 +1,163 @@
+"""
+Title: MCDB Reaction Dispatcher
+Author: Billy Cobb
+Desc: Routes reaction events to the paginated message they belong to and times every session out from one timer
+"""
+
+import asyncio
+import heapq
+import itertools
+
+
+""" Reaction Session """
+
+
+class ReactionSession:
+	"""
+	The reactions waiting to be handled for one controlled message
+	"""
+
+	def __init__(self, message_id: int, user_id: int, channel_id: int, emojis: set, timeout: float):
+		"""
+		:param message_id: Id of the controlled message
+		:param user_id: Id of the user who opened the session
+		:param channel_id: Id of the channel the message is in
+		:param emojis: The reactions the session responds to
+		:param timeout: Secs without a reaction before the session ends
+		"""
+		self.message_id = message_id
+		self.user_id = user_id
+		self.channel_id = channel_id
+		self.emojis = emojis
+		self.timeout = timeout
+		self.deadline = None
+		self.queue = asyncio.Queue()
+		self.closed = False
+
+	async def next(self):
+		"""
+		Waits for the next reaction to the message
+		:return: An (emoji, user) tuple, or None once the session has timed out or been closed
+		"""
+		if self.closed and self.queue.empty():
+			return None
+		return await self.queue.get()
+
+
+""" Reaction Dispatcher """
+
+
+class ReactionDispatcher:
+	"""
+	Keeps every open ReactionSession in a dict keyed by message id, so a reaction event costs one lookup however
+	many paginated messages are open. Timeouts live in a single heap served by one scheduled timer callback, and
+	the oldest sessions are ended when a user or channel goes over its cap.
+	"""
+
+	def __init__(self, max_per_user: int = 3, max_per_channel: int = 10):
+		"""
+		:param max_per_user: Most sessions one user may have open at once
+		:param max_per_channel: Most sessions one channel may have open at once
+		"""
+		self.max_per_user = max_per_user
+		self.max_per_channel = max_per_channel
+		self.sessions = {}  # message id -> ReactionSession, in the order they were opened
+		self.deadlines = []  # heap of (deadline, tiebreak, message id), stale entries are skipped
+		self.counter = itertools.count()
+		self.timer = None
+		self.dispatched = 0
+		self.ignored = 0
+		self.expired = 0
+		self.evicted = 0
+
+	def open(self, message_id: int, user_id: int, channel_id: int, emojis: set, timeout: float):
+		"""
+		Starts routing reactions on a message to a new session
+		:return: The ReactionSession
+		"""
+		# ends the oldest sessions of a user or channel that is already at its cap
+		by_user = [s for s in self.sessions.values() if s.user_id == user_id]
+		by_channel = [s for s in self.sessions.values() if s.channel_id == channel_id]
+		for owned, cap in ((by_user, self.max_per_user), (by_channel, self.max_per_channel)):
+			for session in owned[:max(len(owned) - cap + 1, 0)]:
+				if session.message_id in self.sessions:
+					self.evicted += 1
+					self.close(session.message_id)
+		session = ReactionSession(message_id, user_id, channel_id, emojis, timeout)
+		self.sessions[message_id] = session
+		self.touch(session)
+		return session
+
+	def close(self, message_id: int):
+		"""
+		Stops routing reactions to a session, waking it up with None if it is waiting
+		:param message_id: Id of the controlled message
+		:return: None
+		"""
+		session = self.sessions.pop(message_id, None)
+		if session is not None and not session.closed:
+			session.closed = True
+			session.queue.put_nowait(None)
+
+	def touch(self, session: ReactionSession):
+		"""
+		Restarts a session's timeout
+		:param session: The session
+		:return: None
+		"""
+		loop = asyncio.get_running_loop()
+		session.deadline = loop.time() + session.timeout
+		heapq.heappush(self.deadlines, (session.deadline, next(self.counter), session.message_id))
+		if self.deadlines[0][2] == session.message_id:
+			self._schedule(loop)
+
+	def _schedule(self, loop: asyncio.AbstractEventLoop):
+		"""
+		Points the single timer at the earliest deadline in the heap
+		:return: None
+		"""
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		if self.deadlines:
+			self.timer = loop.call_at(self.deadlines[0][0], self._expire)
+
+	def _expire(self):
+		"""
+		Timer callback, ends every session whose deadline has passed
+		:return: None
+		"""
+		loop = asyncio.get_running_loop()
+		now = loop.time()
+		while self.deadlines and self.deadlines[0][0] <= now:
+			deadline, _, message_id = heapq.heappop(self.deadlines)
+			session = self.sessions.get(message_id)
+			if session is not None and session.deadline == deadline:
+				self.expired += 1
+				self.close(message_id)
+		self.timer = None
+		self._schedule(loop)
+
+	def dispatch(self, message_id: int, emoji, user):
+		"""
+		Hands a reaction to the session controlling the message, if there is one
+		:param message_id: Id of the message reacted to
+		:param emoji: The reaction emoji
+		:param user: The user who reacted
+		:return: True if a session took the reaction, else False
+		"""
+		session = self.sessions.get(message_id)
+		if session is None or emoji not in session.emojis:
+			self.ignored += 1
+			return False
+		self.dispatched += 1
+		self.touch(session)
+		session.queue.put_nowait((emoji, user))
+		return True
+
+	def stats(self):
+		"""
+		:return: A dict of open session and reaction counts
+		"""
+		return {'open': len(self.sessions), 'dispatched': self.dispatched, 'ignored': self.ignored,
+				'expired': self.expired, 'evicted': self.evicted}
@@ -0,0 +1,919 @@
+"""
+Title: MCDB Replay Harness
+Author: Billy Cobb
+Desc: Replays a recorded command log, or a synthetic workload, through the bot's real event handlers and commands at
+N times real time. A local stand-in for Discord's REST API answers with Discord's rate limit headers and feeds
+gateway events back to the bot, and fake Minecraft servers answer status pings after a set latency. Reports reply
+throughput and latency, event loop stalls and Discord API use. Run with python replay.py [--log CommandLog.jsonl]
+[--speed 10] [--out results.json], a run given --max-p99, --max-stall or --max-rate-limited exits with status 1 when
+it misses one.
+"""
+
+import argparse
+import ast
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from urllib.parse import unquote
+
+import discord
+from aiohttp import web
+
+from cmdlog import CommandLog, read_legacy_log
+
+
+""" Replay Vars """
+
+
+bot_id = 900000000000000001
+first_guild = 910000000000000000  # simulated guild ids count up from here, the first one is the home guild
+first_user = 920000000000000000
+first_id = 930000000000000000  # channel and message ids
+rate_limits = {  # route -> (requests, per secs) in each channel, as Discord reports them to bots
+	'send': (5, 5.0),
+	'edit': (5, 5.0),
+	'delete': (5, 1.0),
+	'react': (1, 0.25)
+}
+global_limit = 50  # REST requests a second Discord allows a bot across every route
+stall_secs = 0.1  # event loop wake ups later than this count as stalls
+monitor_interval = 0.01  # secs between the stall monitor's wake ups
+synthetic_mix = {  # command -> weight in a synthetic workload
+	'find': 30, 'near': 15, 'random': 10, 'server': 10, 'add': 8, 'within': 5, 'map': 5, 'help': 5, 'box': 3,
+	'seen': 3, 'playtime': 3, 'peak': 2, 'usage': 1
+}
+right_arrow, close = '\U000027A1', '\U0000274C'
+
+
+def json_response(data, status: int = 200, headers: dict = None):
+	# discord.py only parses bodies whose content type is exactly application/json, without a charset
+	return web.Response(body=json.dumps(data).encode('utf-8'), status=status,
+						headers={**(headers or {}), 'Content-Type': 'application/json'})
+
+
+def percentile(samples: list, fraction: float):
+	if not samples:
+		return None
+	ordered = sorted(samples)
+	return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+""" Workload """
+
+
+def command_content(command: str, prefix: str):
+	"""
+	Rebuilds the message a logged command was sent as, commands are logged as their name and argument tuple
+	:param command: The logged "Command", i.e. "find ('zombie', 'spawner')"
+	:param prefix: The bot's command prefix
+	:return: The message content, i.e. %find zombie spawner
+	"""
+	name, _, rest = str(command or '').partition(' ')
+	try:
+		args = ast.literal_eval(rest) if rest else ()
+	except (ValueError, SyntaxError):
+		args = (rest,)
+	if not isinstance(args, tuple):
+		args = (args,)
+	return ' '.join([prefix + name, *(f'"{arg}"' if ' ' in str(arg) else str(arg) for arg in args)])
+
+
+def recorded_workload(path: str, prefix: str):
+	"""
+	:param path: A CommandLog.jsonl segment, read with the segments rotated beside it, or a legacy CommandLog.json
+	:param prefix: The bot's command prefix
+	:return: A list of (secs after the first command, user key, user name, guild key, message content) tuples
+	"""
+	entries = read_legacy_log(path) if path.endswith('.json') else CommandLog(path).read()
+	events = sorted((entry.get("Time", 0), str(entry.get("UserID")), str(entry.get("UserName", 'user')).split('#')[0],
+					 str(entry.get("GuildID")), command_content(entry.get("Command"), prefix)) for entry in entries)
+	start = events[0][0] if events else 0
+	return [(at - start, *event) for at, *event in events]
+
+
+def synthetic_workload(rng: random.Random, count: int, rate: float, users: int, guilds: int, names: list,
+					   prefix: str):
+	"""
+	Commands arriving at random at an average rate, from users who each stay in one guild
+	:param rng: The random generator
+	:param count: Number of commands
+	:param rate: Average commands a second at real time
+	:param users: Number of users
+	:param guilds: Number of guilds the users are spread over
+	:param names: Stored location names, find queries are parts of them
+	:param prefix: The bot's command prefix
+	:return: A workload list in the same form as recorded_workload's
+	"""
+	commands, weights = list(synthetic_mix), list(synthetic_mix.values())
+	events, at = [], 0.0
+
+	def coords():
+		return f'{rng.randint(-3000, 3000)} {rng.randint(5, 250)} {rng.randint(-3000, 3000)}'
+
+	for i in range(count):
+		at += rng.expovariate(rate)
+		user = rng.randrange(users)
+		dim = rng.choice('one')
+		command = rng.choices(commands, weights)[0]
+		if command == 'find':
+			name = rng.choice(names) if names else 'base'
+			start = rng.randrange(max(len(name) - 4, 1))
+			args = f'"{name[start:start + rng.randint(4, 8)]}"'
+		elif command == 'near':
+			args = f'{dim} {coords()} {rng.choice([5, 10])}'
+		elif command == 'within':
+			args = f'{dim} {coords()} {rng.choice([100, 500, 2000])}'
+		elif command == 'box':
+			args = f'{dim} {coords()} {coords()}'
+		elif command == 'map':
+			args = f'{dim} {rng.randint(-3000, 3000)} {rng.randint(-3000, 3000)} {rng.randint(0, 4)}'
+		elif command == 'add':
+			args = f'{dim} "replay {i} {user}" {coords()}'
+		elif command == 'random':
+			args = rng.choice(['', 'o', 'n', 'e'])
+		elif command in ('seen', 'playtime'):
+			args = f'player{rng.randrange(50)}'
+		elif command in ('peak', 'usage'):
+			args = rng.choice(['', '24h', '7d'])
+		else:
+			args = ''
+		events.append((at, str(user), f'user{user}', str(user % guilds), f'{prefix}{command} {args}'.strip()))
+	return events
+
+
+""" Fake Discord """
+
+
+class FakeGateway:
+	"""
+	Feeds gateway events to the bot by running discord.py's own parsers for them on the bot's event loop, as its
+	websocket would. Events can be sent from any thread.
+	"""
+
+	def __init__(self, client, loop: asyncio.AbstractEventLoop):
+		"""
+		:param client: The bot's discord.py Client
+		:param loop: The event loop the bot runs on
+		"""
+		self.client = client
+		self.loop = loop
+		self.parsers = client._connection.parsers
+		self.events = 0
+		self.errors = 0
+
+	def dispatch(self, event: str, data: dict):
+		self.events += 1
+		self.loop.call_soon_threadsafe(self._parse, event, data)
+
+	def _parse(self, event: str, data: dict):
+		try:
+			self.parsers[event](data)
+		except Exception as e:
+			self.errors += 1
+			print(f'FakeGateway ERROR: {event} could not be parsed ({e!r})')
+
+
+def user_json(user_id: int, name: str, bot: bool = False):
+	return {'id': str(user_id), 'username': name, 'discriminator': '0001', 'avatar': None, 'bot': bot}
+
+
+def member_json(user: dict):
+	return {'user': user, 'roles': [], 'joined_at': '2021-01-01T00:00:00+00:00', 'deaf': False, 'mute': False,
+			'nick': None}
+
+
+def guild_json(guild_id: int, channel_ids: list, bot: dict):
+	return {'id': str(guild_id), 'name': f'replay {guild_id - first_guild}', 'owner_id': bot['id'],
+			'region': 'us-east', 'afk_timeout': 300, 'verification_level': 0, 'default_message_notifications': 0,
+			'explicit_content_filter': 0, 'mfa_level': 0, 'premium_tier': 0, 'features': [], 'emojis': [],
+			'roles': [{'id': str(guild_id), 'name': '@everyone', 'permissions': str(2 ** 31 - 1), 'position': 0,
+					   'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+			'channels': [{'id': str(channel_id), 'type': 0, 'name': f'commands-{n}', 'position': n,
+						  'permission_overwrites': [], 'guild_id': str(guild_id)}
+						 for n, channel_id in enumerate(channel_ids)],
+			'members': [member_json(bot)], 'member_count': 1, 'large': False, 'unavailable': False,
+			'presences': [], 'voice_states': []}
+
+
+class FakeDiscord:
+	"""
+	Answers the REST routes the bot uses. Each route is limited per channel the way Discord limits bots, with the
+	same headers, so discord.py waits out exhausted buckets itself, and requests over a bucket or the global limit
+	are refused with a 429. Messages, deletions and reactions are echoed to the gateway like Discord does.
+	"""
+
+	def __init__(self, gateway: FakeGateway, ids, rng: random.Random, latency: float = 0.05):
+		"""
+		:param gateway: The FakeGateway echoed events go to
+		:param ids: An iterator of unused snowflakes
+		:param rng: The random generator latencies are drawn from
+		:param latency: Mean secs each request takes to answer
+		"""
+		self.gateway = gateway
+		self.ids = ids
+		self.rng = rng
+		self.latency = latency
+		self.bot = user_json(bot_id, 'MCDB', bot=True)
+		self.channel_guilds = {}  # channel id -> guild id
+		self.buckets = {}  # (route, channel id) -> [monotonic reset time, remaining]
+		self.window = [0, 0]  # [second, requests in it] for the global limit
+		self.listeners = []  # callables run with (route, channel id, message id, data) after every answered request
+		self.calls = {}  # route -> requests answered
+		self.per_second = {}  # whole secs since start -> requests
+		self.limited = {'bucket': 0, 'global': 0}
+		self.unknown = 0
+		self.start = time.monotonic()
+		self.runner = None
+		self.app = web.Application()
+		base = '/api/v7'
+		self.app.add_routes([
+			web.get(base + '/users/@me', self.me),
+			web.post(base + '/channels/{channel}/messages', self.send),
+			web.patch(base + '/channels/{channel}/messages/{message}', self.edit),
+			web.delete(base + '/channels/{channel}/messages/{message}', self.delete),
+			web.put(base + '/channels/{channel}/messages/{message}/reactions/{emoji}/@me', self.react),
+			web.delete(base + '/channels/{channel}/messages/{message}/reactions/{emoji}/{user}', self.unreact),
+			web.route('*', base + '/{tail:.*}', self.other)
+		])
+
+	async def serve(self, host: str = '127.0.0.1'):
+		"""
+		:return: The base url to point discord.py's Route.BASE at
+		"""
+		self.runner = web.AppRunner(self.app, access_log=None)
+		await self.runner.setup()
+		site = web.TCPSite(self.runner, host, 0)
+		await site.start()
+		port = site._server.sockets[0].getsockname()[1]
+		return f'http://{host}:{port}/api/v7'
+
+	async def close(self):
+		if self.runner is not None:
+			await self.runner.cleanup()
+
+	def _limit(self, route: str, channel: int):
+		"""
+		Counts a request against its bucket and the global limit
+		:return: (headers, None) if it may go ahead, else (headers, a 429 response)
+		"""
+		now = time.monotonic()
+		second = int(now - self.start)
+		if self.window[0] != second:
+			self.window = [second, 0]
+		self.window[1] += 1
+		if self.window[1] > global_limit:
+			self.limited['global'] += 1
+			retry = second + 1 - (now - self.start)
+			headers = {'Via': '1.1 google', 'Retry-After': str(retry), 'X-RateLimit-Global': 'true'}
+			return headers, json_response({'message': 'You are being rate limited.', 'global': True,
+											   'retry_after': retry * 1000}, status=429, headers=headers)
+		limit, per = rate_limits[route]
+		bucket = self.buckets.get((route, channel))
+		if bucket is None or now >= bucket[0]:
+			bucket = self.buckets[(route, channel)] = [now + per, limit]
+		reset_after = bucket[0] - now
+		headers = {'Via': '1.1 google', 'X-RateLimit-Limit': str(limit), 'X-RateLimit-Bucket': route,
+				   'X-RateLimit-Reset': f'{time.time() + reset_after:.3f}',
+				   'X-RateLimit-Reset-After': f'{reset_after:.3f}'}
+		if bucket[1] == 0:
+			self.limited['bucket'] += 1
+			headers.update({'X-RateLimit-Remaining': '0', 'Retry-After': f'{reset_after:.3f}'})
+			return headers, json_response({'message': 'You are being rate limited.', 'global': False,
+											   'retry_after': reset_after * 1000}, status=429, headers=headers)
+		bucket[1] -= 1
+		headers['X-RateLimit-Remaining'] = str(bucket[1])
+		return headers, None
+
+	async def _answer(self, request: web.Request, route: str, respond):
+		"""
+		Runs a handler after the request's latency if its buckets allow it
+		:param request: The request
+		:param route: Its rate_limits key
+		:param respond: A coroutine function taking the channel and message ids and returning the json body
+		:return: The web.Response
+		"""
+		channel = int(request.match_info['channel'])
+		message = int(request.match_info['message']) if 'message' in request.match_info else None
+		headers, refused = self._limit(route, channel)
+		if refused is not None:
+			return refused
+		await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+		self.calls[route] = self.calls.get(route, 0) + 1
+		second = int(time.monotonic() - self.start)
+		self.per_second[second] = self.per_second.get(second, 0) + 1
+		data = await respond(request, channel, message)
+		for listener in self.listeners:
+			listener(route, channel, message, data)
+		if data is None:
+			return web.Response(status=204, headers=headers)
+		return json_response(data, headers=headers)
+
+	def message_json(self, message_id: int, channel: int, author: dict, content: str, embeds: list = ()):
+		guild = self.channel_guilds.get(channel)
+		data = {'id': str(message_id), 'channel_id': str(channel), 'type': 0, 'content': content,
+				'author': author, 'attachments': [], 'embeds': list(embeds), 'mentions': [], 'mention_roles': [],
+				'pinned': False, 'mention_everyone': False, 'tts': False, 'flags': 0, 'edited_timestamp': None,
+				'timestamp': datetime.utcnow().isoformat() + '+00:00'}
+		if guild is not None:
+			data.update({'guild_id': str(guild), 'member': member_json(author)})
+		return data
+
+	async def me(self, request: web.Request):
+		return json_response(self.bot)
+
+	async def send(self, request: web.Request):
+		async def respond(request, channel, _):
+			if request.content_type.startswith('multipart/'):  # messages with files carry their json in a field
+				payload = {}
+				async for part in (await request.multipart()):
+					if part.name == 'payload_json':
+						payload = json.loads(await part.text())
+					else:
+						await part.read()
+			else:
+				payload = await request.json()
+			embeds = [payload['embed']] if payload.get('embed') else []
+			data = self.message_json(next(self.ids), channel, self.bot, payload.get('content') or '', embeds)
+			self.gateway.dispatch('MESSAGE_CREATE', data)
+			return data
+		return await self._answer(request, 'send', respond)
+
+	async def edit(self, request: web.Request):
+		async def respond(request, channel, message):
+			payload = await request.json()
+			data = self.message_json(message, channel, self.bot, payload.get('content') or '',
+									 [payload['embed']] if payload.get('embed') else [])
+			self.gateway.dispatch('MESSAGE_UPDATE', data)
+			return data
+		return await self._answer(request, 'edit', respond)
+
+	async def delete(self, request: web.Request):
+		async def respond(request, channel, message):
+			data = {'id': str(message), 'channel_id': str(channel)}
+			if channel in self.channel_guilds:
+				data['guild_id'] = str(self.channel_guilds[channel])
+			self.gateway.dispatch('MESSAGE_DELETE', data)
+			return None
+		return await self._answer(request, 'delete', respond)
+
+	def reaction_json(self, channel: int, message: int, emoji: str, user: dict):
+		data = {'user_id': user['id'], 'channel_id': str(channel), 'message_id': str(message),
+				'emoji': {'id': None, 'name': emoji}}
+		if channel in self.channel_guilds:
+			data.update({'guild_id': str(self.channel_guilds[channel]), 'member': member_json(user)})
+		return data
+
+	async def react(self, request: web.Request):
+		async def respond(request, channel, message):
+			emoji = unquote(request.match_info['emoji'])
+			self.gateway.dispatch('MESSAGE_REACTION_ADD', self.reaction_json(channel, message, emoji, self.bot))
+			return {'emoji': emoji}
+		return await self._answer(request, 'react', respond)
+
+	async def unreact(self, request: web.Request):
+		async def respond(request, channel, message):
+			user = user_json(int(request.match_info['user']), 'user')
+			data = self.reaction_json(channel, message, unquote(request.match_info['emoji']), user)
+			data.pop('member', None)
+			self.gateway.dispatch('MESSAGE_REACTION_REMOVE', data)
+			return None
+		return await self._answer(request, 'react', respond)
+
+	async def other(self, request: web.Request):
+		self.unknown += 1
+		print(f'FakeDiscord: {request.method} {request.path} is not simulated')
+		return json_response({'message': 'Unknown route', 'code': 0}, status=404)
+
+	def stats(self):
+		"""
+		:return: A dict of REST request counts by route, 429s, the busiest second and unsimulated requests
+		"""
+		return {'requests': sum(self.calls.values()), 'routes': dict(self.calls), 'rate_limited': dict(self.limited),
+				'peak_per_sec': max(self.per_second.values(), default=0), 'global_limit': global_limit,
+				'unknown': self.unknown}
+
+
+""" Fake Minecraft Server """
+
+
+def pack_varint(value: int):
+	out = bytearray()
+	while True:
+		byte, value = value & 0x7F, value >> 7
+		out.append(byte | (0x80 if value else 0))
+		if not value:
+			return bytes(out)
+
+
+def unpack_varint(data: bytes, i: int = 0):
+	"""
+	:return: The varint at data[i] and the index after it
+	"""
+	value = shift = 0
+	while True:
+		byte = data[i]
+		i += 1
+		value |= (byte & 0x7F) << shift
+		if not byte & 0x80:
+			return value, i
+		shift += 7
+
+
+async def read_varint(reader: asyncio.StreamReader):
+	value = shift = 0
+	while shift < 35:
+		byte = (await reader.readexactly(1))[0]
+		value |= (byte & 0x7F) << shift
+		if not byte & 0x80:
+			return value
+		shift += 7
+	raise ValueError('varint is too long')
+
+
+class FakeMinecraft:
+	"""
+	Answers Minecraft status pings after a latency, with players joining and leaving between pings
+	"""
+
+	def __init__(self, rng: random.Random, latency: float = 0.05, players: int = 50):
+		"""
+		:param rng: The random generator latencies and players are drawn from
+		:param latency: Mean secs before a status is answered
+		:param players: Number of players who may be online, named player0, player1...
+		"""
+		self.rng = rng
+		self.latency = latency
+		self.players = [f'player{i}' for i in range(players)]
+		self.online = set(rng.sample(self.players, min(len(self.players), 12)))
+		self.server = None
+		self.pings = 0
+
+	async def serve(self, host: str = '127.0.0.1'):
+		"""
+		:return: The server's ip as the bot registers it, host:port
+		"""
+		self.server = await asyncio.start_server(self.handle, host, 0)
+		return f'{host}:{self.server.sockets[0].getsockname()[1]}'
+
+	async def close(self):
+		if self.server is not None:
+			self.server.close()
+			await self.server.wait_closed()
+
+	def status_json(self):
+		if self.players and self.rng.random() < 0.5:  # someone joins or leaves
+			self.online ^= {self.rng.choice(self.players)}
+		sample = [{'name': name, 'id': '00000000-0000-0000-0000-000000000000'} for name in sorted(self.online)]
+		return {'version': {'name': '1.20.1', 'protocol': 763}, 'description': {'text': 'A replay server'},
+				'players': {'online': len(sample), 'max': len(self.players), 'sample': sample[:12]}}
+
+	async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		def send(packet: bytes):
+			writer.write(pack_varint(len(packet)) + packet)
+
+		try:
+			handshaken = False
+			while True:
+				packet = await reader.readexactly(await read_varint(reader))
+				packet_id, i = unpack_varint(packet)
+				if not handshaken:  # the handshake's fields aren't needed to answer
+					handshaken = True
+				elif packet_id == 0:
+					await asyncio.sleep(self.latency * self.rng.uniform(0.5, 1.5))
+					self.pings += 1
+					status = json.dumps(self.status_json()).encode('utf-8')
+					send(pack_varint(0) + pack_varint(len(status)) + status)
+				elif packet_id == 1:  # the ping token is echoed back
+					send(pack_varint(1) + packet[i:])
+				await writer.drain()
+		except (asyncio.IncompleteReadError, ConnectionError, ValueError, IndexError):
+			pass
+		finally:
+			writer.close()
+
+
+""" Simulated Users """
+
+
+class Replayer:
+	"""
+	Sends the workload's commands as gateway messages at their scaled times and plays the users' side of the bot's
+	paginated replies, turning pages and closing them. Runs on the fakes' event loop, so the time a reply takes
+	includes any time the bot's loop spends stalled. Every command starts by deleting the user's message, which marks
+	it as acknowledged, and a reply mentioning the user is matched to their latest acknowledged command, since some
+	commands (a successful add) never reply.
+	"""
+
+	def __init__(self, gateway: FakeGateway, discord: FakeDiscord, ids, rng: random.Random, args):
+		self.gateway = gateway
+		self.discord = discord
+		self.ids = ids
+		self.rng = rng
+		self.args = args
+		self.users = {}  # user key -> user json
+		self.user_ids = {}  # user id -> user key
+		self.guilds = {}  # guild key -> (guild id, channel ids)
+		self.commands = {}  # message id -> [user id, command name, perf counter time sent, acknowledged]
+		self.waiting = {}  # user id -> message ids of their commands not replied to yet, oldest first
+		self.turns = {}  # message id -> perf counter time a page turn was sent
+		self.owners = {}  # message id -> (user id, command name) of bot replies
+		self.paged = set()  # message ids of replies with page controls
+		self.latencies = {}  # command name -> reply latencies in secs
+		self.ack_latencies = []
+		self.turn_latencies = []
+		self.sent = 0
+		self.acked = 0
+		self.replied = 0
+		self.first = None
+		self.last = None
+		self.tasks = set()
+		self.readied = False
+		discord.listeners.append(self.on_request)
+
+	def guild(self, key: str):
+		"""
+		:return: The (guild id, channel ids) of a simulated guild, sending its GUILD_CREATE the first time
+		"""
+		guild = self.guilds.get(key)
+		if guild is None:
+			guild_id = first_guild + len(self.guilds)
+			channels = [next(self.ids) for _ in range(self.args.channels)]
+			for channel in channels:
+				self.discord.channel_guilds[channel] = guild_id
+			guild = self.guilds[key] = (guild_id, channels)
+			if self.readied:
+				self.gateway.dispatch('GUILD_CREATE', guild_json(guild_id, channels, self.discord.bot))
+		return guild
+
+	def user(self, key: str, name: str):
+		user = self.users.get(key)
+		if user is None:
+			user = self.users[key] = user_json(first_user + len(self.users), name)
+			self.user_ids[int(user['id'])] = key
+		return user
+
+	def ready(self, guild_keys: list):
+		"""
+		Sends READY with the guilds the workload's first commands are in
+		:return: None
+		"""
+		guilds = [self.guild(key) for key in guild_keys]
+		self.readied = True
+		self.gateway.dispatch('READY', {'v': 6, 'user': self.discord.bot, 'session_id': 'replay',
+										'guilds': [guild_json(guild_id, channels, self.discord.bot)
+												   for guild_id, channels in guilds],
+										'private_channels': [], 'relationships': []})
+
+	def send(self, user_key: str, user_name: str, guild_key: str, content: str):
+		guild_id, channels = self.guild(guild_key)
+		user = self.user(user_key, user_name)
+		channel = channels[int(user['id']) % len(channels)]
+		message = next(self.ids)
+		self.commands[message] = [int(user['id']), content[1:].split(' ', 1)[0].lower(), time.perf_counter(), False]
+		self.waiting.setdefault(int(user['id']), []).append(message)
+		self.sent += 1
+		self.first = self.first or time.perf_counter()
+		self.gateway.dispatch('MESSAGE_CREATE', self.discord.message_json(message, channel, user, content))
+
+	def on_request(self, route: str, channel: int, message: int, data):
+		"""
+		FakeDiscord listener, matches replies to the commands waiting on them and plays the users' reactions
+		:return: None
+		"""
+		now = time.perf_counter()
+		if route == 'send':
+			mention = re.search(r'<@!?(\d+)>', data['content'])
+			waiting = self.waiting.get(int(mention.group(1))) if mention else None
+			if waiting:
+				acked = [command for command in waiting if self.commands[command][3]]
+				command = acked[-1] if acked else waiting[0]
+				waiting.remove(command)
+				user_id, name, sent, _ = self.commands[command]
+				self.latencies.setdefault(name, []).append(now - sent)
+				self.owners[int(data['id'])] = (user_id, name)
+				self.replied += 1
+				self.last = now
+		elif route == 'edit':
+			sent = self.turns.pop(message, None)
+			if sent is not None:
+				self.turn_latencies.append(now - sent)
+		elif route == 'react' and data is not None and message in self.owners:
+			if data['emoji'] == right_arrow:
+				self.paged.add(message)
+			elif data['emoji'] == close:  # the last control, the user can react from here
+				self._spawn(self.react(channel, message))
+		elif route == 'delete' and message in self.commands:
+			command = self.commands[message]
+			if not command[3]:
+				command[3] = True
+				self.ack_latencies.append(now - command[2])
+				self.acked += 1
+				self.last = max(self.last or now, now)
+		elif route == 'delete':
+			self.owners.pop(message, None)
+			self.paged.discard(message)
+
+	def _spawn(self, coroutine):
+		task = asyncio.get_running_loop().create_task(coroutine)
+		self.tasks.add(task)
+		task.add_done_callback(self.tasks.discard)
+
+	async def react(self, channel: int, message: int):
+		"""
+		A user reading a reply: turns a few pages of a paged one and then closes it, or sometimes leaves it to time out
+		:return: None
+		"""
+		user_id, _ = self.owners[message]
+		user = self.users[self.user_ids[user_id]]
+		turns = int(self.rng.expovariate(1 / self.args.turns)) if message in self.paged and self.args.turns else 0
+		for emoji in [right_arrow] * turns + ([close] if self.rng.random() < self.args.close else []):
+			await asyncio.sleep(self.rng.uniform(0.5, 1.5) * self.args.think / self.args.speed)
+			if message not in self.owners:  # it timed out while the user was reading
+				return
+			if emoji == right_arrow:
+				self.turns[message] = time.perf_counter()
+			self.gateway.dispatch('MESSAGE_REACTION_ADD', self.discord.reaction_json(channel, message, emoji, user))
+
+	async def run(self, workload: list):
+		"""
+		Sends every command at its time divided by the speed, then waits for acknowledgements and replies until drain
+		secs pass without one
+		:return: None
+		"""
+		loop = asyncio.get_running_loop()
+		start = loop.time()
+		for at, user_key, user_name, guild_key, content in workload:
+			delay = start + at / self.args.speed - loop.time()
+			if delay > 0:
+				await asyncio.sleep(delay)
+			self.send(user_key, user_name, guild_key, content)
+		waited = 0.0
+		while (self.acked < self.sent or self.replied < self.sent) and waited < self.args.drain:
+			progress = (self.acked, self.replied)
+			await asyncio.sleep(0.1)
+			waited = 0.0 if (self.acked, self.replied) != progress else waited + 0.1
+		for task in list(self.tasks):
+			task.cancel()
+
+	def stats(self):
+		"""
+		:return: A dict of sent, acknowledged, replied and unanswered commands, reply throughput and latency
+		percentiles in ms
+		"""
+		everything = [secs for samples in self.latencies.values() for secs in samples]
+		elapsed = (self.last - self.first) if self.last and self.first else None
+
+		def ms(samples):
+			return {'n': len(samples), **{f'p{int(q * 100)}_ms': (percentile(samples, q) or 0) * 1000
+										   for q in (0.5, 0.9, 0.99)},
+					'max_ms': max(samples, default=0) * 1000}
+
+		return {'sent': self.sent, 'acked': self.acked, 'replied': self.replied, 'unanswered': self.sent - self.acked,
+				'replies_per_sec': self.replied / elapsed if elapsed else 0, 'latency': ms(everything),
+				'ack': ms(self.ack_latencies), 'page_turns': ms(self.turn_latencies),
+				'commands': {command: ms(samples) for command, samples in sorted(self.latencies.items())}}
+
+
+""" Stall Monitor """
+
+
+class StallMonitor:
+	"""
+	Wakes up every interval on the bot's event loop and records how late each wake up was
+	"""
+
+	def __init__(self, interval: float = monitor_interval, threshold: float = stall_secs):
+		self.interval = interval
+		self.threshold = threshold
+		self.samples = []
+		self.task = None
+
+	def start(self, loop: asyncio.AbstractEventLoop):
+		self.task = loop.create_task(self.run())
+
+	async def run(self):
+		loop = asyncio.get_running_loop()
+		while True:
+			expected = loop.time() + self.interval
+			await asyncio.sleep(self.interval)
+			self.samples.append(max(loop.time() - expected, 0.0))
+
+	def stats(self):
+		"""
+		:return: A dict of lateness percentiles and the longest stall in ms, and the number of stalls
+		"""
+		return {'p50_ms': (percentile(self.samples, 0.5) or 0) * 1000,
+				'p99_ms': (percentile(self.samples, 0.99) or 0) * 1000, 'max_ms': max(self.samples, default=0) * 1000,
+				'stalls': sum(1 for lag in self.samples if lag > self.threshold), 'threshold_ms': self.threshold * 1000}
+
+
+""" Replay """
+
+
+async def replay(mcdb, workload: list, args: argparse.Namespace):
+	"""
+	Starts the fakes on their own thread, connects the bot to them and runs the workload through it
+	:param mcdb: The imported bot module
+	:param workload: The workload list
+	:param args: The parsed arguments
+	:return: A results dict
+	"""
+	client = mcdb.client
+	bot_loop = asyncio.get_running_loop()
+	fake_loop = asyncio.new_event_loop()
+	thread = threading.Thread(target=fake_loop.run_forever, name='mcdb-replay-fakes', daemon=True)
+	thread.start()
+
+	def on_fakes(coroutine):
+		return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, fake_loop))
+
+	rng = random.Random(args.seed)
+	ids = iter(range(first_id, first_id + 2 ** 40))
+	gateway = FakeGateway(client, bot_loop)
+	fake_discord = FakeDiscord(gateway, ids, random.Random(rng.random()), latency=args.rest_latency / 1000)
+	minecraft = [FakeMinecraft(random.Random(rng.random()), latency=args.ping_latency / 1000, players=args.players)
+				 for _ in range(args.servers)]
+	replayer = Replayer(gateway, fake_discord, ids, random.Random(rng.random()), args)
+	monitor = StallMonitor(threshold=args.stall_ms / 1000)
+	try:
+		discord.http.Route.BASE = await on_fakes(fake_discord.serve())
+		ips = [await on_fakes(server.serve()) for server in minecraft]
+
+		# the ws is only asked to change the bot's presence, the gateway's events come from FakeGateway
+		class FakeWebSocket:
+			open = False
+			latency = 0.0
+
+			async def change_presence(self, **kwargs):
+				pass
+
+		client.ws = FakeWebSocket()
+		client._connection.guild_ready_timeout = 0.1
+		await client.login('replay-token')
+		guild_keys = list(dict.fromkeys(event[3] for event in workload))
+		fake_loop.call_soon_threadsafe(replayer.ready, guild_keys)
+		await client.wait_until_ready()
+		# the first guild is the home guild, whose store was loaded from .resources, every guild gets a fake server
+		mcdb.guilds.home_guild_id = first_guild
+		mcdb.servers.guild_servers[mcdb.home_key] = [ips[0]]
+		mcdb.servers.entry(ips[0], members=mcdb.store.files['members'],
+						   presence=mcdb.PresenceHistory(mcdb.json_files['presence']))
+		for n, key in enumerate(guild_keys[1:], 1):
+			mcdb.servers.register(mcdb.guilds.key(first_guild + n), ips[n % len(ips)])
+		monitor.start(bot_loop)
+		started = time.perf_counter()
+		await on_fakes(replayer.run(workload))
+		elapsed = time.perf_counter() - started
+	finally:
+		if monitor.task is not None:
+			monitor.task.cancel()
+		await on_fakes(fake_discord.close())
+		for server in minecraft:
+			await on_fakes(server.close())
+		fake_loop.call_soon_threadsafe(fake_loop.stop)
+		thread.join()
+
+	results = replayer.stats()
+	rest = fake_discord.stats()
+	waited = sum(value for _, value in mcdb.metrics.counter_values('mcdb_discord_rate_limit_wait_seconds_total'))
+	results.update({
+		'elapsed_secs': elapsed, 'commands_per_sec': replayer.sent / elapsed if elapsed else 0,
+		'event_loop': monitor.stats(),
+		'discord': {**rest, 'requests_per_command': rest['requests'] / replayer.sent if replayer.sent else 0,
+					'rate_limit_wait_secs': waited, 'gateway_events': gateway.events, 'gateway_errors': gateway.errors},
+		'minecraft': {'pings': sum(server.pings for server in minecraft), 'servers': len(minecraft)}
+	})
+	return results
+
+
+""" Reporting """
+
+
+def print_results(results: dict):
+	latency, loop, rest = results['latency'], results['event_loop'], results['discord']
+	print(f'\n{results["sent"]} commands in {results["elapsed_secs"]:.1f}s, {results["acked"]} acknowledged, '
+		  f'{results["replied"]} replied, {results["unanswered"]} unanswered, '
+		  f'{results["replies_per_sec"]:.1f} replies/s')
+	print(f'{"command":<16}{"n":>7}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+	rows = [('all', latency), ('acknowledged', results['ack']), ('page turns', results['page_turns']),
+			*results['commands'].items()]
+	for name, row in rows:
+		print(f'{name:<16}{row["n"]:>7}{row["p50_ms"]:>10.1f}{row["p90_ms"]:>10.1f}{row["p99_ms"]:>10.1f}'
+			  f'{row["max_ms"]:>10.1f}')
+	print(f'\nevent loop lateness p50 {loop["p50_ms"]:.1f}ms, p99 {loop["p99_ms"]:.1f}ms, max {loop["max_ms"]:.1f}ms, '
+		  f'{loop["stalls"]} stalls over {loop["threshold_ms"]:.0f}ms')
+	print(f'discord {rest["requests"]} requests ({rest["requests_per_command"]:.1f} a command), busiest second '
+		  f'{rest["peak_per_sec"]}/{rest["global_limit"]}, 429s {rest["rate_limited"]}, waited '
+		  f'{rest["rate_limit_wait_secs"]:.1f}s on rate limits')
+	print('routes ' + ', '.join(f'{route} {count}' for route, count in sorted(rest['routes'].items())))
+	print(f'minecraft {results["minecraft"]["pings"]} status pings answered')
+
+
+def failures(results: dict, args: argparse.Namespace):
+	"""
+	:return: A list of the thresholds the run missed
+	"""
+	missed = []
+	if args.max_p99 is not None and results['latency']['p99_ms'] > args.max_p99:
+		missed.append(f'reply p99 {results["latency"]["p99_ms"]:.1f}ms > {args.max_p99}ms')
+	if args.max_stall is not None and results['event_loop']['max_ms'] > args.max_stall:
+		missed.append(f'longest stall {results["event_loop"]["max_ms"]:.1f}ms > {args.max_stall}ms')
+	limited = sum(results['discord']['rate_limited'].values())
+	if args.max_rate_limited is not None and limited > args.max_rate_limited:
+		missed.append(f'{limited} requests refused with 429 > {args.max_rate_limited}')
+	if results['unanswered']:
+		missed.append(f'{results["unanswered"]} commands never acknowledged')
+	return missed
+
+
+def main():
+	parser = argparse.ArgumentParser(description='Replays a command workload through the bot against fake Discord '
+												 'and Minecraft servers')
+	parser.add_argument('--log', help='CommandLog.jsonl or legacy CommandLog.json to replay, a synthetic workload '
+									  'is generated without one')
+	parser.add_argument('--resources', default='./.resources',
+						help='data folder copied for the run, the bot never touches the original')
+	parser.add_argument('--speed', type=float, default=10, help='times faster than the recorded or synthetic rate')
+	parser.add_argument('--limit', type=int, help='replay at most this many commands')
+	parser.add_argument('--commands', type=int, default=2000, help='synthetic commands')
+	parser.add_argument('--rate', type=float, default=2, help='synthetic commands a second at real time')
+	parser.add_argument('--users', type=int, default=200, help='synthetic users')
+	parser.add_argument('--guilds', type=int, default=4, help='guilds the synthetic users are spread over')
+	parser.add_argument('--channels', type=int, default=1, help='command channels in each guild')
+	parser.add_argument('--turns', type=float, default=1, help='mean page turns a user makes on a paged reply')
+	parser.add_argument('--close', type=float, default=0.8, help='chance a user closes a reply instead of leaving it')
+	parser.add_argument('--think', type=float, default=3, help='mean secs between a user\'s reactions at real time')
+	parser.add_argument('--rest-latency', type=float, default=50, help='mean ms a Discord REST request takes')
+	parser.add_argument('--ping-latency', type=float, default=50, help='mean ms a Minecraft status ping takes')
+	parser.add_argument('--servers', type=int, default=1, help='fake Minecraft servers the guilds are spread over')
+	parser.add_argument('--players', type=int, default=50, help='players who may be online on each server')
+	parser.add_argument('--drain', type=float, default=30, help='secs to wait for replies after the last command')
+	parser.add_argument('--stall-ms', type=float, default=stall_secs * 1000, help='lateness counted as a stall')
+	parser.add_argument('--guild-backend', choices=['json', 'sqlite', 'columnar'],
+						help='storage backend the guilds other than the home guild are opened with, default the bot\'s')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--keep', action='store_true', help='keep the run\'s data folder')
+	parser.add_argument('--out', help='write the results to this json file')
+	parser.add_argument('--max-p99', type=float, help='fail if the reply p99 is over this many ms')
+	parser.add_argument('--max-stall', type=float, help='fail if the event loop stalls longer than this many ms')
+	parser.add_argument('--max-rate-limited', type=int, help='fail if more requests than this get a 429')
+	args = parser.parse_args()
+
+	log = os.path.abspath(args.log) if args.log else None
+	out = os.path.abspath(args.out) if args.out else None
+	work = tempfile.mkdtemp(prefix='mcdb-replay-')
+	if os.path.isdir(args.resources):
+		shutil.copytree(args.resources, os.path.join(work, '.resources'))
+	else:
+		os.makedirs(os.path.join(work, '.resources'))
+	# the bot's files are relative to the working directory, so the run reads and writes only the copy
+	os.chdir(work)
+	sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+	import mcdb
+	if args.guild_backend:
+		# the other guilds are opened on a worker thread, so this checks each backend opens off the event loop
+		mcdb.guilds.paths = {**mcdb.guilds.paths, 'backend': args.guild_backend}
+	try:
+		mcdb.store.load()
+		if log is not None:
+			workload = recorded_workload(log, mcdb.cmd_prefix)
+		else:
+			workload = synthetic_workload(random.Random(args.seed), args.commands, args.rate, args.users, args.guilds,
+										  list(mcdb.store.locations), mcdb.cmd_prefix)
+		workload = workload[:args.limit] if args.limit else workload
+		if not workload:
+			print(f'Nothing to replay in {log}')
+			sys.exit(2)
+		print(f'replaying {len(workload)} commands over {workload[-1][0] / args.speed:.1f}s at {args.speed}x '
+			  f'from {log or "a synthetic workload"} in {work}')
+		results = mcdb.client.loop.run_until_complete(replay(mcdb, workload, args))
+	finally:
+		mcdb.command_log.flush()
+		mcdb.guilds.close()
+		mcdb.servers.close()
+		os.chdir(os.path.dirname(os.path.abspath(__file__)))
+		if not args.keep:
+			shutil.rmtree(work, ignore_errors=True)
+
+	print_results(results)
+	if out:
+		with open(out, 'w') as file_w:
+			json.dump({'meta': {'date': datetime.now().isoformat(timespec='seconds'), 'workload': log or 'synthetic',
+								**{key: value for key, value in vars(args).items() if key not in ('log', 'out')}},
+					   'results': results}, file_w, indent=4)
+	missed = failures(results, args)
+	if missed:
+		print(f'\n{len(missed)} thresholds missed: {", ".join(missed)}')
+		sys.exit(1)
+
+
+if __name__ == '__main__':
+	main()
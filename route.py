@@ -0,0 +1,274 @@
+"""
+Title: MCDB Route Planner
+Author: Billy Cobb
+Desc: Orders multi-stop trips between stored locations with a nearest-neighbour tour improved by 2-opt, optionally
+travelling through the guild's Nether portals, from a distance matrix cached and kept up to date like an index
+"""
+
+from spatial import dimension_scale, distance
+
+
+""" Route Vars """
+
+
+max_two_opt_passes = 50  # passes over every segment pair, a tour of a few dozen stops settles in far fewer
+
+
+def position(loc: dict, dim: str):
+	"""
+	:param loc: The stored location dict
+	:param dim: Full name of the dimension the position is wanted in
+	:return: The location's (x, y, z) in dim's coordinates, scaling nether/overworld 8:1, or None if the location
+	is in a dimension that isn't linked to dim
+	"""
+	if loc["Dimension"] == dim:
+		return loc["X"], loc["Y"], loc["Z"]
+	if loc["Dimension"] not in dimension_scale or dim not in dimension_scale:
+		return None
+	factor = dimension_scale[loc["Dimension"]] / dimension_scale[dim]
+	return loc["X"] * factor, loc["Y"], loc["Z"] * factor
+
+
+def tour(dist: list):
+	"""
+	Orders the stops of an open trip starting from the first, nearest unvisited stop first, then reverses segments
+	of it (2-opt) while that shortens it
+	:param dist: A symmetric matrix of distances between stops, stop 0 being the start
+	:return: The list of stop indexes in visiting order, starting with 0
+	"""
+	order = [0]
+	unvisited = set(range(1, len(dist)))
+	while unvisited:
+		row = dist[order[-1]]
+		nearest = min(unvisited, key=row.__getitem__)
+		unvisited.remove(nearest)
+		order.append(nearest)
+
+	n = len(order)
+	for _ in range(max_two_opt_passes):
+		improved = False
+		for i in range(1, n - 1):
+			for j in range(i + 1, n):
+				# reversing order[i:j + 1] swaps edges (i - 1, i) and (j, j + 1) for (i - 1, j) and (i, j + 1)
+				a, b, c = order[i - 1], order[i], order[j]
+				delta = dist[a][c] - dist[a][b]
+				if j + 1 < n:
+					d = order[j + 1]
+					delta += dist[b][d] - dist[c][d]
+				if delta < -1e-9:
+					order[i:j + 1] = order[i:j + 1][::-1]
+					improved = True
+		if not improved:
+			break
+	return order
+
+
+""" Route Index """
+
+
+class RouteIndex:
+	"""
+	The Nether portals among a guild's locations and the travel distances between locations already routed,
+	attached to a DataStore like an index. Any overworld or nether location filed under the portal tag is a portal,
+	linking its overworld and nether coordinates. Shortest paths between every pair of portals, walking either side, are
+	kept as a matrix that a new portal is folded into in O(portals^2); removing one rebuilds it on the next route.
+	Adding or removing a location only drops the cached distances to it, unless it is a portal, which can change
+	any distance travelled through portals.
+	"""
+
+	def __init__(self, tag: str = 'portal', max_pairs: int = 200000):
+		"""
+		:param tag: Locations filed under this tag are portals, None to have none
+		:param max_pairs: Most cached distances, every one is dropped once there are more
+		"""
+		self.tag = tag
+		self.max_pairs = max_pairs
+		self.portals = {}  # name -> {dim: (x, y, z) of that side of the portal}
+		self.paths = None  # portal -> {portal: shortest travel between them}, None until a route needs it
+		self.matrices = {}  # (dim, through portals) -> {name: {name: travel distance}}
+		self.pairs = 0
+		self.hits = 0
+		self.computed = 0
+		self.graph_builds = 0
+
+	def _sides(self, name: str, loc: dict):
+		"""
+		:return: The portal's {dim: (x, y, z)} sides, or None if the location isn't a Nether portal
+		"""
+		if not self.tag or self.tag not in loc.get("Tags", ()) or loc["Dimension"] not in dimension_scale:
+			return None
+		return {dim: position(loc, dim) for dim in dimension_scale}
+
+	def rebuild(self, locations: dict):
+		self.portals = {}
+		for name, loc in locations.items():
+			sides = self._sides(name, loc)
+			if sides is not None:
+				self.portals[name] = sides
+		self.paths = None
+		self.matrices = {}
+		self.pairs = 0
+
+	def insert(self, name: str, loc: dict):
+		self._forget(name)
+		sides = self._sides(name, loc)
+		if sides is not None:
+			self._add_portal(name, sides)
+			self._forget_routed()
+
+	def delete(self, name: str, loc: dict):
+		self._forget(name)
+		if self.portals.pop(name, None) is not None:
+			self.paths = None
+			self._forget_routed()
+
+	def _forget(self, name: str):
+		"""
+		Drops the cached distances to and from a location
+		"""
+		for matrix in self.matrices.values():
+			row = matrix.pop(name, None)
+			if row:
+				for other in row:
+					matrix[other].pop(name, None)
+				self.pairs -= len(row)
+
+	def _forget_routed(self):
+		"""
+		Drops every distance that may have been travelled through a portal
+		"""
+		for key in [key for key in self.matrices if key[1]]:
+			self.pairs -= sum(map(len, self.matrices.pop(key).values())) // 2
+
+	def _edge(self, p: str, q: str):
+		"""
+		:return: The shorter walk between two portals, on either side
+		"""
+		return min(distance(self.portals[p][dim], self.portals[q][dim]) for dim in dimension_scale)
+
+	def _add_portal(self, name: str, sides: dict):
+		"""
+		Adds a portal, folding it into the shortest path matrix if one is built
+		"""
+		self.portals[name] = sides
+		if self.paths is None:
+			return
+		paths = self.paths
+		# the new portal's shortest path to q leaves it by a direct walk to some portal j
+		row = {q: min(self._edge(name, j) + paths[j][q] for j in paths) for q in paths}
+		for p in paths:
+			paths[p][name] = row[p]
+		row[name] = 0
+		paths[name] = row
+		for p in paths:
+			for q in paths:
+				through = row[p] + row[q]
+				if through < paths[p][q]:
+					paths[p][q] = through
+
+	def _graph(self):
+		"""
+		:return: The shortest path matrix between every pair of portals, built with Floyd-Warshall if it isn't
+		"""
+		if self.paths is None:
+			names = list(self.portals)
+			paths = {p: {q: self._edge(p, q) if p != q else 0 for q in names} for p in names}
+			for k in names:
+				via_k = paths[k]
+				for p in names:
+					row = paths[p]
+					to_k = row[k]
+					for q in names:
+						if to_k + via_k[q] < row[q]:
+							row[q] = to_k + via_k[q]
+			self.paths = paths
+			self.graph_builds += 1
+		return self.paths
+
+	def _reach(self, point: tuple, dim: str):
+		"""
+		:param point: The (x, y, z) a trip leaves from, in dim's coordinates
+		:return: {portal: (travel distance to it through the portal graph, the portal first walked to in dim)}
+		"""
+		paths = self._graph()
+		walks = {p: distance(point, sides[dim]) for p, sides in self.portals.items()}
+		return {q: min((walk + paths[p][q], p) for p, walk in walks.items()) for q in walks}
+
+	def _leg(self, start: tuple, end: tuple, dim: str, reach: dict):
+		"""
+		:param reach: _reach() of start, None to only walk directly
+		:return: (travel distance, (entry portal, exit portal) or None if walking directly is shorter)
+		"""
+		best = (distance(start, end), None)
+		for q, (travelled, p) in (reach or {}).items():
+			dist = travelled + distance(self.portals[q][dim], end)
+			if dist < best[0]:
+				best = (dist, (p, q))
+		return best
+
+	def distances(self, names: list, points: dict, dim: str, portals: bool = False):
+		"""
+		Returns the travel distances between locations, computing only the pairs that aren't cached
+		:param names: Names of the locations
+		:param points: {name: (x, y, z)} of every location in dim's coordinates
+		:param dim: Full name of the dimension the trip is travelled in
+		:param portals: Also travel through the portals, every block walked counting once whichever dimension it
+		is in, so a block walked in the nether covers 8 in the overworld
+		:return: A symmetric matrix of distances, in the order of names
+		"""
+		portals = portals and dim in dimension_scale and bool(self.portals)
+		if self.pairs > self.max_pairs:
+			self.matrices = {}
+			self.pairs = 0
+		matrix = self.matrices.setdefault((dim, portals), {})
+		reaches = {}
+		dist = [[0.0] * len(names) for _ in names]
+		for i, a in enumerate(names):
+			row = matrix.setdefault(a, {})
+			for j in range(i + 1, len(names)):
+				b = names[j]
+				value = row.get(b)
+				if value is None:
+					if portals and a not in reaches:
+						reaches[a] = self._reach(points[a], dim)
+					value = row[b] = self._leg(points[a], points[b], dim, reaches.get(a))[0]
+					matrix.setdefault(b, {})[a] = value
+					self.pairs += 1
+					self.computed += 1
+				else:
+					self.hits += 1
+				dist[i][j] = dist[j][i] = value
+		return dist
+
+	def route(self, locations: dict, dim: str, start: str, stops: list, portals: bool = False):
+		"""
+		Plans a trip from a location visiting every stop once
+		:param locations: The dict of stored locations keyed by name
+		:param dim: Full name of the dimension the trip is travelled in
+		:param start: Name of the location the trip starts from
+		:param stops: Names of the locations to visit, in any order
+		:param portals: Also travel through the portals
+		:return: (total distance, a list of (name, leg distance, (entry portal, exit portal) or None) in visiting
+		order, the start first with a leg of 0)
+		"""
+		names = [start] + [name for name in dict.fromkeys(stops) if name != start]
+		points = {name: position(locations[name], dim) for name in names}
+		dist = self.distances(names, points, dim, portals)
+		order = [names[i] for i in tour(dist)]
+
+		portals = portals and dim in dimension_scale and bool(self.portals)
+		legs = [(start, 0, None)]
+		total = 0
+		for a, b in zip(order, order[1:]):
+			# only the legs taken are traced back through the portals, the matrix just keeps their lengths
+			leg, via = self._leg(points[a], points[b], dim, self._reach(points[a], dim) if portals else None)
+			legs.append((b, leg, via))
+			total += leg
+		return total, legs
+
+	def stats(self):
+		"""
+		:return: A dict of portal and cached distance counts, cache hits and portal graph builds
+		"""
+		return {'portals': len(self.portals), 'pairs': self.pairs, 'hits': self.hits, 'computed': self.computed,
+				'graph_builds': self.graph_builds}
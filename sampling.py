@@ -0,0 +1,82 @@
+"""
+Title: MCDB Random Sampling
+Author: Billy Cobb
+Desc: Per-dimension arrays of location names so random picks a location in O(1)
+"""
+
+import random
+
+
+""" Random Index """
+
+
+class RandomIndex:
+	"""
+	Keeps the location names of each dimension in a list, with each name's position in a dict. Adding appends and
+	removing moves the last name into the gap, so both are O(1) and a random pick is one randrange.
+	"""
+
+	def __init__(self, rng: random.Random = None):
+		"""
+		:param rng: The random generator to pick with, defaults to the random module's
+		"""
+		self.rng = rng or random.Random()
+		self.names = {}  # dimension -> list of names
+		self.positions = {}  # name -> index in its dimension's list
+
+	def rebuild(self, locations: dict):
+		"""
+		Throws away the name lists and reindexes every location
+		:param locations: The dict of stored locations keyed by name
+		:return: None
+		"""
+		self.names = {}
+		self.positions = {}
+		for name, loc in locations.items():
+			self.insert(name, loc)
+
+	def insert(self, name: str, loc: dict):
+		"""
+		Appends a location to its dimension's list, a name already indexed is left where it is
+		:param name: Name of the location
+		:param loc: The stored location dict
+		:return: None
+		"""
+		if name in self.positions:
+			return
+		names = self.names.setdefault(loc["Dimension"], [])
+		self.positions[name] = len(names)
+		names.append(name)
+
+	def delete(self, name: str, loc: dict):
+		"""
+		Removes a location, moving the last name of its dimension's list into its place
+		:param name: Name of the location
+		:param loc: The stored location dict
+		:return: None
+		"""
+		i = self.positions.pop(name, None)
+		if i is None:
+			return
+		names = self.names[loc["Dimension"]]
+		last = names.pop()
+		if last != name:
+			names[i] = last
+			self.positions[last] = i
+
+	def sample(self, dim: str = None):
+		"""
+		Picks a location uniformly at random, every location is equally likely whichever dimension it is in
+		:param dim: Only pick from this dimension, None to pick from every location
+		:return: A random location name, or None if there are none to pick from
+		"""
+		if dim is not None:
+			names = self.names.get(dim)
+			return names[self.rng.randrange(len(names))] if names else None
+		i = self.rng.randrange(len(self.positions)) if self.positions else None
+		if i is None:
+			return None
+		for names in self.names.values():  # one draw over every location, walking the few dimension lists
+			if i < len(names):
+				return names[i]
+			i -= len(names)
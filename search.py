@@ -0,0 +1,159 @@
+"""
+Title: MCDB Search Index
+Author: Billy Cobb
+Desc: Trigram index over location names used by find for substring and typo tolerant lookups
+"""
+
+from collections import Counter
+
+
+""" Search Vars """
+
+
+# rank of each kind of match, lower ranks are listed first
+match_ranks = {
+	'exact': 0,
+	'prefix': 1,
+	'substring': 2,
+	'fuzzy': 3
+}
+
+min_similarity = 0.3  # share of trigrams a name needs in common with the query to count as a fuzzy match
+
+
+""" Helper Functions """
+
+
+def trigrams(text: str, pad: bool = True):
+	"""
+	Splits text into its set of three character grams
+	:param text: The text to split
+	:param pad: Mark the start and end of the text so prefixes and suffixes get their own grams
+	:return: A set of trigram strings
+	"""
+	if pad:
+		text = f'\x02{text}\x03'
+	return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+""" Search Index """
+
+
+class SearchIndex:
+	"""
+	An inverted index from trigram to the names containing it, kept in sync with the DataStore. A substring
+	lookup intersects the posting sets of the query's trigrams and a fuzzy lookup counts shared trigrams.
+	"""
+
+	def __init__(self):
+		self.postings = {}  # trigram -> set of names
+		self.gram_counts = {}  # name -> number of padded trigrams in the name
+
+	def rebuild(self, locations: dict):
+		"""
+		Throws away the index and reindexes every location name
+		:param locations: The dict of stored locations keyed by name
+		:return: None
+		"""
+		self.postings = {}
+		self.gram_counts = {}
+		for name in locations:
+			self.insert(name, locations[name])
+
+	def insert(self, name: str, loc: dict = None):
+		"""
+		:param name: Name of the location
+		:param loc: The stored location dict, unused but matches the other indexes
+		:return: None
+		"""
+		grams = trigrams(name.lower())
+		for gram in grams:
+			self.postings.setdefault(gram, set()).add(name)
+		self.gram_counts[name] = len(grams)
+
+	def delete(self, name: str, loc: dict = None):
+		"""
+		:param name: Name of the location
+		:param loc: The stored location dict, unused but matches the other indexes
+		:return: None
+		"""
+		if self.gram_counts.pop(name, None) is None:
+			return
+		for gram in trigrams(name.lower()):
+			names = self.postings.get(gram)
+			if names is not None:
+				names.discard(name)
+				if not names:
+					del self.postings[gram]
+
+	def _substring(self, query: str):
+		"""
+		:return: Every indexed name containing query
+		"""
+		if len(query) < 3:
+			# too short to have a trigram of its own, but short queries are cheap to check directly
+			return [name for name in self.gram_counts if query in name.lower()]
+		postings = sorted((self.postings.get(gram, set()) for gram in trigrams(query, pad=False)), key=len)
+		candidates = set(postings[0])
+		for names in postings[1:]:
+			candidates &= names
+			if not candidates:
+				break
+		return [name for name in candidates if query in name.lower()]
+
+	def _fuzzy(self, query: str, exclude: set):
+		"""
+		:return: A list of (similarity, name) for names sharing enough trigrams with query
+		"""
+		grams = trigrams(query)
+		shared = Counter()
+		for gram in grams:
+			shared.update(self.postings.get(gram, ()))
+		found = []
+		for name, count in shared.items():
+			if name in exclude:
+				continue
+			similarity = 2 * count / (len(grams) + self.gram_counts[name])
+			if similarity >= min_similarity:
+				found.append((similarity, name))
+		return found
+
+	def names(self, query: str):
+		"""
+		:param query: The search term
+		:return: The set of names containing the term, unranked and without fuzzy matches
+		"""
+		query = query.lower().strip()
+		return set(self._substring(query)) if query else set()
+
+	def search(self, query: str, limit: int = 10, offset: int = 0):
+		"""
+		Finds names matching a query, ranked exact > prefix > substring > fuzzy
+		:param query: The search term
+		:param limit: Most results to return
+		:param offset: Number of ranked results to skip
+		:return: A tuple of the total number of matches and a list of (match kind, name) for the requested slice,
+		fuzzy matches are only counted once the slice reaches past the exact tiers
+		"""
+		query = query.lower().strip()
+		if not query:
+			return 0, []
+		ranked = []
+		for name in self._substring(query):
+			lowered = name.lower()
+			if lowered == query:
+				kind = 'exact'
+			elif lowered.startswith(query):
+				kind = 'prefix'
+			else:
+				kind = 'substring'
+			ranked.append((match_ranks[kind], len(name), name, kind))
+		ranked.sort()
+		results = [(kind, name) for _, _, name, kind in ranked]
+		total = len(results)
+		if total < offset + limit:
+			# only pay for fuzzy matching when the exact tiers don't fill the page
+			fuzzy = sorted(self._fuzzy(query, {name for _, name in results}), key=lambda match: (-match[0], match[1]))
+			results += [('fuzzy', name) for _, name in fuzzy]
+			total = len(results)
+		return total, results[offset:offset + limit]
@@ -0,0 +1,209 @@
+"""
+Title: MCDB Shards
+Author: Billy Cobb
+Desc: Splits the bot's gateway shards across processes that share the .resources data. Discord sends each guild's
+events to a single shard, so every guild namespace is only ever written by the process running that shard.
+"""
+
+import asyncio
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+import discord
+
+from guilds import home_key
+
+
+""" Shard Vars """
+
+
+shard_env = 'MCDB_SHARDS'  # set by the launcher for each process it starts
+restart_delay = 5  # secs before a process that exited with an error is started again
+
+
+def shard_of(guild_id: int, shard_count: int):
+	"""
+	:param guild_id: A Discord guild id
+	:param shard_count: Shards the bot connects with
+	:return: The shard Discord sends the guild's events to
+	"""
+	return (guild_id >> 22) % shard_count
+
+
+def plan(shard_count: int, processes: int, pinned: set = frozenset()):
+	"""
+	Splits the shard ids between processes. Pinned shards all go to the first process and the rest are dealt out
+	so every process runs the same number of shards, give or take one.
+	:param shard_count: Shards the bot connects with
+	:param processes: Processes to split them across, no more are used than there are shards
+	:param pinned: Shard ids the first process must run
+	:return: A list of sorted shard id lists, one per process
+	"""
+	shards = [[] for _ in range(max(1, min(processes, shard_count)))]
+	shards[0] += sorted(pinned)
+	for shard_id in range(shard_count):
+		if shard_id not in pinned:
+			min(shards, key=len).append(shard_id)
+	return [sorted(ids) for ids in shards]
+
+
+def process_path(path: str, process: int):
+	"""
+	:param path: String path to a file each process keeps its own copy of, such as the command log
+	:param process: The process number, the first process keeps the original path
+	:return: The path for that process, i.e. CommandLog-shard2.jsonl
+	"""
+	if not process:
+		return path
+	base, ext = os.path.splitext(path)
+	return f'{base}-shard{process}{ext}'
+
+
+def process_paths(path: str):
+	"""
+	:param path: String path given to process_path
+	:return: The paths every process has used for it, including processes from runs with more of them
+	"""
+	base, ext = os.path.splitext(path)
+	numbers = set()
+	for found in glob.glob(f'{glob.escape(base)}-shard*'):
+		match = re.match(r'-shard(\d+)', found[len(base):])
+		if match:
+			numbers.add(int(match.group(1)))
+	return [path] + [process_path(path, n) for n in sorted(numbers) if n]
+
+
+""" Shard Config """
+
+
+class ShardConfig:
+	"""
+	Which shards this process runs and which guild namespaces and Minecraft servers it owns. The home namespace
+	belongs to the first process, which also runs shard 0 where DMs arrive and the home guild's shard.
+	"""
+
+	def __init__(self, process: int = 0, shard_count: int = None, shards: list = None):
+		"""
+		:param process: This process's number
+		:param shard_count: Shards the bot connects with, None for an unsharded connection
+		:param shards: Every process's shard id lists from plan(), None when one process runs every shard
+		"""
+		self.process = process
+		self.shard_count = shard_count
+		self.shards = shards
+		self.processes = len(shards) if shards is not None else 1
+
+	@classmethod
+	def from_env(cls):
+		"""
+		:return: The ShardConfig the launcher gave this process, or one for a single process if it wasn't launched
+		"""
+		value = os.environ.get(shard_env)
+		if not value:
+			return cls()
+		config = json.loads(value)
+		return cls(config['process'], config['shard_count'], config['shards'])
+
+	def env(self, process: int):
+		"""
+		:param process: A process number
+		:return: The environment variable value for that process
+		"""
+		return json.dumps({'process': process, 'shard_count': self.shard_count, 'shards': self.shards})
+
+	@property
+	def shard_ids(self):
+		"""
+		:return: The shard ids this process connects, None for all of them
+		"""
+		return self.shards[self.process] if self.shards is not None else None
+
+	def owner(self, key: str):
+		"""
+		:param key: A namespace key
+		:return: The number of the process whose shards receive the guild's commands
+		"""
+		if self.shards is None or key == home_key:
+			return 0
+		shard_id = shard_of(int(key), self.shard_count)
+		return next(process for process, ids in enumerate(self.shards) if shard_id in ids)
+
+	def owns(self, key: str):
+		"""
+		:param key: A namespace key
+		:return: True if this process answers the guild's commands and is the only one writing its data
+		"""
+		return self.owner(key) == self.process
+
+	def stats(self):
+		return {'process': self.process, 'processes': self.processes, 'shards': len(self.shard_ids or ())}
+
+
+""" Launcher """
+
+
+async def recommended_shards(token: str):
+	"""
+	:param token: The bot token
+	:return: The number of shards Discord recommends for the bot
+	"""
+	http = discord.http.HTTPClient()
+	try:
+		await http.static_login(token, bot=True)
+		shard_count, _ = await http.get_bot_gateway()
+	finally:
+		await http.close()
+	return shard_count
+
+
+def launch(script: str, token: str, shard_count: int, processes: int, home_guild_id: int = None):
+	"""
+	Runs the bot as several processes, each connecting its share of the shards, and restarts any process that
+	exits with an error. Returns once every process has exited cleanly, or stops them all on Ctrl+C.
+	:param script: String path to the bot script each process runs
+	:param token: The bot token, used to ask Discord for a shard count
+	:param shard_count: Shards to connect with, 0 or None for Discord's recommended count
+	:param processes: Processes to split them across
+	:param home_guild_id: Id of the home guild, whose shard is run by the first process
+	:return: None
+	"""
+	if not shard_count:
+		shard_count = asyncio.run(recommended_shards(token))
+	pinned = {0} if home_guild_id is None else {0, shard_of(home_guild_id, shard_count)}
+	config = ShardConfig(shard_count=shard_count, shards=plan(shard_count, processes, pinned))
+	children = {}
+	restarts = {}  # process -> monotonic time it is started again
+
+	def start(process: int):
+		children[process] = subprocess.Popen([sys.executable, script], env={**os.environ,
+																			  shard_env: config.env(process)})
+		print(f'Started shard process {process} (pid {children[process].pid}) for shards {config.shards[process]}')
+
+	for process in range(config.processes):
+		start(process)
+	try:
+		while children or restarts:
+			time.sleep(1)
+			for process, child in list(children.items()):
+				code = child.poll()
+				if code is None:
+					continue
+				del children[process]
+				if code != 0:
+					print(f'launch() ERROR: shard process {process} exited with status {code}, restarting in '
+						  f'{restart_delay}s')
+					restarts[process] = time.monotonic() + restart_delay
+			for process, due in list(restarts.items()):
+				if time.monotonic() >= due:
+					del restarts[process]
+					start(process)
+	except KeyboardInterrupt:
+		for child in children.values():
+			child.terminate()
+		for child in children.values():
+			child.wait()
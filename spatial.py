@@ -0,0 +1,296 @@
+"""
+Title: MCDB Spatial Index
+Author: Billy Cobb
+Desc: Per-dimension chunk grid used by near, within and box so queries don't scan every stored location
+"""
+
+import heapq
+import math
+
+
+""" Spatial Vars """
+
+
+# overworld blocks covered by one block of travel in each dimension, used for cross-dimension queries
+dimension_scale = {
+	'overworld': 1,
+	'nether': 8
+}
+
+
+def distance(a: tuple, b: tuple):
+	"""
+	:param a: An (x, y, z) point
+	:param b: Another (x, y, z) point
+	:return: The straight line distance between them, written out as math.dist needs Python 3.8
+	"""
+	return math.sqrt((a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2)
+
+
+""" Chunk Grid """
+
+
+class ChunkGrid:
+	"""
+	A uniform grid over the x/z plane of a single dimension. Each cell holds the locations whose x/z fall
+	inside it so a query only looks at the cells that could contain an answer.
+	"""
+
+	def __init__(self, cell_size: int = 128):
+		"""
+		:param cell_size: Width of a grid cell in blocks
+		"""
+		self.cell_size = cell_size
+		self.cells = {}  # (cell x, cell z) -> {name: (x, y, z)}
+		self.count = 0
+
+	def _cell(self, x: float, z: float):
+		"""
+		:return: The (cell x, cell z) key the block coordinates fall in
+		"""
+		return math.floor(x / self.cell_size), math.floor(z / self.cell_size)
+
+	def insert(self, name: str, x: int, y: int, z: int):
+		"""
+		Adds a location to the grid
+		:return: None
+		"""
+		cell = self.cells.setdefault(self._cell(x, z), {})
+		if name not in cell:
+			self.count += 1
+		cell[name] = (x, y, z)
+
+	def delete(self, name: str, x: int, z: int):
+		"""
+		Removes a location from the grid, dropping its cell if it is left empty
+		:return: True if the location was in the grid, else False
+		"""
+		key = self._cell(x, z)
+		cell = self.cells.get(key)
+		if cell is None or cell.pop(name, None) is None:
+			return False
+		self.count -= 1
+		if not cell:
+			del self.cells[key]
+		return True
+
+	def _cell_bound(self, key: tuple, px: float, pz: float):
+		"""
+		:return: The shortest horizontal distance from point (px, pz) to any block in the cell
+		"""
+		lo_x, lo_z = key[0] * self.cell_size, key[1] * self.cell_size
+		dx = max(lo_x - px, 0, px - (lo_x + self.cell_size))
+		dz = max(lo_z - pz, 0, pz - (lo_z + self.cell_size))
+		return math.hypot(dx, dz)
+
+	def _ring(self, center: tuple, r: int):
+		"""
+		Yields the keys of the occupied cells exactly r cells away from center
+		"""
+		cx, cz = center
+		if r == 0:
+			if center in self.cells:
+				yield center
+			return
+		for dx in range(-r, r + 1):
+			for key in ((cx + dx, cz - r), (cx + dx, cz + r)):
+				if key in self.cells:
+					yield key
+		for dz in range(-r + 1, r):
+			for key in ((cx - r, cz + dz), (cx + r, cz + dz)):
+				if key in self.cells:
+					yield key
+
+	def nearest(self, x: float, y: float, z: float, k: int, factor: float = 1):
+		"""
+		Finds the k closest locations to a point
+		:param x: X val of the point
+		:param y: Y val of the point
+		:param z: Z val of the point
+		:param k: Number of locations to return
+		:param factor: Multiplier applied to the stored x/z values to bring them into the point's dimension
+		:return: A list of (distance, name, (x, y, z)) tuples sorted by distance
+		"""
+		if k <= 0 or not self.count:
+			return []
+		px, pz = x / factor, z / factor  # the point in this grid's own coordinates
+		best = []  # max heap of (-distance, name, coords) holding the k best seen so far
+
+		def visit(key):
+			for name, (lx, ly, lz) in self.cells[key].items():
+				dist = math.sqrt((x - lx * factor) ** 2 + (y - ly) ** 2 + (z - lz * factor) ** 2)
+				if len(best) < k:
+					heapq.heappush(best, (-dist, name, (lx, ly, lz)))
+				elif dist < -best[0][0]:
+					heapq.heapreplace(best, (-dist, name, (lx, ly, lz)))
+
+		# walk rings of cells outward while a ring is cheaper than looking at every occupied cell
+		center = self._cell(px, pz)
+		visited = set()
+		r = 0
+		while 8 * r <= len(self.cells):
+			for key in self._ring(center, r):
+				visited.add(key)
+				visit(key)
+			if len(visited) == len(self.cells):
+				break
+			# every cell past this ring is at least r whole cells away from the point
+			if len(best) == k and -best[0][0] <= r * self.cell_size * factor:
+				break
+			r += 1
+		else:
+			# sparse grid: order the remaining occupied cells by how close they could possibly be
+			bounds = [(self._cell_bound(key, px, pz) * factor, key) for key in self.cells if key not in visited]
+			heapq.heapify(bounds)
+			while bounds:
+				bound, key = heapq.heappop(bounds)
+				if len(best) == k and bound > -best[0][0]:
+					break
+				visit(key)
+		return sorted((-d, name, coords) for d, name, coords in best)
+
+	def _cells_in(self, lo_x: float, lo_z: float, hi_x: float, hi_z: float):
+		"""
+		Yields the occupied cells overlapping a rectangle given in this grid's coordinates
+		"""
+		lo = self._cell(lo_x, lo_z)
+		hi = self._cell(hi_x, hi_z)
+		if (hi[0] - lo[0] + 1) * (hi[1] - lo[1] + 1) > len(self.cells):
+			for key in self.cells:
+				if lo[0] <= key[0] <= hi[0] and lo[1] <= key[1] <= hi[1]:
+					yield key
+			return
+		for cx in range(lo[0], hi[0] + 1):
+			for cz in range(lo[1], hi[1] + 1):
+				if (cx, cz) in self.cells:
+					yield cx, cz
+
+	def within(self, x: float, y: float, z: float, radius: float, factor: float = 1):
+		"""
+		Finds every location within a radius of a point
+		:param radius: Search radius in blocks of the point's dimension
+		:param factor: Multiplier applied to the stored x/z values to bring them into the point's dimension
+		:return: A list of (distance, name, (x, y, z)) tuples sorted by distance
+		"""
+		px, pz, pr = x / factor, z / factor, radius / factor
+		found = []
+		for key in self._cells_in(px - pr, pz - pr, px + pr, pz + pr):
+			for name, (lx, ly, lz) in self.cells[key].items():
+				dist = math.sqrt((x - lx * factor) ** 2 + (y - ly) ** 2 + (z - lz * factor) ** 2)
+				if dist <= radius:
+					found.append((dist, name, (lx, ly, lz)))
+		found.sort()
+		return found
+
+	def box(self, x1: int, y1: int, z1: int, x2: int, y2: int, z2: int):
+		"""
+		Finds every location inside an axis aligned box, the corners may be given in any order
+		:return: A list of (name, (x, y, z)) tuples
+		"""
+		x1, x2 = sorted((x1, x2))
+		y1, y2 = sorted((y1, y2))
+		z1, z2 = sorted((z1, z2))
+		found = []
+		for key in self._cells_in(x1, z1, x2, z2):
+			for name, (lx, ly, lz) in self.cells[key].items():
+				if x1 <= lx <= x2 and y1 <= ly <= y2 and z1 <= lz <= z2:
+					found.append((name, (lx, ly, lz)))
+		return found
+
+
+""" Spatial Index """
+
+
+class SpatialIndex:
+	"""
+	One ChunkGrid per dimension, kept in sync with the DataStore through insert/delete/rebuild
+	"""
+
+	def __init__(self, cell_size: int = 128):
+		"""
+		:param cell_size: Width of a grid cell in blocks
+		"""
+		self.cell_size = cell_size
+		self.grids = {}
+
+	def _grid(self, dim: str):
+		if dim not in self.grids:
+			self.grids[dim] = ChunkGrid(self.cell_size)
+		return self.grids[dim]
+
+	def rebuild(self, locations: dict):
+		"""
+		Throws away the grids and reindexes every location
+		:param locations: The dict of stored locations keyed by name
+		:return: None
+		"""
+		self.grids = {}
+		for name, loc in locations.items():
+			self.insert(name, loc)
+
+	def insert(self, name: str, loc: dict):
+		"""
+		:param name: Name of the location
+		:param loc: The stored location dict
+		:return: None
+		"""
+		self._grid(loc["Dimension"]).insert(name, loc["X"], loc["Y"], loc["Z"])
+
+	def delete(self, name: str, loc: dict):
+		"""
+		:param name: Name of the location
+		:param loc: The stored location dict
+		:return: None
+		"""
+		grid = self.grids.get(loc["Dimension"])
+		if grid is not None:
+			grid.delete(name, loc["X"], loc["Z"])
+
+	def _targets(self, dim: str, cross: bool):
+		"""
+		:return: (dimension, factor) pairs to search for a query made in dim
+		"""
+		targets = [(dim, 1)]
+		if cross and dim in dimension_scale:
+			for other, scale in dimension_scale.items():
+				if other != dim:
+					targets.append((other, scale / dimension_scale[dim]))
+		return [(d, f) for d, f in targets if d in self.grids]
+
+	def nearest(self, dim: str, x: int, y: int, z: int, k: int = 5, cross: bool = False):
+		"""
+		Finds the k nearest locations to a point
+		:param dim: Full name of the dimension the point is in
+		:param cross: Also search the linked dimension, scaling nether/overworld coordinates 8:1
+		:return: A list of (distance, name, dim) tuples sorted by distance in blocks of dim
+		"""
+		results = []
+		for target, factor in self._targets(dim, cross):
+			for dist, name, _ in self.grids[target].nearest(x, y, z, k, factor):
+				results.append((dist, name, target))
+		results.sort()
+		return results[:k]
+
+	def within(self, dim: str, x: int, y: int, z: int, radius: float, cross: bool = False):
+		"""
+		Finds every location within a radius of a point
+		:param dim: Full name of the dimension the point is in
+		:param cross: Also search the linked dimension, scaling nether/overworld coordinates 8:1
+		:return: A list of (distance, name, dim) tuples sorted by distance in blocks of dim
+		"""
+		results = []
+		for target, factor in self._targets(dim, cross):
+			for dist, name, _ in self.grids[target].within(x, y, z, radius, factor):
+				results.append((dist, name, target))
+		results.sort()
+		return results
+
+	def box(self, dim: str, x1: int, y1: int, z1: int, x2: int, y2: int, z2: int):
+		"""
+		Finds every location of a dimension inside an axis aligned box
+		:return: A list of location names
+		"""
+		grid = self.grids.get(dim)
+		if grid is None:
+			return []
+		return [name for name, _ in grid.box(x1, y1, z1, x2, y2, z2)]
@@ -0,0 +1,142 @@
+"""
+Title: MCDB Status Poller
+Author: Billy Cobb
+Desc: Pings the Minecraft server in the background and shares one cached PingResponse with every command
+"""
+
+import asyncio
+import time
+
+from mcstatus import MinecraftServer
+
+from metrics import metrics
+
+
+""" Status Poller """
+
+
+class StatusPoller:
+	"""
+	Keeps the last PingResponse from a Minecraft server. A background task refreshes it on an interval, backing
+	off while the server is unreachable, and concurrent callers that need a fresh status share a single ping.
+	"""
+
+	def __init__(self, server_ip: str, interval: float = 30, timeout: float = 5, max_backoff: float = 300):
+		"""
+		:param server_ip: A string containing the server IP
+		:param interval: Seconds between background pings while the server responds
+		:param timeout: Seconds a ping may take before it is treated as failed
+		:param max_backoff: Longest wait in seconds between pings while the server is unreachable
+		"""
+		self.server_ip = server_ip
+		self.interval = interval
+		self.timeout = timeout
+		self.max_backoff = max_backoff
+		self.server = None
+		self.status = None  # the last successful mcstatus PingResponse
+		self.updated = None  # monotonic time of the last successful ping
+		self.error = None  # the exception from the last ping if it failed
+		self.inflight = None
+		self.task = None
+		self.delay = interval  # secs until the next background ping, grows while the server is unreachable
+		self.next_ping = 0  # monotonic time the next background ping is due
+		self.listeners = []  # callables run with every successful PingResponse
+		self.pings = 0
+		self.failures = 0
+		self.coalesced = 0
+
+	@property
+	def age(self):
+		"""
+		:return: Seconds since the cached status was fetched, or None if there is none
+		"""
+		if self.updated is None:
+			return None
+		return time.monotonic() - self.updated
+
+	def start(self, loop: asyncio.AbstractEventLoop):
+		"""
+		Starts the background polling task if it isn't already running
+		:param loop: The event loop the bot runs on
+		:return: None
+		"""
+		if self.task is None or self.task.done():
+			self.task = loop.create_task(self.run())
+
+	async def run(self):
+		"""
+		Pings the server every interval seconds, doubling the wait after each failure up to max_backoff
+		:return: None
+		"""
+		while True:
+			await self.poll()
+			await asyncio.sleep(self.delay)
+
+	async def poll(self):
+		"""
+		Makes one background ping and works out when the next one is due
+		:return: The new PingResponse, or None if the ping failed
+		"""
+		status = await self.ping()
+		if status is not None:
+			self.delay = self.interval
+		else:
+			self.delay = min(self.delay * 2, self.max_backoff)
+		self.next_ping = time.monotonic() + self.delay
+		return status
+
+	async def ping(self):
+		"""
+		Pings the server, or waits on the ping already in flight if there is one
+		:return: The new PingResponse, or None if the ping failed
+		"""
+		if self.inflight is None or self.inflight.done():
+			self.inflight = asyncio.get_running_loop().create_task(self._ping())
+		else:
+			self.coalesced += 1
+		return await asyncio.shield(self.inflight)
+
+	async def _ping(self):
+		"""
+		Looks the server up (once, off the event loop) and fetches its status
+		:return: The new PingResponse, or None if the ping failed
+		"""
+		self.pings += 1
+		start = time.perf_counter()
+		try:
+			if self.server is None:
+				# lookup can resolve SRV records, which is blocking
+				self.server = await asyncio.get_running_loop().run_in_executor(None, MinecraftServer.lookup,
+																			   self.server_ip)
+			status = await asyncio.wait_for(self.server.async_status(), self.timeout)
+		except Exception as e:  # timeouts, refused connections and bad responses all mean no status
+			print(f'StatusPoller ERROR: {self.server_ip} did not respond ({e!r})')
+			self.error = e
+			self.failures += 1
+			metrics.observe('mcdb_ping_seconds', time.perf_counter() - start, result='failed')
+			return None
+		metrics.observe('mcdb_ping_seconds', time.perf_counter() - start, result='ok')
+		self.status = status
+		self.updated = time.monotonic()
+		self.error = None
+		for listener in self.listeners:
+			listener(status)
+		return status
+
+	async def get(self, max_age: float = None):
+		"""
+		Returns the cached status, pinging first if it is missing or older than max_age
+		:param max_age: Oldest cached status in seconds the caller will accept, None for any age
+		:return: A PingResponse, or None if the server has never responded
+		"""
+		if self.status is None or (max_age is not None and self.age > max_age):
+			status = await self.ping()
+			if status is not None:
+				return status
+		return self.status
+
+	def stats(self):
+		"""
+		:return: A dict of ping, failure and coalesced request counts and the age of the cached status
+		"""
+		return {'pings': self.pings, 'failures': self.failures, 'coalesced': self.coalesced, 'age': self.age}
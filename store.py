@@ -0,0 +1,450 @@
+"""
+Title: MCDB Resident Store
+Author: Billy Cobb
+Desc: Keeps the bot's json data in memory and only reparses a file when it is changed outside of the bot
+"""
+
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from journal import Journal, journal_path
+from metrics import metrics
+
+
+# writes the snapshots of journals that outgrew their compaction size, one at a time, so no change waits on them
+compactor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mcdb-compact')
+
+
+""" Json Helpers """
+
+
+@metrics.timed('mcdb_io_seconds', op='json_load')
+def load_json_data(path: str):
+	"""
+	Loads a Python dict from a json file
+	:param path: String path to the json file
+	:return: a Python dict of the json data
+	"""
+	try:
+		file_r = open(path, "r")
+	except FileNotFoundError:
+		print('load_json_data() ERROR: File was not found')
+		return None
+	try:
+		file_data = json.load(file_r)
+	except json.decoder.JSONDecodeError:
+		print('load_json_data() ERROR: Improper file type or format')
+		return None
+	finally:
+		file_r.close()
+	return file_data
+
+
+@metrics.timed('mcdb_io_seconds', op='json_dump')
+def dump_json_data(file_data: dict, path: str):
+	"""
+	Dumps a Python dict to a json file. The dict is written and synced to a temporary file that then replaces the
+	old one, so a crash leaves either the old or the new file and never a truncated one.
+	:param file_data: The Python dict to be converted and dumped
+	:param path: String path to the json file
+	:return: True if the file was written, else None
+	"""
+	try:
+		file_w = open(path + '.tmp', "w")
+	except FileNotFoundError:
+		print('dump_json_data() ERROR: File was not found')
+		return None
+	try:
+		json.dump(file_data, file_w)
+		file_w.flush()
+		os.fsync(file_w.fileno())
+	except (TypeError, ValueError):
+		print('dump_json_data() ERROR: Improper file type or format')
+		return None
+	finally:
+		file_w.close()
+	replace_file(path + '.tmp', path)
+	return True
+
+
+def replace_file(tmp_path: str, path: str):
+	"""
+	Renames a fully written temporary file over its target and syncs the folder so the rename itself survives a crash
+	:param tmp_path: String path to the synced temporary file
+	:param path: String path it replaces
+	:return: None
+	"""
+	os.replace(tmp_path, path)
+	if os.name == 'posix':  # folders can't be opened for syncing on Windows
+		folder = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+		try:
+			os.fsync(folder)
+		finally:
+			os.close(folder)
+
+
+""" Resident Files """
+
+
+class ResidentFile:
+	"""
+	A json file that stays parsed in memory. Every read stats the file and only reparses it when its
+	modification time or size no longer match what the bot last loaded or wrote. With a journal, changes are
+	appended to it instead of rewriting the file, which becomes a snapshot the journal is replayed over and is only
+	rewritten once the journal has grown past its compaction size. That rewrite runs on the compaction thread from a
+	copy of the data, while the journal keeps taking changes.
+	"""
+
+	empty = dict  # the data a missing or unreadable file starts as
+
+	def __init__(self, path: str, journal: Journal = None):
+		"""
+		:param path: String path to the json file
+		:param journal: The Journal changes are written to, None to rewrite the file on every change
+		"""
+		self.path = path
+		self.journal = journal
+		self.data = None
+		self.stamp = None
+		self.hits = 0
+		self.reloads = 0
+		self.writes = 0
+		self.listeners = []  # callables run with the new data every time the file is reparsed
+		self.compaction = None  # future of the running background compaction
+
+	def _stat(self):
+		"""
+		:return: A (mtime, size) tuple for the file, or None if it does not exist
+		"""
+		try:
+			st = os.stat(self.path)
+		except FileNotFoundError:
+			return None
+		return st.st_mtime_ns, st.st_size
+
+	def get(self):
+		"""
+		Returns the in-memory data, reloading it first if the file was edited outside of the bot
+		:return: The parsed json data
+		"""
+		if self.compaction is not None and not self.compaction.done():
+			# the compaction is replacing the file with a copy of this data, that isn't an outside edit
+			self.hits += 1
+			return self.data
+		stamp = self._stat()
+		if self.data is None or stamp != self.stamp:
+			self.reload(stamp)
+		else:
+			self.hits += 1
+		return self.data
+
+	def reload(self, stamp=None):
+		"""
+		Reparses the file and notifies listeners. A file that fails to parse keeps the last good copy, a missing one is
+		empty.
+		:param stamp: The (mtime, size) tuple the reload is for, looked up if not given
+		:return: None
+		"""
+		self._settle()
+		if stamp is None:
+			stamp = self._stat()
+		data = self._read()
+		self.stamp = stamp
+		if data is None:
+			if self.data is not None and stamp is not None:
+				return
+			data = self.empty()
+		if self.journal is not None:
+			self.journal.apply(data)
+		self.data = data
+		self.reloads += 1
+		for listener in self.listeners:
+			listener(data)
+
+	def commit(self):
+		"""
+		Writes the in-memory data back to disk and records the new file stamp so it isn't reparsed. The journal is
+		emptied once the new snapshot holds its changes, a crash in between only replays them again.
+		:return: None
+		"""
+		self._settle()
+		if not self._write(self.data):
+			return
+		self.stamp = self._stat()
+		self.writes += 1
+		if self.journal is not None:
+			self.journal.truncate()
+
+	def _settle(self):
+		"""
+		Waits for a background compaction, so nothing else rewrites the file or replays the journal meanwhile
+		:return: None
+		"""
+		if self.compaction is not None:
+			self.compaction.exception()
+			self.compaction = None
+
+	def _read(self):
+		"""
+		:return: The parsed file, or None if it is missing or can't be parsed
+		"""
+		return load_json_data(self.path)
+
+	def _write(self, data):
+		"""
+		:param data: The data to write, self.data or a frozen copy of it
+		:return: True if the data was written
+		"""
+		return dump_json_data(data, self.path)
+
+	def _freeze(self):
+		"""
+		:return: A copy of the data the compaction thread can write while the original keeps changing, entries are
+		replaced rather than changed so they can be shared
+		"""
+		return dict(self.data)
+
+	def put(self, *keys: str):
+		"""
+		Persists changed entries, journaled if there is a journal, otherwise the json file is written whole
+		:param keys: The keys of the entries that were added or changed
+		:return: None
+		"""
+		if self.journal is None:
+			self.commit()
+			return
+		for key in keys:
+			self.journal.put(key, self.data[key])
+		self._compact()
+
+	def delete(self, *keys: str):
+		"""
+		Persists removed entries, journaled if there is a journal, otherwise the json file is written whole
+		:param keys: The keys of the entries that were removed
+		:return: None
+		"""
+		if self.journal is None:
+			self.commit()
+			return
+		for key in keys:
+			self.journal.delete(key)
+		self._compact()
+
+	def _compact(self):
+		"""
+		Starts writing a new snapshot on the compaction thread once the journal has grown past its compaction size
+		:return: None
+		"""
+		if self.journal.size >= self.journal.compact_bytes and (self.compaction is None or self.compaction.done()):
+			end, last = self.journal.mark()
+			self.compaction = compactor.submit(self._compact_copy, self._freeze(), end, last)
+
+	def _compact_copy(self, data, end: int, last):
+		"""
+		Compaction thread: writes a frozen copy of the data as the new snapshot, then drops the journal records it
+		holds. A crash in between only replays records the snapshot already holds, which changes nothing.
+		:param data: The copy from _freeze()
+		:param end: Bytes of journal records the copy holds
+		:param last: Future of the last of those records, they must be on disk before they are dropped
+		:return: None
+		"""
+		if last is not None and last.exception() is not None:
+			return  # the journal write failed and was reported, the next change retries the compaction
+		try:
+			if not self._write(data):
+				return
+		except (OSError, RuntimeError) as e:
+			print(f'ResidentFile ERROR: {self.path} could not be compacted ({e})')
+			return
+		self.stamp = self._stat()
+		self.writes += 1
+		self.journal.discard(end)
+
+	def close(self):
+		"""
+		Compacts any journaled changes into the snapshot and stops the journal's writer
+		:return: None
+		"""
+		if self.journal is None:
+			return
+		if self.data is not None and self.journal.size:
+			self.commit()
+		self.journal.close()
+
+	def stats(self):
+		"""
+		:return: A dict of the hit, reload and write counts for this file, and its journal's counts
+		"""
+		stats = {'hits': self.hits, 'reloads': self.reloads, 'writes': self.writes}
+		if self.journal is not None:
+			stats['journal'] = self.journal.stats()
+		return stats
+
+
+class DataStore:
+	"""
+	The bot's resident copy of the locations and members, loaded once and shared by every command. By default
+	they are kept in Locations.json and Members.json, a storage backend can supply its own resident tables.
+	"""
+
+	def __init__(self, paths: dict, backend=None, journaled: bool = False):
+		"""
+		:param paths: The json_files dict, must contain a 'locations' path and may contain a 'members' path
+		:param backend: A storage backend with a tables() method, None to use the json files
+		:param journaled: Journal changes to the json files instead of rewriting them, ignored with a backend
+		"""
+		if backend is not None:
+			self.files = backend.tables()
+		else:
+			self.files = {key: ResidentFile(paths[key], Journal(journal_path(paths[key])) if journaled else None)
+						  for key in ('locations', 'members') if key in paths}
+		self.indexes = []  # objects with rebuild/insert/delete kept in sync with the locations
+		self.generation = 0  # bumped by every change to the locations, cached query results from older ones are stale
+		self.files['locations'].listeners.append(self._reindex)
+
+	def attach(self, index):
+		"""
+		Registers an index to be built from the locations and kept up to date by add/remove. Indexes attached
+		before load() are built when the file is first parsed.
+		:param index: An object with rebuild(locations), insert(name, loc) and delete(name, loc) methods
+		:return: The index
+		"""
+		if self.files['locations'].data is not None:
+			index.rebuild(self.locations)
+		self.indexes.append(index)
+		return index
+
+	def _reindex(self, locations: dict):
+		"""
+		Rebuilds every attached index after the locations file was reparsed
+		:param locations: The freshly loaded locations dict
+		:return: None
+		"""
+		self.generation += 1
+		for index in self.indexes:
+			index.rebuild(locations)
+
+	def load(self):
+		"""
+		Parses every file up front so the first command doesn't pay for it
+		:return: None
+		"""
+		for file in self.files.values():
+			file.reload()
+
+	@property
+	def locations(self):
+		"""
+		:return: The dict of stored locations keyed by name
+		"""
+		return self.files['locations'].get()
+
+	@property
+	def members(self):
+		"""
+		:return: The dict of known members keyed by player name
+		"""
+		return self.files['members'].get()
+
+	def add_location(self, name: str, dim: str, x: int, y: int, z: int, tags: list = None):
+		"""
+		Adds a new location and writes it to disk
+		:param name: Name of the location
+		:param dim: Full name of the dimension (overworld, nether or end)
+		:param x: X val of the location
+		:param y: Y val of the location
+		:param z: Z val of the location
+		:param tags: Tags to file the location under, such as spawner or an owner
+		:return: True if the location was added, False if the name is already in use
+		"""
+		locs = self.locations
+		if name in locs:
+			return False
+		loc = {"Dimension": dim, "X": x, "Y": y, "Z": z}
+		if tags:
+			loc["Tags"] = list(tags)
+		locs[name] = loc
+		self.generation += 1
+		self.files['locations'].put(name)
+		for index in self.indexes:
+			index.insert(name, loc)
+		return True
+
+	def add_locations(self, rows):
+		"""
+		Adds many locations with a single write to disk
+		:param rows: An iterable of (name, dim, x, y, z, tags) tuples, tags being an empty list for untagged rows
+		:return: The list of names added, names already in use are skipped
+		"""
+		locs = self.locations
+		added = []
+		for name, dim, x, y, z, tags in rows:
+			if name not in locs:
+				loc = {"Dimension": dim, "X": x, "Y": y, "Z": z}
+				if tags:
+					loc["Tags"] = list(tags)
+				locs[name] = loc
+				added.append(name)
+		if added:
+			self.generation += 1
+			self.files['locations'].put(*added)
+			for index in self.indexes:
+				for name in added:
+					index.insert(name, locs[name])
+		return added
+
+	def remove_location(self, name: str):
+		"""
+		Removes a location and writes the change to disk
+		:param name: Name of the location
+		:return: The removed location's data, or None if it did not exist
+		"""
+		loc = self.locations.pop(name, None)
+		if loc is not None:
+			self.generation += 1
+			self.files['locations'].delete(name)
+			for index in self.indexes:
+				index.delete(name, loc)
+		return loc
+
+	def save_members(self, names: list = None):
+		"""
+		Writes the in-memory members to disk
+		:param names: The members that changed, None to write every member
+		:return: None
+		"""
+		if names is None:
+			self.files['members'].commit()
+		elif names:
+			self.files['members'].put(*set(names))
+
+	async def durable(self):
+		"""
+		Waits until every journaled change made so far is synced to disk
+		:return: True if they all were, False if a journal write failed
+		"""
+		for file in self.files.values():
+			journal = getattr(file, 'journal', None)
+			last = journal.last if journal is not None else None
+			if last is not None:
+				await asyncio.wait([asyncio.wrap_future(last)])
+				if last.exception() is not None:
+					return False
+		return True
+
+	def close(self):
+		"""
+		Compacts and closes the journals of files that have them
+		:return: None
+		"""
+		for file in self.files.values():
+			if hasattr(file, 'close'):
+				file.close()
+
+	def stats(self):
+		"""
+		:return: A dict of hit/reload/write counts for each resident file and the locations generation
+		"""
+		return {**{key: file.stats() for key, file in self.files.items()}, 'generation': self.generation}
@@ -0,0 +1,167 @@
+"""
+Title: MCDB Tag Index
+Author: Billy Cobb
+Desc: Inverted index from tag to the locations filed under it, and the faceted find queries that intersect its posting
+sets with name matches and distance filters
+"""
+
+import math
+
+from columnar import dimension_names
+from route import position
+from search import match_ranks
+from spatial import distance
+
+
+""" Tag Vars """
+
+
+max_tags = 10  # most tags one location is filed under
+max_tag_length = 32
+grid_min_candidates = 5000  # fewer tag or name matches than this are measured directly rather than from the grid
+
+
+def parse_tags(args):
+	"""
+	Normalizes tag arguments (i.e. Spawner, #farm, "iron,") to the tags stored with locations
+	:param args: The tag arguments supplied by the user
+	:return: A list of distinct lower case tags, at most max_tags of them
+	"""
+	tags = []
+	for arg in args:
+		tag = arg.lower().replace(",", "").strip().lstrip('#')[:max_tag_length]
+		if tag and tag not in tags:
+			tags.append(tag)
+	return tags[:max_tags]
+
+
+def location_tags(loc: dict):
+	"""
+	:param loc: The stored location dict
+	:return: The tags the location is filed under, its dimension always among them
+	"""
+	return {loc["Dimension"], *loc.get("Tags", ())}
+
+
+""" Tag Index """
+
+
+class TagIndex:
+	"""
+	An inverted index from tag to the set of names filed under it, kept in sync with the DataStore. Every location
+	is also filed under its dimension, so tag:nether is just another posting set. Intersecting posting sets smallest
+	first costs about the size of the rarest tag asked for, not the number of locations.
+	"""
+
+	def __init__(self):
+		self.postings = {}  # tag -> set of names
+		self.queries = 0
+
+	def rebuild(self, locations: dict):
+		"""
+		Throws away the index and refiles every location
+		:param locations: The dict of stored locations keyed by name
+		:return: None
+		"""
+		self.postings = {}
+		for name, loc in locations.items():
+			self.insert(name, loc)
+
+	def insert(self, name: str, loc: dict):
+		"""
+		:param name: Name of the location
+		:param loc: The stored location dict
+		:return: None
+		"""
+		for tag in location_tags(loc):
+			self.postings.setdefault(tag, set()).add(name)
+
+	def delete(self, name: str, loc: dict):
+		"""
+		:param name: Name of the location
+		:param loc: The stored location dict
+		:return: None
+		"""
+		for tag in location_tags(loc):
+			names = self.postings.get(tag)
+			if names is not None:
+				names.discard(name)
+				if not names:
+					del self.postings[tag]
+
+	def names(self, tags: list):
+		"""
+		:param tags: Tags a location must all be filed under
+		:return: The set of names filed under every tag
+		"""
+		self.queries += 1
+		postings = sorted((self.postings.get(tag, set()) for tag in tags), key=len)
+		found = set(postings[0]) if postings else set()
+		for names in postings[1:]:
+			found &= names
+			if not found:
+				break
+		return found
+
+	def stats(self):
+		"""
+		:return: A dict of the number of distinct tags and queries answered
+		"""
+		return {'tags': len(self.postings), 'queries': self.queries}
+
+
+def facet_search(locations, tag_index: TagIndex, search_index, spatial_index, tags: list = (), query: str = '',
+				 point: tuple = None, radius: float = None):
+	"""
+	Finds the locations matching every facet of a find query. Each facet narrows to a set of names, from the tag
+	postings, the name trigrams and the spatial grid, and the sets are intersected by probing the smallest.
+	:param locations: The dict of stored locations keyed by name
+	:param tag_index: The guild's TagIndex
+	:param search_index: The guild's SearchIndex
+	:param spatial_index: The guild's SpatialIndex
+	:param tags: Tags a location must all be filed under, a dimension among them is the dimension of the point
+	:param query: Text the name must contain, '' for any name
+	:param point: (x, y, z) to order the locations by distance from, None to order them by how well the name matches
+	:param radius: Most blocks from the point, None for any distance
+	:return: A list of (distance or None, name) tuples, nearest or best match first
+	"""
+	dim = next((tag for tag in tags if tag in dimension_names), None)
+	cross = dim is None  # without a dimension tag the point is in the overworld and the nether is scaled into it
+	dim = dim or 'overworld'
+	query = query.lower().strip()
+	sets = []
+	if tags:
+		sets.append(tag_index.names(tags))
+	if query:
+		sets.append(search_index.names(query))
+	distances = None
+	if point is not None and radius is not None and min(map(len, sets), default=math.inf) >= grid_min_candidates:
+		# the grid only looks at the cells the radius covers
+		distances = {name: dist for dist, name, _ in spatial_index.within(dim, *point, radius, cross=cross)}
+		sets.append(distances)
+	if sets:
+		sets.sort(key=len)
+		found = [name for name in sets[0] if all(name in names for names in sets[1:])]
+	else:
+		found = list(locations)
+
+	if point is not None:
+		results = []
+		for name in found:
+			if distances is not None:
+				results.append((distances[name], name))
+				continue
+			coords = position(locations[name], dim)
+			if coords is None:
+				continue
+			dist = distance(point, coords)
+			if radius is None or dist <= radius:
+				results.append((dist, name))
+		results.sort()
+		return results
+
+	def rank(name: str):
+		lowered = name.lower()
+		kind = 'exact' if lowered == query else 'prefix' if lowered.startswith(query) else 'substring'
+		return match_ranks[kind], len(name), name
+	return [(None, name) for name in sorted(found, key=rank if query else None)]
@@ -0,0 +1,282 @@
+"""
+Title: MCDB Map Tiles
+Author: Billy Cobb
+Desc: Renders stored locations as PNG map tiles kept in a per-guild tile pyramid, and composes map views from them
+off the event loop
+"""
+
+import asyncio
+import functools
+import io
+import math
+from collections import OrderedDict
+
+from PIL import Image, ImageDraw, ImageFont
+
+from metrics import metrics
+
+
+""" Tile Vars """
+
+
+tile_size = 256  # tile width and height in pixels
+max_zoom = 4  # at zoom z a pixel is 2 ** (max_zoom - z) blocks, so max_zoom is one block per pixel
+view_size = (512, 384)  # pixels of a composed map view
+marker_radius = 3  # pixels, tiles this close to a location draw part of its marker
+label_chars = 24  # longer names are cut short on the map
+label_margin = 160  # pixels right of a marker its label may reach, views gather locations this far outside
+label_cell = (8, 6)  # pixel cells labels claim, coarse enough to check overlaps with a set
+backgrounds = {'overworld': (36, 58, 36), 'nether': (64, 24, 24), 'end': (40, 32, 56)}
+grid_color = (255, 255, 255, 40)
+marker_color = (255, 200, 40)
+player_color = (80, 200, 255)
+
+
+def blocks_per_pixel(zoom: int):
+	return 2 ** (max_zoom - zoom)
+
+
+@functools.lru_cache(maxsize=None)
+def label_font():
+	return ImageFont.load_default()
+
+
+def touched_tiles(dim: str, x: int, z: int):
+	"""
+	:param dim: Full name of the dimension
+	:param x: X of a location
+	:param z: Z of a location
+	:return: A generator of the (dim, zoom, tile x, tile z) keys of every tile the location's marker is drawn on
+	"""
+	for zoom in range(max_zoom + 1):
+		bpp = blocks_per_pixel(zoom)
+		px, pz = math.floor(x / bpp), math.floor(z / bpp)
+		for tx in range((px - marker_radius) // tile_size, (px + marker_radius) // tile_size + 1):
+			for tz in range((pz - marker_radius) // tile_size, (pz + marker_radius) // tile_size + 1):
+				yield dim, zoom, tx, tz
+
+
+def located(grid, bpp: int, x1: int, z1: int, x2: int, z2: int):
+	"""
+	:param grid: The dimension's ChunkGrid from the SpatialIndex, None if it has no locations
+	:param bpp: Blocks per pixel at the zoom level
+	:param x1: Left edge in pixels of the whole zoom level
+	:param z1: Top edge in pixels
+	:param x2: Right edge in pixels, included
+	:param z2: Bottom edge in pixels, included
+	:return: (pixel x, pixel z, name) tuples of the locations inside the pixel rectangle
+	"""
+	if grid is None:
+		return []
+	return [(math.floor(lx / bpp), math.floor(lz / bpp), name) for name, (lx, _, lz) in
+			grid.box(x1 * bpp, -2 ** 31, z1 * bpp, (x2 + 1) * bpp - 1, 2 ** 31, (z2 + 1) * bpp - 1)]
+
+
+""" Rendering """
+
+
+def render_tile(key: tuple, points: list):
+	"""
+	Draws a tile's grid lines and location markers, run on a worker thread
+	:param key: The tile's (dim, zoom, tile x, tile z)
+	:param points: (pixel x, pixel z, name) tuples of the locations whose markers are on the tile
+	:return: The tile as PNG bytes
+	"""
+	dim, zoom, tx, tz = key
+	bpp = blocks_per_pixel(zoom)
+	left, top = tx * tile_size, tz * tile_size  # the tile's corner in pixels of the whole zoom level
+	image = Image.new('RGB', (tile_size, tile_size), backgrounds.get(dim, (40, 40, 40)))
+	overlay = Image.new('RGBA', (tile_size, tile_size), (0, 0, 0, 0))
+	draw = ImageDraw.Draw(overlay)
+	# a grid line every 512 blocks, or every 64 when zoomed in far enough for those to be 64 pixels apart
+	step = 64 if bpp == 1 else 512 // bpp
+	for offset in range(-(left % step), tile_size, step):
+		draw.line([(offset, 0), (offset, tile_size)], fill=grid_color)
+	for offset in range(-(top % step), tile_size, step):
+		draw.line([(0, offset), (tile_size, offset)], fill=grid_color)
+	image.paste(overlay, (0, 0), overlay)
+	draw = ImageDraw.Draw(image)
+	r = marker_radius
+	# sorted so markers overlap the same way on every tile they span
+	for px, pz, _ in sorted(points):
+		px, pz = px - left, pz - top
+		draw.ellipse([px - r, pz - r, px + r, pz + r], fill=marker_color, outline=(0, 0, 0))
+	with io.BytesIO() as buffer:
+		image.save(buffer, 'PNG')
+		return buffer.getvalue()
+
+
+def draw_labels(draw: ImageDraw.ImageDraw, points: list):
+	"""
+	Labels markers top to bottom, leaving out labels that would overlap one already drawn
+	:param draw: The ImageDraw of the view
+	:param points: (pixel x, pixel z, name) tuples in pixels of the view
+	:return: The number of labels drawn
+	"""
+	font = label_font()
+	taken = set()  # label_cell sized cells already under a label
+	drawn = 0
+	for px, pz, name in sorted(points, key=lambda point: (point[1], point[0], point[2])):
+		label = name if len(name) <= label_chars else name[:label_chars - 1] + '…'
+		x1 = px + marker_radius + 3
+		x2 = x1 + int(font.getlength(label))
+		if x2 < 0 or x1 >= view_size[0]:
+			continue
+		cells = {(cx, cz) for cx in range(x1 // label_cell[0], x2 // label_cell[0] + 1)
+				 for cz in range((pz - 6) // label_cell[1], (pz + 6) // label_cell[1] + 1)}
+		if cells & taken:
+			continue
+		taken |= cells
+		draw.text((x1, pz - 6), label, fill=(255, 255, 255), font=font, stroke_width=1, stroke_fill=(0, 0, 0))
+		drawn += 1
+	return drawn
+
+
+def compose_view(zoom: int, left: int, top: int, tiles: dict, points: list, caption: str):
+	"""
+	Pastes tiles into one view and draws the labels, scale and reported position over them, run on a worker thread
+	:param zoom: The zoom level
+	:param left: The view's left edge in pixels of the whole zoom level
+	:param top: The view's top edge in pixels of the whole zoom level
+	:param tiles: (tile x, tile z) -> PNG bytes for every tile the view covers
+	:param points: (pixel x, pixel z, name) tuples of the locations to label, in pixels of the whole zoom level
+	:param caption: Text drawn in the view's corner
+	:return: The view as PNG bytes
+	"""
+	view = Image.new('RGB', view_size)
+	for (tx, tz), png in tiles.items():
+		with Image.open(io.BytesIO(png)) as tile:
+			view.paste(tile, (tx * tile_size - left, tz * tile_size - top))
+	draw = ImageDraw.Draw(view)
+	draw_labels(draw, [(px - left, pz - top, name) for px, pz, name in points])
+	# the position the map was asked for, drawn as a cross where the player reported standing
+	cx, cz = view_size[0] // 2, view_size[1] // 2
+	draw.line([(cx - 8, cz), (cx + 8, cz)], fill=player_color, width=2)
+	draw.line([(cx, cz - 8), (cx, cz + 8)], fill=player_color, width=2)
+	draw.ellipse([cx - 5, cz - 5, cx + 5, cz + 5], outline=player_color, width=2)
+	font = label_font()
+	# a scale bar of 2 ** n blocks, as close to 100 pixels as the zoom allows
+	bpp = blocks_per_pixel(zoom)
+	blocks = 2 ** round(math.log2(100 * bpp))
+	bar = blocks // bpp
+	scale = f'{blocks} blocks'
+	draw.rectangle([0, view_size[1] - 24, 24 + bar + font.getlength(scale), view_size[1]], fill=(0, 0, 0))
+	draw.line([(10, view_size[1] - 12), (10 + bar, view_size[1] - 12)], fill=(255, 255, 255), width=3)
+	draw.text((16 + bar, view_size[1] - 18), scale, fill=(255, 255, 255), font=font)
+	draw.rectangle([0, 0, 16 + font.getlength(caption), 22], fill=(0, 0, 0))
+	draw.text((8, 6), caption, fill=(255, 255, 255), font=font)
+	with io.BytesIO() as buffer:
+		view.save(buffer, 'PNG')
+		return buffer.getvalue()
+
+
+""" Tile Cache """
+
+
+class TileCache:
+	"""
+	An LRU cache of rendered tiles keyed by (dimension, zoom, tile x, tile z), attached to a DataStore like an index.
+	Adding or removing a location drops only the tiles its marker is drawn on at each zoom, so the rest of the pyramid
+	stays rendered. Labels are drawn once over each composed view, so they are never cut off at tile edges. Whole
+	views are cached too, and dropped whenever any tile is.
+	"""
+
+	def __init__(self, max_tiles: int = 1024, max_views: int = 64):
+		"""
+		:param max_tiles: Most tiles kept, at a few KB of PNG each
+		:param max_views: Most composed views kept
+		"""
+		self.max_tiles = max_tiles
+		self.max_views = max_views
+		self.tiles = OrderedDict()  # (dim, zoom, tx, tz) -> PNG bytes, least recently used first
+		self.views = OrderedDict()  # (dim, x, z, zoom) -> PNG bytes
+		self.version = 0  # bumped by every invalidation, renders started at an older version aren't cached
+		self.hits = 0
+		self.renders = 0
+		self.invalidated = 0
+		self.view_hits = 0
+
+	def rebuild(self, locations: dict):
+		self.tiles.clear()
+		self.views.clear()
+		self.version += 1
+
+	def insert(self, name: str, loc: dict):
+		self._invalidate(loc["Dimension"], loc["X"], loc["Z"])
+
+	def delete(self, name: str, loc: dict):
+		self._invalidate(loc["Dimension"], loc["X"], loc["Z"])
+
+	def _invalidate(self, dim: str, x: int, z: int):
+		for key in touched_tiles(dim, x, z):
+			if self.tiles.pop(key, None) is not None:
+				self.invalidated += 1
+		self.views.clear()
+		self.version += 1
+
+	def _put(self, cache: OrderedDict, limit: int, key: tuple, png: bytes):
+		cache[key] = png
+		cache.move_to_end(key)
+		while len(cache) > limit:
+			cache.popitem(last=False)
+
+	async def view(self, grid, dim: str, x: int, z: int, zoom: int):
+		"""
+		Returns a map view centred on a position, rendering only the tiles that aren't cached
+		:param grid: The dimension's ChunkGrid from the SpatialIndex, None if it has no locations
+		:param dim: Full name of the dimension
+		:param x: X of the centre
+		:param z: Z of the centre
+		:param zoom: Zoom level from 0 to max_zoom
+		:return: The view as PNG bytes
+		"""
+		view_key = (dim, x, z, zoom)
+		png = self.views.get(view_key)
+		if png is not None:
+			self.view_hits += 1
+			self.views.move_to_end(view_key)
+			return png
+
+		bpp = blocks_per_pixel(zoom)
+		left = math.floor(x / bpp) - view_size[0] // 2
+		top = math.floor(z / bpp) - view_size[1] // 2
+		right, bottom = left + view_size[0] - 1, top + view_size[1] - 1
+		r = marker_radius
+		# locations are gathered on the event loop, where the grid is never changed mid-read
+		tiles, missing = {}, {}
+		for tx in range(left // tile_size, right // tile_size + 1):
+			for tz in range(top // tile_size, bottom // tile_size + 1):
+				key = (dim, zoom, tx, tz)
+				cached = self.tiles.get(key)
+				if cached is not None:
+					self.hits += 1
+					self.tiles.move_to_end(key)
+					tiles[(tx, tz)] = cached
+				else:
+					missing[key] = located(grid, bpp, tx * tile_size - r, tz * tile_size - r,
+										   (tx + 1) * tile_size + r - 1, (tz + 1) * tile_size + r - 1)
+		# labels start right of their markers, so markers just off the left edge can still be labelled in view
+		points = located(grid, bpp, left - label_margin, top - r, right, bottom + r)
+
+		version = self.version
+		caption = f'{dim} {x}, {z} zoom {zoom}'
+
+		def render():
+			with metrics.timer('mcdb_map_render_seconds'):
+				rendered = {key: render_tile(key, tile_points) for key, tile_points in missing.items()}
+				tiles.update((key[2:], tile) for key, tile in rendered.items())
+				return rendered, compose_view(zoom, left, top, tiles, points, caption)
+		rendered, png = await asyncio.get_running_loop().run_in_executor(None, render)
+		self.renders += len(rendered)
+		if self.version == version:  # nothing was added or removed while rendering
+			for key, tile in rendered.items():
+				self._put(self.tiles, self.max_tiles, key, tile)
+			self._put(self.views, self.max_views, view_key, png)
+		return png
+
+	def stats(self):
+		"""
+		:return: A dict of cached tile and view counts, hits, renders and invalidated tiles
+		"""
+		return {'tiles': len(self.tiles), 'views': len(self.views), 'hits': self.hits, 'view_hits': self.view_hits,
+				'renders': self.renders, 'invalidated': self.invalidated}
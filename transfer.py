@@ -0,0 +1,273 @@
+"""
+Title: MCDB Import/Export
+Author: Billy Cobb
+Desc: Reads locations from CSV, JSON, JSON-lines and minimap waypoint files a row at a time, and writes the stored
+locations back out as gzipped files
+"""
+
+import csv
+import gzip
+import json
+import math
+import os
+
+from tags import parse_tags
+
+
+""" Transfer Vars """
+
+
+dimension_aliases = {  # dimension names used by the supported formats
+	'o': 'overworld', 'overworld': 'overworld', 'minecraft:overworld': 'overworld', '0': 'overworld',
+	'n': 'nether', 'nether': 'nether', 'the_nether': 'nether', 'minecraft:the_nether': 'nether', '-1': 'nether',
+	'e': 'end', 'end': 'end', 'the_end': 'end', 'minecraft:the_end': 'end', '1': 'end'
+}
+field_aliases = {  # lower case column or key names -> the field they hold
+	'name': 'name', 'location': 'name', 'dimension': 'dim', 'dim': 'dim', 'dimensions': 'dim', 'world': 'dim',
+	'x': 'x', 'y': 'y', 'z': 'z', 'tags': 'tags', 'tag': 'tags'
+}
+export_formats = {'json', 'jsonl', 'csv'}
+unknown_y = 64  # xaero waypoints may leave y out, written as ~
+
+
+""" Parsing """
+
+
+def parse_dim(value, default: str = None):
+	"""
+	:param value: A dimension in any supported spelling, or a list of them of which the first is used
+	:param default: Dimension to use when the value is empty
+	:return: The full dimension name, or None if it isn't recognised
+	"""
+	if isinstance(value, list):
+		value = value[0] if value else None
+	if value is None or str(value).strip() == '':
+		return default
+	return dimension_aliases.get(str(value).strip().lower())
+
+
+def parse_coord(value):
+	"""
+	:param value: A coordinate as an int, float or string
+	:return: The block coordinate as an int
+	"""
+	coord = float(value)
+	if not math.isfinite(coord):
+		raise ValueError(value)
+	return math.floor(coord)
+
+
+def normalize(raw: dict, default_dim: str = None):
+	"""
+	Validates one parsed row
+	:param raw: A dict of the row's fields, keyed by any name in field_aliases
+	:param default_dim: Dimension for rows that don't give one
+	:return: A (name, dim, x, y, z, tags) tuple, tags being a list that is empty for untagged rows
+	:raises ValueError: with a message saying what is wrong with the row
+	"""
+	fields = {}
+	for key, value in raw.items():
+		field = field_aliases.get(str(key).strip().lower())
+		if field is not None and fields.get(field) in (None, '', []):  # the first non-empty alias wins
+			fields[field] = value
+	# names are stored the way the add command stores them
+	name = str(fields.get('name') or '').lower().replace(',', '').strip()
+	if not name:
+		raise ValueError('missing name')
+	dim = parse_dim(fields.get('dim'), default_dim)
+	if dim is None:
+		raise ValueError(f'unknown dimension {fields.get("dim")!r}' if fields.get('dim') else 'missing dimension')
+	coords = []
+	for axis in ('x', 'y', 'z'):
+		try:
+			coords.append(parse_coord(fields[axis]))
+		except KeyError:
+			raise ValueError(f'missing {axis}')
+		except (TypeError, ValueError):
+			raise ValueError(f'{axis} is not a number ({fields[axis]!r})')
+	tags = fields.get('tags') or []
+	if isinstance(tags, str):  # a csv cell holds its tags comma separated, as they are exported
+		tags = tags.split(',')
+	elif not isinstance(tags, list):
+		raise ValueError(f'tags are not a list ({tags!r})')
+	return (name, dim, *coords, parse_tags([str(tag) for tag in tags]))
+
+
+def read_csv(file_r):
+	"""
+	Reads a CSV with a header naming its columns, or without one in the add command's dim, name, x, y, z, tags order
+	"""
+	reader = csv.reader(file_r)
+	header = None
+	for row in reader:
+		if not any(cell.strip() for cell in row):
+			continue
+		if header is None:
+			header = [cell.strip().lower() for cell in row]
+			if 'name' in header and 'x' in header:
+				continue
+			header = ['dim', 'name', 'x', 'y', 'z', 'tags']
+		yield reader.line_num, dict(zip(header, row))
+
+
+def read_jsonl(file_r):
+	for line_no, line in enumerate(file_r, 1):
+		if line.strip():
+			try:
+				yield line_no, json.loads(line)
+			except ValueError:
+				yield line_no, ValueError('not a json object')
+
+
+def read_json(file_r):
+	"""
+	Reads a Locations.json style dict keyed by name, a list of location objects or a single waypoint object such
+	as a JourneyMap waypoint file. A json document can't be parsed a row at a time, rows are numbered from 1.
+	"""
+	data = json.load(file_r)
+	# a waypoint holds plain values, a Locations.json dict holds a location dict per name, even one named like a field
+	if isinstance(data, dict) and any(key.lower() in field_aliases for key in data) and \
+			not any(isinstance(value, dict) for value in data.values()):
+		data = [data]
+	if isinstance(data, dict):
+		for row_no, (name, loc) in enumerate(data.items(), 1):
+			yield row_no, {'name': name, **loc} if isinstance(loc, dict) else loc
+	elif isinstance(data, list):
+		yield from enumerate(data, 1)
+	else:
+		raise ValueError('expected a json object or list of objects')
+
+
+def read_xaero(file_r):
+	"""
+	Reads a Xaero's Minimap waypoint file, where each row is waypoint:name:initials:x:y:z:color:... and colons in
+	names are written as §§. The dimension is part of the file's folder name, so it comes from the default.
+	"""
+	for line_no, line in enumerate(file_r, 1):
+		if not line.startswith('waypoint:'):
+			continue
+		parts = line.rstrip('\n').split(':')
+		if len(parts) < 6:
+			yield line_no, ValueError('expected waypoint:name:initials:x:y:z')
+			continue
+		y = unknown_y if parts[4] == '~' else parts[4]
+		yield line_no, {'name': parts[1].replace('§§', ':'), 'x': parts[3], 'y': y, 'z': parts[5]}
+
+
+def read_voxelmap(file_r):
+	"""
+	Reads a VoxelMap .points file, where each row is name:Home,x:1,z:2,y:3,...,dimensions:overworld#the_nether#
+	"""
+	for line_no, line in enumerate(file_r, 1):
+		if not line.startswith('name:'):
+			continue
+		fields = dict(part.split(':', 1) for part in line.rstrip('\n').split(',') if ':' in part)
+		# VoxelMap writes commas and colons in names as look-alike characters
+		fields['name'] = fields.get('name', '').replace('﹐', ',').replace('˸', ':')
+		fields['dimensions'] = [dim for dim in fields.get('dimensions', '').split('#') if dim]
+		yield line_no, fields
+
+
+readers = {'csv': read_csv, 'json': read_json, 'jsonl': read_jsonl, 'xaero': read_xaero, 'voxelmap': read_voxelmap}
+
+
+def detect_format(path: str, filename: str):
+	"""
+	Works out a file's format from its extension, falling back on its first line
+	:param path: String path to the file
+	:param filename: The file's original name
+	:return: A key of readers
+	"""
+	ext = os.path.splitext(filename.lower())[1]
+	if ext in ('.jsonl', '.ndjson'):
+		return 'jsonl'
+	if ext == '.points':
+		return 'voxelmap'
+	with open(path, 'r', encoding='utf-8-sig', errors='replace') as file_r:
+		first = ''
+		for first in file_r:
+			if first.strip() and not first.startswith('#'):
+				break
+	if first.startswith('waypoint:'):
+		return 'xaero'
+	if first.startswith('name:'):
+		return 'voxelmap'
+	if ext == '.csv' or not first.lstrip().startswith(('{', '[')):
+		return 'csv'
+	if ext == '.json':
+		return 'json'
+	try:  # a whole object on the first line is json-lines
+		return 'jsonl' if isinstance(json.loads(first), dict) else 'json'
+	except ValueError:
+		return 'json'
+
+
+def read_locations(path: str, filename: str, default_dim: str = None, max_rows: int = None):
+	"""
+	Parses and validates a location file a row at a time. Rows are checked against each other but not against the
+	stored locations, which the caller does.
+	:param path: String path to the file
+	:param filename: The file's original name, used to detect its format
+	:param default_dim: Dimension for rows that don't give one
+	:param max_rows: Most rows to read, the rest are reported as one error
+	:return: A (format, rows, errors) tuple of the format read, (row number, (name, dim, x, y, z, tags)) tuples for
+	the valid rows and (row number, message) tuples for the rest
+	"""
+	fmt = detect_format(path, filename)
+	rows, errors, seen = [], [], {}
+	with open(path, 'r', encoding='utf-8-sig', errors='replace', newline='') as file_r:
+		try:
+			for row_no, raw in readers[fmt](file_r):
+				if max_rows is not None and len(rows) + len(errors) >= max_rows:
+					errors.append((row_no, f'stopped, files may hold at most {max_rows} rows'))
+					break
+				try:
+					if isinstance(raw, Exception):
+						raise raw
+					if not isinstance(raw, dict):
+						raise ValueError('expected an object')
+					row = normalize(raw, default_dim)
+				except ValueError as e:
+					errors.append((row_no, str(e)))
+					continue
+				if row[0] in seen:
+					errors.append((row_no, f'{row[0]} is already on row {seen[row[0]]}'))
+					continue
+				seen[row[0]] = row_no
+				rows.append((row_no, row))
+		except (ValueError, csv.Error) as e:  # the file itself is malformed, rows read so far are kept
+			errors.append((0, f'could not read the file as {fmt} ({e})'))
+	return fmt, rows, errors
+
+
+""" Exporting """
+
+
+def write_locations(path: str, locations, fmt: str = 'json'):
+	"""
+	Writes locations to a gzipped file one entry at a time, json is written in the Locations.json layout. Tags are
+	a comma separated csv column and a list in json-lines, left out of untagged rows.
+	:param path: String path to the .gz file
+	:param locations: An iterable of (name, location dict) tuples
+	:param fmt: 'json', 'jsonl' or 'csv'
+	:return: The number of locations written
+	"""
+	count = 0
+	with gzip.open(path, 'wt', encoding='utf-8', newline='') as file_w:
+		if fmt == 'csv':
+			writer = csv.writer(file_w)
+			writer.writerow(['name', 'dimension', 'x', 'y', 'z', 'tags'])
+			for count, (name, loc) in enumerate(locations, 1):
+				writer.writerow([name, loc['Dimension'], loc['X'], loc['Y'], loc['Z'], ','.join(loc.get('Tags', ()))])
+		elif fmt == 'jsonl':
+			for count, (name, loc) in enumerate(locations, 1):
+				row = {'name': name, 'dimension': loc['Dimension'], 'x': loc['X'], 'y': loc['Y'], 'z': loc['Z']}
+				if loc.get('Tags'):
+					row['tags'] = loc['Tags']
+				file_w.write(json.dumps(row) + '\n')
+		else:
+			file_w.write('{')
+			for count, (name, loc) in enumerate(locations, 1):
+				file_w.write(f'{"," if count > 1 else ""}\n{json.dumps(name)}: {json.dumps(loc)}')
+			file_w.write('\n}\n')
+	return count
@@ -0,0 +1,201 @@
+"""
+Title: MCDB Usage Rollups
+Author: Billy Cobb
+Desc: Hourly and daily command counts per command and per user, kept up to date from the command log as entries are
+appended so usage queries never rescan the log
+"""
+
+import asyncio
+import time
+
+
+""" Usage Vars """
+
+
+hour = 3600
+day = 86400
+hours_per_day = day // hour
+
+
+def command_name(entry: dict):
+	"""
+	:param entry: A command log entry, whose "Command" is the command name followed by its arguments
+	:return: The lower case command name
+	"""
+	return str(entry.get("Command") or '').split(' ', 1)[0].lower()
+
+
+""" Usage Rollups """
+
+
+class UsageRollups:
+	"""
+	Counts of logged commands in hour and day buckets (UTC) for every command, every user, every command and user
+	pair and all commands together, each kept per namespace. A range is summed from whole days in the middle and
+	hours at the edges, so a query over months of history adds up a few hundred buckets at most.
+	"""
+
+	def __init__(self, scope=None, owns=None):
+		"""
+		:param scope: A callable giving the namespace key an entry belongs to, None to keep a single namespace
+		:param owns: A callable telling whether a namespace's entries are counted when rebuilding, None to count
+		every namespace. Shard processes only count their own guilds.
+		"""
+		self.scope = scope or (lambda entry: None)
+		self.owns = owns
+		self.hourly = {}  # (scope, kind, key) -> {hour number: count}
+		self.daily = {}  # (scope, kind, key) -> {day number: count}
+		self.keys = {}  # (scope, kind) -> set of keys counted
+		self.since = time.time()  # entries before this are counted by rebuilding from the log
+		self.rebuilt = False
+		self.task = None
+		self.entries = 0
+
+	def add(self, entry: dict):
+		"""
+		Counts one entry, used as a CommandLog listener
+		:param entry: The logged command
+		:return: None
+		"""
+		stamp = entry.get("Time", time.time())
+		scope = self.scope(entry)
+		command, user = command_name(entry), str(entry.get("UserName", ''))
+		h = int(stamp // hour)
+		d = h // hours_per_day
+		for kind, key in (('all', ''), ('command', command), ('user', user), ('pair', (command, user))):
+			row = (scope, kind, key)
+			hourly = self.hourly.get(row)
+			if hourly is None:
+				hourly = self.hourly[row] = {}
+				self.daily[row] = {}
+				self.keys.setdefault((scope, kind), set()).add(key)
+			hourly[h] = hourly.get(h, 0) + 1
+			daily = self.daily[row]
+			daily[d] = daily.get(d, 0) + 1
+		self.entries += 1
+
+	def rebuild(self, entries):
+		"""
+		Counts the entries logged before this process started into a new set of rollups, safe to run on a worker
+		thread as it doesn't touch this one
+		:param entries: An iterable of command log entries, such as CommandLog.read()
+		:return: The new UsageRollups, to be merged into this one
+		"""
+		older = UsageRollups(self.scope)
+		for entry in entries:
+			if entry.get("Time", 0) < self.since and (self.owns is None or self.owns(self.scope(entry))):
+				older.add(entry)
+		return older
+
+	def start(self, loop: asyncio.AbstractEventLoop, *logs):
+		"""
+		Starts rebuilding from the logs in the background if it hasn't been done yet
+		:param loop: The event loop the bot runs on
+		:param logs: The CommandLog whose listeners include add(), then the logs other shard processes write
+		:return: None
+		"""
+		if self.task is None:
+			self.task = loop.create_task(self.run(*logs))
+
+	async def run(self, *logs):
+		"""
+		Streams the logs on a worker thread and merges the counts back on the event loop
+		:return: None
+		"""
+		older = await asyncio.get_running_loop().run_in_executor(
+			None, lambda: self.rebuild(entry for log in logs for entry in log.read()))
+		self.merge(older)
+
+	def merge(self, other):
+		"""
+		Adds another set of rollups' counts to these
+		:param other: The UsageRollups returned by rebuild()
+		:return: None
+		"""
+		for buckets, other_buckets in ((self.hourly, other.hourly), (self.daily, other.daily)):
+			for row, counts in other_buckets.items():
+				mine = buckets.setdefault(row, {})
+				for n, count in counts.items():
+					mine[n] = mine.get(n, 0) + count
+		for scope_kind, keys in other.keys.items():
+			self.keys.setdefault(scope_kind, set()).update(keys)
+		self.entries += other.entries
+		self.rebuilt = True
+
+	@staticmethod
+	def _span(counts: dict, lo: int, hi: int):
+		"""
+		:return: The sum of the buckets numbered lo up to but not including hi
+		"""
+		if hi - lo > len(counts):
+			return sum(count for n, count in counts.items() if lo <= n < hi)
+		return sum(counts.get(n, 0) for n in range(lo, hi))
+
+	def count(self, scope, kind: str, key, start: float = 0, end: float = None):
+		"""
+		:param scope: The namespace key
+		:param kind: 'all', 'command', 'user' or 'pair'
+		:param key: The command name, user name or (command, user) tuple, '' for 'all'
+		:param start: Epoch time the range starts at, counted from the start of its hour
+		:param end: Epoch time the range ends at, defaults to now
+		:return: The number of commands logged in the range
+		"""
+		row = (scope, kind, key)
+		hourly = self.hourly.get(row)
+		if hourly is None:
+			return 0
+		lo = int(start // hour)
+		hi = int((time.time() if end is None else end) // hour) + 1
+		first_day, last_day = -(-lo // hours_per_day), hi // hours_per_day
+		if first_day >= last_day:
+			return self._span(hourly, lo, hi)
+		return (self._span(self.daily[row], first_day, last_day) + self._span(hourly, lo, first_day * hours_per_day) +
+				self._span(hourly, last_day * hours_per_day, hi))
+
+	def top(self, scope, kind: str, start: float = 0, end: float = None, command: str = None, user: str = None):
+		"""
+		:param scope: The namespace key
+		:param kind: 'command' or 'user'
+		:param start: Epoch time the range starts at
+		:param end: Epoch time the range ends at, defaults to now
+		:param command: Only count uses of this command, for ranking users
+		:param user: Only count this user's commands, for ranking commands
+		:return: A list of (key, count) tuples, most used first, leaving out keys unused in the range
+		"""
+		if command is None and user is None:
+			counted = ((key, self.count(scope, kind, key, start, end)) for key in self.keys.get((scope, kind), ()))
+		else:
+			pairs = (pair for pair in self.keys.get((scope, 'pair'), ())
+					 if (command is None or pair[0] == command) and (user is None or pair[1] == user))
+			counted = ((pair[0] if kind == 'command' else pair[1], self.count(scope, 'pair', pair, start, end))
+					   for pair in pairs)
+		return sorted(((key, count) for key, count in counted if count), key=lambda item: (-item[1], item[0]))
+
+	def series(self, scope, kind: str, key, start: float, end: float = None):
+		"""
+		:param scope: The namespace key
+		:param kind: 'all', 'command', 'user' or 'pair'
+		:param key: The key as for count()
+		:param start: Epoch time the range starts at
+		:param end: Epoch time the range ends at, defaults to now
+		:return: A list of (bucket start epoch time, count) tuples, hourly for ranges up to two days, else daily
+		"""
+		end = time.time() if end is None else end
+		row = (scope, kind, key)
+		step, counts = (hour, self.hourly.get(row, {})) if end - start <= 2 * day else (day, self.daily.get(row, {}))
+		return [(n * step, counts.get(n, 0)) for n in range(int(start // step), int(end // step) + 1)]
+
+	def users(self, scope):
+		"""
+		:param scope: The namespace key
+		:return: The set of user names counted in the namespace
+		"""
+		return self.keys.get((scope, 'user'), set())
+
+	def stats(self):
+		"""
+		:return: A dict of counted entry, rollup row and bucket counts
+		"""
+		return {'entries': self.entries, 'rows': len(self.hourly), 'rebuilt': self.rebuilt,
+				'buckets': sum(len(counts) for counts in self.hourly.values()) +
+						   sum(len(counts) for counts in self.daily.values())}
@@ -0,0 +1,474 @@
+"""
+Title: MCDB Worker Pool
+Author: Billy Cobb
+Desc: Runs CPU-bound queries, parsing and exports off the event loop on a pool of threads or processes, handing
+workers an immutable columnar snapshot of a guild's locations so they never read data the event loop is changing
+"""
+
+import asyncio
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from columnar import LocationTable
+from metrics import metrics
+from search import SearchIndex
+from spatial import SpatialIndex
+from tags import TagIndex, facet_search
+from transfer import write_locations
+
+
+""" Worker Vars """
+
+
+pool_kinds = ('inline', 'thread', 'process')
+worker_cache_size = 8  # snapshots each worker keeps mapped, a few generations of a few guilds
+worker_index_size = 4  # guilds each worker keeps indexes for, brought up to date from the changes handed off with them
+change_log_size = 512  # changes a guild's SnapshotIndex hands off, a worker further behind than that rebuilds
+query_indexes = {  # query method -> the GuildData attribute holding the index that answers it
+	'nearest': 'spatial_index',
+	'within': 'spatial_index',
+	'box': 'spatial_index',
+	'search': 'search_index'
+}
+index_types = {
+	'spatial_index': SpatialIndex,
+	'search_index': SearchIndex
+}
+snapshot_ids = itertools.count()  # tells apart the snapshots of a guild evicted and opened again at generation 0
+
+
+""" Snapshot Index """
+
+
+class SnapshotIndex:
+	"""
+	A columnar copy of a guild's locations kept in sync with its DataStore like the other indexes, one O(1) row
+	change per add or remove. Freezing it copies the columns whole, so handing workers a snapshot of a store
+	generation costs a few memcpys on the event loop rather than a walk over every location. The copy is only
+	made the first time the guild is frozen, so guilds that never hand anything off don't keep one. Every change
+	since then is numbered and the last change_log_size are kept, so workers bring the indexes they built at an
+	earlier version up to date by replaying the changes rather than rebuilding them.
+	"""
+
+	def __init__(self, key: str, source):
+		"""
+		:param key: The guild's namespace key, naming its snapshots
+		:param source: A callable returning the guild's stored locations
+		"""
+		self.key = f'{key}.{next(snapshot_ids)}'  # unique per opening, its generations start again from 0
+		self.source = source
+		self.table = None
+		self.frozen = None  # (store generation, LocationTable) of the last freeze, None once a change follows it
+		self.freezes = 0
+		self.version = 0  # number of the last change
+		self.base = 0  # version of the last rebuild, workers can't replay changes from before it
+		self.changes = deque(maxlen=change_log_size)  # (version, 'insert' or 'delete', name, loc)
+
+	@staticmethod
+	def _table(locations):
+		return locations.copy() if isinstance(locations, LocationTable) else LocationTable.from_dict(locations)
+
+	def rebuild(self, locations):
+		if self.table is not None:
+			self.table = self._table(locations)
+			self.version += 1
+			self.base = self.version
+			self.changes.clear()
+		self.frozen = None
+
+	def insert(self, name: str, loc: dict):
+		if self.table is not None:
+			self.table[name] = loc
+			self._log('insert', name, loc)
+		self.frozen = None
+
+	def delete(self, name: str, loc: dict):
+		if self.table is not None and name in self.table:
+			del self.table[name]
+			self._log('delete', name, loc)
+		self.frozen = None
+
+	def _log(self, method: str, name: str, loc: dict):
+		self.version += 1
+		self.changes.append((self.version, method, name, loc))
+
+	def freeze(self, generation: int):
+		"""
+		:param generation: The store generation the snapshot is taken at
+		:return: A LocationTable that is never changed again, shared by every hand-off at this generation
+		"""
+		if self.table is None:
+			self.table = self._table(self.source())
+		if self.frozen is None or self.frozen[0] != generation:
+			self.frozen = (generation, self.table.copy())
+			self.freezes += 1
+		return self.frozen[1]
+
+	def __len__(self):
+		return len(self.source())
+
+
+class Handoff:
+	"""
+	What a worker is given to query a guild: the key and generation naming the snapshot, either the frozen
+	table itself, which threads share, or the path of the snapshot file it was written to, which processes map,
+	and the snapshot's version with the changes leading up to it, which workers replay onto their indexes
+	"""
+
+	def __init__(self, snapshots: SnapshotIndex, generation: int, table: LocationTable = None, path: str = None):
+		"""
+		:param snapshots: The guild's SnapshotIndex, frozen at generation
+		:param generation: The store generation of the snapshot
+		:param table: The frozen LocationTable, for threads
+		:param path: The snapshot file, for processes
+		"""
+		self.key = snapshots.key
+		self.generation = generation
+		self.table = table
+		self.path = path
+		self.version = snapshots.version
+		self.base = snapshots.base
+		self.changes = tuple(snapshots.changes)
+
+
+class HandoffFile:
+	"""
+	A snapshot written for the processes to map, removed once a newer generation replaces it and no query in
+	flight still needs it
+	"""
+
+	def __init__(self, generation: int, path: str, task: asyncio.Future):
+		self.generation = generation
+		self.path = path
+		self.task = task  # resolved once the file is written
+		self.readers = 0
+		self.replaced = False
+
+	def release(self):
+		if self.replaced and not self.readers:
+			try:
+				os.remove(self.path)  # processes that already mapped it keep reading it, except on Windows
+			except OSError:
+				pass
+
+
+""" Worker Functions """
+
+
+# built on the workers themselves, each process has its own
+worker_snapshots = OrderedDict()  # (key, generation) -> LocationTable
+worker_indexes = OrderedDict()  # key -> [version, {index type: built index}]
+worker_lock = threading.Lock()
+
+
+def snapshot_table(handoff: Handoff):
+	"""
+	Runs on a worker with worker_lock held. Returns a handed off snapshot's table, mapping its file the first time
+	this worker needs it.
+	:param handoff: The Handoff
+	:return: The LocationTable
+	"""
+	ident = (handoff.key, handoff.generation)
+	table = worker_snapshots.get(ident)
+	if table is None:
+		# the previous generation's table is left for the garbage collector to unmap
+		table = handoff.table if handoff.table is not None else LocationTable.from_snapshot(handoff.path)
+		worker_snapshots[ident] = table
+		while len(worker_snapshots) > worker_cache_size:
+			worker_snapshots.popitem(last=False)
+	worker_snapshots.move_to_end(ident)
+	return table
+
+
+def replay_changes(built: list, handoff: Handoff):
+	"""
+	Runs on a worker with worker_lock held. Brings the indexes built at an earlier version up to a handoff's.
+	:param built: The [version, indexes] entry of the handoff's guild
+	:param handoff: The Handoff
+	:return: False if its changes don't reach back to the indexes' version, so they have to be rebuilt
+	"""
+	version, indexes = built
+	if version == handoff.version:
+		return True
+	changes = [change for change in handoff.changes if change[0] > version]
+	if version < handoff.base or version > handoff.version or len(changes) != handoff.version - version:
+		return False
+	for _, method, name, loc in changes:
+		for index in indexes.values():
+			getattr(index, method)(name, loc)
+	built[0] = handoff.version
+	return True
+
+
+def snapshot_index(handoff: Handoff, index_type):
+	"""
+	Runs on a worker. Returns an index over a handed off snapshot. A worker builds each index of a guild once and
+	replays the changes handed off with later snapshots onto it, only building it again if the worker fell further
+	behind than the changes reach. One index is built or updated at a time.
+	:param handoff: The Handoff
+	:param index_type: SpatialIndex, SearchIndex, TagIndex or LocationTable for the snapshot itself
+	:return: The index
+	"""
+	with worker_lock:
+		if index_type is LocationTable:
+			return snapshot_table(handoff)
+		built = worker_indexes.get(handoff.key)
+		if built is None or not replay_changes(built, handoff):
+			built = worker_indexes[handoff.key] = [handoff.version, {}]
+			while len(worker_indexes) > worker_index_size:
+				worker_indexes.popitem(last=False)
+		worker_indexes.move_to_end(handoff.key)
+		index = built[1].get(index_type)
+		if index is None:
+			index = built[1][index_type] = index_type()
+			index.rebuild(snapshot_table(handoff))
+		return index
+
+
+def run_query(handoff: Handoff, method: str, args: tuple, kwargs: dict):
+	"""
+	Runs on a worker. Answers a query from the indexes built over a snapshot.
+	:param handoff: The Handoff
+	:param method: A key of query_indexes
+	:param args: The index method's positional arguments
+	:param kwargs: Its keyword arguments
+	:return: Whatever the index method returns
+	"""
+	index = snapshot_index(handoff, index_types[query_indexes[method]])
+	return getattr(index, method)(*args, **kwargs)
+
+
+def run_facets(handoff: Handoff, args: tuple):
+	"""
+	Runs on a worker. Answers a faceted find query from the tag, name and spatial indexes built over a snapshot,
+	only building the name and spatial indexes for queries with a name or radius facet.
+	:param handoff: The Handoff
+	:param args: facet_search's (tags, query, point, radius) arguments
+	:return: What facet_search returns
+	"""
+	tags, query, point, radius = args
+	return facet_search(snapshot_index(handoff, LocationTable), snapshot_index(handoff, TagIndex),
+						snapshot_index(handoff, SearchIndex) if query else None,
+						snapshot_index(handoff, SpatialIndex) if point is not None and radius is not None else None,
+						*args)
+
+
+def export_snapshot(handoff: Handoff, path: str, dim: str = None, fmt: str = 'json'):
+	"""
+	Runs on a worker. Writes a snapshot's locations to a gzipped export file.
+	:param handoff: The Handoff
+	:param path: String path to the .gz file
+	:param dim: Only export this dimension, None for every location
+	:param fmt: 'json', 'jsonl' or 'csv'
+	:return: The number of locations written
+	"""
+	table = snapshot_index(handoff, LocationTable)
+
+	def locations():
+		for name, dim_name, x, y, z in table.rows():
+			if dim is None or dim_name == dim:
+				loc = {"Dimension": dim_name, "X": x, "Y": y, "Z": z}
+				if name in table.tags:
+					loc["Tags"] = list(table.tags[name])
+				yield name, loc
+	return write_locations(path, locations(), fmt)
+
+
+""" Worker Pool """
+
+
+class WorkerPool:
+	"""
+	The executors CPU-bound work is sent to. The pool's threads become the event loop's default executor, so the
+	run_in_executor(None, ...) calls already made for file I/O and rendering share one sized pool. With kind
+	'process', queries, parsing and exports go to processes instead, which run in parallel rather than taking
+	turns with the event loop for the GIL, and a guild's snapshot is written once per generation to a file the
+	processes memory-map. Queries only go to processes: on a thread the pure-Python index work would still hold
+	the GIL, so with kind 'thread' or 'inline', and on guilds smaller than min_locations, they run on the event
+	loop, where the incrementally updated indexes answer faster than a hand-off.
+	"""
+
+	def __init__(self, kind: str = 'inline', max_workers: int = None, min_locations: int = 20000):
+		"""
+		:param kind: 'inline', 'thread' or 'process'
+		:param max_workers: Workers in the pool, None for one per core. Threads also run blocking file I/O, so there
+		are always at least 4 of them.
+		:param min_locations: Smallest guild whose queries are handed off
+		:raises ValueError: if kind isn't one of pool_kinds
+		"""
+		if kind not in pool_kinds:
+			raise ValueError(f'worker pool kind must be one of {", ".join(pool_kinds)}')
+		self.kind = kind
+		self.max_workers = max_workers or os.cpu_count() or 1
+		self.min_locations = min_locations
+		self.thread_count = max(self.max_workers, 4)
+		self.threads = ThreadPoolExecutor(max_workers=self.thread_count, thread_name_prefix='mcdb-worker')
+		self.processes = None
+		self.folder = None  # holds the snapshot files handed to processes
+		self.files = {}  # key -> HandoffFile of its latest snapshot
+		self.offloaded = 0
+		self.inline = 0
+		self.handoffs = 0
+		self.in_flight = 0
+
+	def start(self, loop: asyncio.AbstractEventLoop = None):
+		"""
+		Makes the threads the loop's default executor and starts the processes. Run it before the bot connects, so
+		on platforms that fork the processes are copies of a process without connections or threads of its own.
+		:param loop: The event loop the bot runs on
+		:return: None
+		"""
+		if loop is not None:
+			loop.set_default_executor(self.threads)
+		if self.kind == 'process' and self.processes is None:
+			context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods()
+												  else 'spawn')
+			self.processes = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+			self.processes.submit(os.getpid).result()  # forks every worker now rather than on the first query
+			self.folder = tempfile.mkdtemp(prefix='mcdb-workers-')
+
+	def offloads(self, size: int):
+		"""
+		:param size: Number of locations in the guild being queried
+		:return: True if its queries are handed off to the processes
+		"""
+		return self.kind == 'process' and size >= self.min_locations
+
+	async def _run(self, executor, op: str, fn, *args):
+		loop = asyncio.get_running_loop()
+		self.in_flight += 1
+		try:
+			with metrics.timer('mcdb_worker_seconds', op=op):
+				return await loop.run_in_executor(executor, fn, *args)
+		finally:
+			self.in_flight -= 1
+
+	async def thread(self, op: str, fn, *args):
+		"""
+		Runs a callable on the pool's threads, for closures over data that is never changed and blocking I/O
+		:param op: Operation name for metrics
+		:return: The callable's result
+		"""
+		return await self._run(self.threads, op, fn, *args)
+
+	async def cpu(self, op: str, fn, *args):
+		"""
+		Runs CPU-bound work on the processes if there are any, else on the threads
+		:param op: Operation name for metrics
+		:param fn: A module level function, its arguments and result must be picklable
+		:return: The function's result
+		"""
+		return await self._run(self.processes or self.threads, op, fn, *args)
+
+	@asynccontextmanager
+	async def handoff(self, snapshots: SnapshotIndex, generation: int):
+		"""
+		Freezes a guild's snapshot for the workers, writing it to a file once per generation for processes. Used as
+		an async with block, the file is kept until the block ends.
+		:param snapshots: The guild's SnapshotIndex
+		:param generation: The store's current generation
+		:return: The Handoff
+		"""
+		table = snapshots.freeze(generation)
+		handoff = Handoff(snapshots, generation)  # taken before awaiting, so its changes lead up to the frozen table
+		if self.processes is None:
+			handoff.table = table
+			yield handoff
+			return
+		written = self.files.get(snapshots.key)
+		if written is None or written.generation != generation:
+			path = os.path.join(self.folder, f'{snapshots.key}-{generation}.mcdb')
+			task = asyncio.ensure_future(self.thread('handoff', table.write_snapshot, path, False))
+			if written is not None:
+				written.replaced = True
+				written.release()
+			written = self.files[snapshots.key] = HandoffFile(generation, path, task)
+			self.handoffs += 1
+		written.readers += 1
+		try:
+			try:
+				await asyncio.shield(written.task)  # queries at the same generation share one write
+			except OSError:
+				if self.files.get(snapshots.key) is written:
+					del self.files[snapshots.key]  # the next query tries again
+				raise
+			handoff.path = written.path
+			yield handoff
+		finally:
+			written.readers -= 1
+			written.release()
+
+	async def query(self, snapshots: SnapshotIndex, generation: int, index, method: str, *args, **kwargs):
+		"""
+		Runs an index query, on a worker against a snapshot of the guild's locations if the guild is large enough,
+		else on the event loop against the guild's own index
+		:param snapshots: The guild's SnapshotIndex
+		:param generation: The store's current generation
+		:param index: The guild's index answering the query on the event loop
+		:param method: 'nearest', 'within', 'box' or 'search'
+		:return: What the index method returns
+		"""
+		if not self.offloads(len(snapshots)):
+			self.inline += 1
+			return getattr(index, method)(*args, **kwargs)
+		self.offloaded += 1
+		async with self.handoff(snapshots, generation) as handoff:
+			return await self.cpu(method, run_query, handoff, method, args, kwargs)
+
+	async def facets(self, snapshots: SnapshotIndex, generation: int, guild, *args):
+		"""
+		Runs a faceted find query, on a worker against a snapshot of the guild's locations if the guild is large
+		enough, else on the event loop against the guild's own indexes
+		:param snapshots: The guild's SnapshotIndex
+		:param generation: The store's current generation
+		:param guild: The GuildData whose indexes answer the query on the event loop
+		:param args: facet_search's arguments after the indexes
+		:return: What facet_search returns
+		"""
+		if not self.offloads(len(snapshots)):
+			self.inline += 1
+			return facet_search(guild.store.locations, guild.tag_index, guild.search_index, guild.spatial_index,
+								*args)
+		self.offloaded += 1
+		async with self.handoff(snapshots, generation) as handoff:
+			return await self.cpu('facets', run_facets, handoff, args)
+
+	async def export(self, snapshots: SnapshotIndex, generation: int, path: str, dim: str = None, fmt: str = 'json'):
+		"""
+		Writes a gzipped export of a guild's locations on a worker
+		:param snapshots: The guild's SnapshotIndex
+		:param generation: The store's current generation
+		:param path: String path to the .gz file
+		:param dim: Only export this dimension, None for every location
+		:param fmt: 'json', 'jsonl' or 'csv'
+		:return: The number of locations written
+		"""
+		async with self.handoff(snapshots, generation) as handoff:
+			return await self.cpu('export', export_snapshot, handoff, path, dim, fmt)
+
+	def close(self):
+		"""
+		Stops the processes and removes their snapshot files, the threads finish what they were given
+		:return: None
+		"""
+		if self.processes is not None:
+			self.processes.shutdown(wait=True)
+			self.processes = None
+			shutil.rmtree(self.folder, ignore_errors=True)
+			self.files = {}
+		self.threads.shutdown(wait=True)
+
+	def stats(self):
+		"""
+		:return: A dict of worker counts, queries offloaded and run inline, snapshot files written and work in flight
+		"""
+		return {'workers': self.max_workers if self.kind == 'process' else self.thread_count,
+				'processes': self.processes is not None, 'offloaded': self.offloaded, 'inline': self.inline,
+				'handoffs': self.handoffs, 'in_flight': self.in_flight}